@@ -0,0 +1,370 @@
+import contextvars
+from contextlib import asynccontextmanager
+from typing import Union
+
+from sqlalchemy import inspect, select
+from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.pool import NullPool
+from db_controller import DatabaseController
+from models import Category, CategoryTree, CategoryTreeRoot, TreeIdCounter, tree_id_sequence
+from tree_manager import guid_mptt_sessionmaker
+from tree_id_allocator import TreeIdAllocator
+from guid_type import GUID, new_guid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# asyncio drivers of the dialects from db_settings.DATABASE
+ASYNC_DRIVERS: dict = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+# nested sets columns, they are expired by the MPTT events after every flush
+POSITION_ATTRIBUTES = ('left', 'right', 'tree_id', 'level')
+
+# one engine per database URL, pool options and locking mode for the whole process, like db_controller._engines
+_async_engines: dict = {}
+
+
+class MpttSession(Session):
+    """Sync session behind every AsyncSession of AsyncDatabaseController."""
+
+
+# the mapper events of tree_manager are global, the session ones (deferred inserts,
+# cache invalidation, expiring positions) need the session class
+guid_mptt_sessionmaker(MpttSession)
+
+
+class AsyncDatabaseController:
+    """
+    asyncio counterpart of DatabaseController. The MPTT bookkeeping of tree_manager
+    runs unchanged: AsyncSession flushes through its sync MpttSession in a greenlet,
+    where the mapper events execute their statements on the async driver.
+
+    Positions of nodes are expired by the MPTT events after every flush and lazy
+    loading isn't possible with asyncio, so the methods reload them after commit.
+    """
+
+    def __init__(self, settings):
+        self.database = settings.DATABASE
+        self.clear_db = settings.CLEAR_DB_BEFORE_START
+        self.bulk_batch_size = settings.BULK_BATCH_SIZE
+        self.lookup_chunk_size = settings.LOOKUP_CHUNK_SIZE
+        self.pool_size = settings.POOL_SIZE
+        self.pool_max_overflow = settings.POOL_MAX_OVERFLOW
+        self.pool_timeout = settings.POOL_TIMEOUT
+        self.pool_recycle = settings.POOL_RECYCLE
+        self.pool_pre_ping = settings.POOL_PRE_PING
+        self.sparse_step = settings.MPTT_SPARSE_STEP
+        self.deferred = settings.MPTT_DEFERRED
+        self.lock_trees = settings.MPTT_TREE_LOCKS
+        self.tree_id_allocator = TreeIdAllocator(CategoryTree.__table__, tree_id_sequence, TreeIdCounter.__table__,
+                                                 block_size=settings.TREE_ID_BLOCK_SIZE)
+        self.engine = None
+        self.session_factory = None
+        self.sessions = {}
+        # session of `async with dbc.session()`, one per task
+        self._current = contextvars.ContextVar('async_db_session', default=None)
+
+    def create_engine(self) -> AsyncEngine:
+        database: dict = dict(self.database)
+        drivername: str = database['drivername']
+        database['drivername'] = ASYNC_DRIVERS.get(drivername, drivername)
+        url: URL = URL.create(**database)
+        key: tuple = (url.render_as_string(hide_password=False), self.pool_size, self.pool_max_overflow,
+                      self.pool_timeout, self.pool_recycle, self.pool_pre_ping, self.lock_trees)
+        engine: AsyncEngine = _async_engines.get(key)
+        if engine is None:
+            if self.pool_size > 0:
+                engine = create_async_engine(url, pool_size=self.pool_size, max_overflow=self.pool_max_overflow,
+                                             pool_timeout=self.pool_timeout, pool_recycle=self.pool_recycle,
+                                             pool_pre_ping=self.pool_pre_ping)
+            else:
+                engine = create_async_engine(url, poolclass=NullPool)
+            if self.lock_trees and engine.dialect.name == 'sqlite':
+                DatabaseController._begin_immediate(engine.sync_engine)
+            _async_engines[key] = engine
+            logger.debug(f"Async engine for {url!r} is created")
+
+        return engine
+
+    @staticmethod
+    async def dispose_engines():
+        """Close every pooled connection, e.g. at shutdown."""
+        for engine in _async_engines.values():
+            await engine.dispose()
+        _async_engines.clear()
+
+    @staticmethod
+    def create_session_factory(engine: AsyncEngine, mptt: dict = None):
+        # nothing may be lazy loaded with asyncio, so keep loaded values after commit;
+        # info goes to the sync MpttSession, where the MPTT events read it
+        return sessionmaker(engine, class_=AsyncSession, sync_session_class=MpttSession, expire_on_commit=False,
+                            info={'mptt': mptt or {}})
+
+    def mptt_config(self) -> dict:
+        """Settings of the MPTT events for the sessions of this controller, see GuidTreesManager.config."""
+        return {
+            'sparse_step': self.sparse_step,
+            'deferred': self.deferred,
+            'lock_trees': self.lock_trees,
+            'root_registry': CategoryTreeRoot.__table__,
+            'tree_id_allocator': self.tree_id_allocator,
+        }
+
+    @asynccontextmanager
+    async def session(self):
+        """
+        Unit of work bound to the current task:
+
+            async with dbc.session() as session:
+                await dbc.add_category_node(...)
+
+        Every controller method awaited inside the block uses this session and only
+        flushes it. It's committed when the block exits (rolled back on error) and closed
+        afterwards. Nested blocks of the same task share the session.
+        """
+        if self.session_factory is None:
+            raise Exception("database is not opened")
+        session: AsyncSession = self._current.get()
+        if session is not None:
+            yield session
+            return
+        session = self.session_factory()
+        token = self._current.set(session)
+        try:
+            yield session
+            await session.commit()
+        except BaseException:
+            await session.rollback()
+            raise
+        finally:
+            self._current.reset(token)
+            await session.close()
+
+    async def _commit(self, session: AsyncSession):
+        """Commit outside of `async with dbc.session()`, inside the block flush only, the block commits."""
+        if self._current.get() is not None:
+            await session.flush()
+        else:
+            await session.commit()
+
+    def _get_session(self) -> AsyncSession:
+        session: AsyncSession = self._current.get()
+        if session is not None:
+            return session
+        session = self.sessions.get(0)
+        if session is None:
+            raise Exception("session is not created")
+        return session
+
+    async def open_db(self):
+        engine: AsyncEngine = self.create_engine()
+        self.engine = engine
+        async with engine.begin() as connection:
+            await connection.run_sync(DatabaseController.create_tables)
+            await connection.run_sync(self.tree_id_allocator.prepare)
+        self.session_factory = self.create_session_factory(engine, self.mptt_config())
+        session: AsyncSession = self.session_factory()
+        self.sessions[0] = session
+        if self.clear_db:
+            await session.run_sync(self._clear_tables)
+        await session.commit()
+
+    async def close_db(self):
+        session: AsyncSession = self.sessions.pop(0)
+        await session.commit()
+        await session.close()
+        self.session_factory = None
+
+    @staticmethod
+    def _clear_tables(session: Session):
+        session.query(CategoryTreeRoot).delete(synchronize_session=False)
+        session.query(CategoryTree).delete(synchronize_session=False)
+        session.query(Category).delete(synchronize_session=False)
+
+    async def add_category(self, name: str, commit: bool = False) -> Category:
+        session: AsyncSession = self._get_session()
+
+        category: Category = Category(name=name)
+        session.add(category)
+        if commit:
+            try:
+                await self._commit(session)
+                logger.debug(
+                    f'Item {name} is stored in category')
+            except SQLAlchemyError as err:
+                logger.debug(f'Failed to add {name} to db. Error: {err=}, {type(err)=}')
+                await session.rollback()
+                raise
+
+        return category
+
+    async def add_categories(self, *args):
+        session: AsyncSession = self._get_session()
+        for arg in args:
+            if isinstance(arg, str):
+                await self.add_category(arg)
+            elif isinstance(arg, list):
+                for name in arg:
+                    await self.add_category(name)
+            else:
+                raise Exception("Unknonw args in add_categories")
+        try:
+            await self._commit(session)
+            logger.debug(
+                f'Items {args} are stored in category')
+        except SQLAlchemyError as err:
+            logger.debug(f'Failed to add {args} to db. Error: {err=}, {type(err)=}')
+            await session.rollback()
+            raise
+
+    async def get_category(self, name) -> Category:
+        session: AsyncSession = self._get_session()
+        result = await session.execute(select(Category).where(Category.name == name).limit(1))
+        return result.scalars().first()
+
+    async def get_categories(self, names) -> dict:
+        """Return {name: Category} for the given names, unknown names are absent from the result."""
+        session: AsyncSession = self._get_session()
+        categories: dict = {}
+        for chunk in self._chunks(names):
+            result = await session.execute(select(Category).where(Category.name.in_(chunk)))
+            categories.update((category.name, category) for category in result.scalars())
+        return categories
+
+    def _chunks(self, names):
+        names = list(names)
+        for i in range(0, len(names), self.lookup_chunk_size):
+            yield names[i:i + self.lookup_chunk_size]
+
+    async def get_max_tree_id(self):
+        """Return an id for a new tree, see DatabaseController.get_max_tree_id."""
+        session: AsyncSession = self._get_session()
+
+        if isinstance(CategoryTree.tree_id.type, GUID):
+            return new_guid()
+        try:
+            return await session.run_sync(lambda sync_session: self.tree_id_allocator.allocate(
+                sync_session.connection()))
+        except SQLAlchemyError as err:
+            logger.exception(err)
+            raise
+
+    async def _load_positions(self, session: AsyncSession, node: CategoryTree):
+        """Reload lft, rgt, tree_id and level of the node if a flush has expired them."""
+        if node is not None and inspect(node).unloaded.intersection(POSITION_ATTRIBUTES):
+            await session.refresh(node, attribute_names=list(POSITION_ATTRIBUTES))
+
+    async def _refresh_positions(self, session: AsyncSession):
+        """
+        The commit could shift any node of the tree, but the session doesn't expire on commit
+        (an expired attribute can't be loaded on access with asyncio). Reload the positions
+        of all nodes of the session instead, with one query per chunk of ids.
+        """
+        nodes: dict = {node.id: node for node in list(session.identity_map.values())
+                       if isinstance(node, CategoryTree)}
+        for chunk in self._chunks(nodes):
+            result = await session.execute(
+                select(CategoryTree.id, *(getattr(CategoryTree, name) for name in POSITION_ATTRIBUTES))
+                .where(CategoryTree.id.in_(chunk))
+            )
+            for node_id, *values in result:
+                for name, value in zip(POSITION_ATTRIBUTES, values):
+                    set_committed_value(nodes[node_id], name, value)
+
+    async def _commit_node(self, node: CategoryTree, session: AsyncSession):
+        session.add(node)
+        try:
+            await self._commit(session)
+            logger.debug(
+                f'Item {node} has been stored in database successfully')
+        except SQLAlchemyError as err:
+            logger.debug(f'Failed to add {node} to category_tree. Error: {err=}, {type(err)=}')
+            await session.rollback()
+            raise
+        await self._refresh_positions(session)
+
+    async def add_category_node(self, category: Category, tree_id: Union[int, GUID],
+                                parent: CategoryTree = None, category_id: Union[int, GUID] = None) -> CategoryTree:
+        """category may be None when category_id is given, e.g. an id returned by upsert_categories."""
+        if category_id is None:
+            if category is None:
+                raise Exception("can't add category, due to it's None ")
+            category_id = category.id
+
+        session: AsyncSession = self._get_session()
+
+        if parent is None:
+            parent_id = None
+        else:
+            parent_id = parent.id
+
+        node = CategoryTree(category_id=category_id, parent_id=parent_id, left=0, right=0, tree_id=tree_id)
+
+        await self._commit_node(node, session)
+        return node
+
+    async def update_node(self, node: CategoryTree, category: Category,
+                          parent: CategoryTree = None) -> CategoryTree:
+        if node is None:
+            raise Exception("node mustn't be None")
+        if category is None:
+            raise Exception("can't add category, due to it's None")
+
+        session: AsyncSession = self._get_session()
+        await self._load_positions(session, parent)
+
+        # ids instead of the relationships, assigning those would lazy load their backrefs
+        node.category_id = category.id
+        node.parent_id = None if parent is None else parent.id
+
+        # a node which becomes a root gets its new tree_id from the MPTT hook
+        if parent is not None:
+            node.tree_id = parent.tree_id
+
+        await self._commit_node(node, session)
+        return node
+
+    # tree reads reuse the queries of DatabaseController
+
+    async def get_subtree(self, node: CategoryTree, max_depth: int = None) -> list:
+        """Return the node and its descendants (down to max_depth levels below it) ordered by lft."""
+        session: AsyncSession = self._get_session()
+        await self._load_positions(session, node)
+        result = await session.execute(DatabaseController._subtree_query(node, max_depth))
+        return result.scalars().all()
+
+    async def get_ancestors(self, node: CategoryTree) -> list:
+        """Return the ancestors of the node from the root down."""
+        session: AsyncSession = self._get_session()
+        await self._load_positions(session, node)
+        result = await session.execute(DatabaseController._ancestors_query(node))
+        return result.scalars().all()
+
+    async def get_children(self, node: CategoryTree) -> list:
+        session: AsyncSession = self._get_session()
+        await self._load_positions(session, node)
+        result = await session.execute(DatabaseController._children_query(node))
+        return result.scalars().all()
+
+    async def count_descendants(self, node: CategoryTree) -> int:
+        session: AsyncSession = self._get_session()
+        await self._load_positions(session, node)
+        result = await session.execute(DatabaseController._count_descendants_query(node))
+        return result.scalar()
+
+    async def iter_subtree(self, node: CategoryTree, batch_size: int = None):
+        """Async generator over (id, parent_id, level, lft, rgt, name) of the subtree in lft order."""
+        session: AsyncSession = self._get_session()
+        await self._load_positions(session, node)
+        batch_size = batch_size or self.bulk_batch_size
+        result = await session.stream(DatabaseController._subtree_rows_query(node))
+        async for rows in result.partitions(batch_size):
+            for row in rows:
+                yield tuple(row)
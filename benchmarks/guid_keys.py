@@ -0,0 +1,90 @@
+"""
+Insert throughput, primary key index size and WAL volume of uuid4 keys against uuid7 keys.
+
+    python -m benchmarks.guid_keys --rows 200000 --batch 1000
+
+The database comes from the settings (SQLITE_FILE or POSTGRES_*), the scratch
+tables guid_bench_v4 and guid_bench_v7 are dropped afterwards.
+"""
+import argparse
+import json
+import time
+import uuid
+
+from sqlalchemy import Column, MetaData, String, Table, text
+from sqlalchemy.engine import Engine
+import settings
+from db_controller import DatabaseController
+from guid_type import GUID, uuid7
+
+
+def _index_size(connection, table: Table) -> int:
+    if connection.dialect.name == 'postgresql':
+        return connection.execute(text("SELECT pg_relation_size(:name)"), {'name': f"{table.name}_pkey"}).scalar()
+    # the primary key of a rowid table with a non-integer key is an automatic index
+    return connection.execute(
+        text("SELECT sum(pgsize) FROM dbstat WHERE name = :name"), {'name': f"sqlite_autoindex_{table.name}_1"}
+    ).scalar()
+
+
+def _wal_position(connection):
+    if connection.dialect.name != 'postgresql':
+        return None
+    return int(connection.execute(text("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')")).scalar())
+
+
+def run(engine: Engine, version: int, rows: int, batch: int) -> dict:
+    generate = uuid7 if version == 7 else uuid.uuid4
+    table = Table(f"guid_bench_v{version}", MetaData(),
+                  Column('id', GUID(), primary_key=True),
+                  Column('payload', String(64), nullable=False))
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+    try:
+        with engine.connect() as connection:
+            wal_start = _wal_position(connection)
+        start = time.perf_counter()
+        for offset in range(0, rows, batch):
+            # one transaction per batch, like a writer committing its unit of work
+            with engine.begin() as connection:
+                connection.execute(table.insert(), [
+                    {'id': generate(), 'payload': 'x' * 32} for _ in range(min(batch, rows - offset))
+                ])
+        elapsed = time.perf_counter() - start
+        with engine.connect() as connection:
+            wal_end = _wal_position(connection)
+            index_bytes = _index_size(connection, table)
+    finally:
+        table.drop(engine)
+
+    return {
+        'version': version,
+        'rows': rows,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(rows / elapsed),
+        'index_bytes': index_bytes,
+        'wal_bytes': None if wal_start is None else wal_end - wal_start,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare uuid4 and uuid7 primary keys")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    engine: Engine = DatabaseController(settings).create_engine()
+    results = [run(engine, version, args.rows, args.batch) for version in (4, 7)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{engine.dialect.name}, {args.rows} rows in batches of {args.batch}, GUID.native={GUID.native}")
+    print(f"{'keys':<6}{'seconds':>10}{'rows/s':>10}{'index bytes':>14}{'WAL bytes':>14}")
+    for result in results:
+        print(f"uuid{result['version']:<2}{result['seconds']:>10}{result['rows_per_second']:>10}"
+              f"{result['index_bytes']:>14}{result['wal_bytes'] if result['wal_bytes'] is not None else '-':>14}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+Latency and throughput of tree operations on synthetic trees.
+
+    SQLITE_FILE=/tmp/bench.db python -m benchmarks.trees --nodes 2000 --output sqlite.json
+    python -m benchmarks.trees --nodes 2000 --output postgres.json          # POSTGRES_* settings
+    python -m benchmarks.trees --nodes 2000 --compare postgres.json         # against a baseline
+
+The database comes from the settings like for main.py, use a scratch one: the
+benchmark writes its own categories (bench_*) and trees and removes them at the end.
+MPTT_SPARSE_STEP, MPTT_DEFERRED, MPTT_TREE_LOCKS etc. are taken into account and recorded.
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import sqlalchemy
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import aliased
+import settings
+from db_controller import DatabaseController, ON, OFF
+from models import Category, CategoryTree, CategoryTreeRoot
+
+SHAPES = ('wide', 'deep', 'balanced', 'skewed')
+OPERATIONS = ('insert_mptt', 'insert_rebuild', 'move', 'delete', 'read_subtree', 'read_ancestors')
+
+
+def make_parents(shape: str, count: int, rng: random.Random, fanout: int = 4) -> list:
+    """Parent index of every node, -1 for the root. Parents always come before their children."""
+    parents = [-1]
+    for i in range(1, count):
+        if shape == 'wide':
+            parents.append(0)
+        elif shape == 'deep':
+            parents.append(i - 1)
+        elif shape == 'balanced':
+            parents.append((i - 1) // fanout)
+        elif shape == 'skewed':
+            # most nodes hang under the first few ones
+            parents.append(int((i - 1) * rng.random() ** 3))
+        else:
+            raise Exception(f"unknown shape {shape}, use one of {SHAPES}")
+    return parents
+
+
+class Timer:
+    def __init__(self):
+        self.latencies: list = []
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.latencies.append(time.perf_counter() - self._start)
+
+    def result(self, shape: str, operation: str, elapsed: float = None) -> dict:
+        latencies = sorted(self.latencies)
+        elapsed = sum(latencies) if elapsed is None else elapsed
+        return {
+            'shape': shape,
+            'operation': operation,
+            'count': len(latencies),
+            'seconds': round(elapsed, 6),
+            'ops_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'p50_ms': round(statistics.median(latencies) * 1000, 3) if latencies else None,
+            'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3) if latencies else None,
+            'max_ms': round(latencies[-1] * 1000, 3) if latencies else None,
+        }
+
+
+class TreeBenchmark:
+    def __init__(self, dbc: DatabaseController, args):
+        self.dbc = dbc
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.session = dbc.sessions[0]
+        self.tree_ids: list = []
+        self.categories: list = []
+        # ids of the benchmark's categories, cleanup deletes them
+        self.category_ids: list = []
+
+    def prepare_categories(self):
+        names = [f"bench_{i}" for i in range(self.args.nodes)]
+        category_ids: dict = self.dbc.upsert_categories(names)
+        self.category_ids = list(category_ids.values())
+        self.categories = [self.session.get(Category, category_ids[name]) for name in names]
+
+    def build(self, parents: list) -> list:
+        """Insert the tree node by node, returns the nodes."""
+        tree_id = self.dbc.get_max_tree_id()
+        nodes: list = []
+        for i, parent in enumerate(parents):
+            nodes.append(self.dbc.add_category_node(self.categories[i], tree_id,
+                                                    parent=None if parent < 0 else nodes[parent]))
+        self.tree_ids.append(nodes[0].tree_id)
+        return nodes
+
+    def insert_mptt(self, shape: str, parents: list) -> list:
+        timer = Timer()
+        tree_id = self.dbc.get_max_tree_id()
+        nodes: list = []
+        for i, parent in enumerate(parents):
+            with timer:
+                nodes.append(self.dbc.add_category_node(self.categories[i], tree_id,
+                                                        parent=None if parent < 0 else nodes[parent]))
+        self.tree_ids.append(nodes[0].tree_id)
+        return [timer.result(shape, 'insert_mptt')]
+
+    def insert_rebuild(self, shape: str, parents: list) -> list:
+        timer = Timer()
+        rebuild = Timer()
+        tree_id = self.dbc.get_max_tree_id()
+        nodes: list = []
+        self.dbc.switch_mptt(flag=OFF, tree_id=tree_id)
+        try:
+            for i, parent in enumerate(parents):
+                with timer:
+                    nodes.append(self.dbc.add_category_node(self.categories[i], tree_id,
+                                                            parent=None if parent < 0 else nodes[parent]))
+        finally:
+            with rebuild:
+                self.dbc.switch_mptt(flag=ON, tree_id=tree_id)
+                self.session.commit()
+        self.tree_ids.append(tree_id)
+        return [timer.result(shape, 'insert_rebuild'), rebuild.result(shape, 'rebuild')]
+
+    def _random_node(self, tree_id, *criteria):
+        node_id = self.session.execute(
+            select(CategoryTree.id).where(CategoryTree.tree_id == tree_id, *criteria)
+            .order_by(func.random()).limit(1)
+        ).scalar()
+        return None if node_id is None else self.session.get(CategoryTree, node_id)
+
+    def move(self, shape: str, parents: list) -> list:
+        timer = Timer()
+        tree_id = self.build(parents)[0].tree_id
+        for _ in range(self.args.moves):
+            node = self._random_node(tree_id, CategoryTree.parent_id.isnot(None))
+            if node is None:
+                break
+            # any node outside of the moved subtree
+            parent = self._random_node(tree_id, or_(CategoryTree.left < node.left, CategoryTree.left > node.right))
+            if parent is None:
+                continue
+            with timer:
+                self.dbc.update_node(node, self.session.get(Category, node.category_id), parent=parent)
+            self.session.expire_all()
+        return [timer.result(shape, 'move')]
+
+    def delete(self, shape: str, parents: list) -> list:
+        timer = Timer()
+        tree_id = self.build(parents)[0].tree_id
+        children = aliased(CategoryTree)
+        child = select(children.id).where(children.parent_id == CategoryTree.id).exists()
+        for _ in range(self.args.deletes):
+            node = self._random_node(tree_id, CategoryTree.parent_id.isnot(None), ~child)
+            if node is None:
+                break
+            with timer:
+                self.session.delete(node)
+                self.session.commit()
+        return [timer.result(shape, 'delete')]
+
+    def read_subtree(self, shape: str, parents: list) -> list:
+        return self._reads(shape, parents, 'read_subtree', self.dbc.get_subtree)
+
+    def read_ancestors(self, shape: str, parents: list) -> list:
+        return self._reads(shape, parents, 'read_ancestors', self.dbc.get_ancestors)
+
+    def _reads(self, shape: str, parents: list, operation: str, read) -> list:
+        timer = Timer()
+        nodes = self.build(parents)
+        self.session.commit()
+        for _ in range(self.args.reads):
+            node = self.rng.choice(nodes)
+            with timer:
+                read(node)
+        return [timer.result(shape, operation)]
+
+    def cleanup(self):
+        if self.tree_ids:
+            self.session.query(CategoryTreeRoot).filter(CategoryTreeRoot.tree_id.in_(self.tree_ids)) \
+                .delete(synchronize_session=False)
+            benchmark_nodes = CategoryTree.tree_id.in_(self.tree_ids)
+            levels = self.session.execute(
+                select(CategoryTree.level).where(benchmark_nodes).distinct().order_by(CategoryTree.level.desc())
+            ).scalars().all()
+            # children first for the self-referencing foreign key
+            for level in levels:
+                self.session.query(CategoryTree).filter(and_(benchmark_nodes, CategoryTree.level == level)) \
+                    .delete(synchronize_session=False)
+        for start in range(0, len(self.category_ids), self.dbc.lookup_chunk_size):
+            self.session.query(Category) \
+                .filter(Category.id.in_(self.category_ids[start:start + self.dbc.lookup_chunk_size])) \
+                .delete(synchronize_session=False)
+        self.session.commit()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_path: str):
+    """Print ops/s of the run against a previous JSON output."""
+    with open(baseline_path, encoding='utf-8') as fp:
+        baseline = {(r['shape'], r['operation']): r for r in json.load(fp)['results']}
+    print(f"{'shape':<10}{'operation':<16}{'baseline ops/s':>16}{'ops/s':>12}{'change':>10}")
+    for result in results:
+        old = baseline.get((result['shape'], result['operation']))
+        if old is None or not old['ops_per_second'] or not result['ops_per_second']:
+            continue
+        change = result['ops_per_second'] / old['ops_per_second'] - 1
+        print(f"{result['shape']:<10}{result['operation']:<16}{old['ops_per_second']:>16}"
+              f"{result['ops_per_second']:>12}{change:>+10.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tree operations")
+    parser.add_argument('--nodes', type=int, default=1000, help="nodes per tree")
+    parser.add_argument('--shapes', default=','.join(SHAPES))
+    parser.add_argument('--operations', default=','.join(OPERATIONS))
+    parser.add_argument('--moves', type=int, default=100)
+    parser.add_argument('--deletes', type=int, default=100)
+    parser.add_argument('--reads', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    shapes = [shape for shape in args.shapes.split(',') if shape]
+    operations = [operation for operation in args.operations.split(',') if operation]
+    unknown = [operation for operation in operations if operation not in OPERATIONS]
+    if unknown:
+        raise Exception(f"unknown operations {unknown}, use {OPERATIONS}")
+
+    dbc = DatabaseController(settings)
+    dbc.open_db()
+    benchmark = TreeBenchmark(dbc, args)
+    results: list = []
+    try:
+        benchmark.prepare_categories()
+        for shape in shapes:
+            parents = make_parents(shape, args.nodes, benchmark.rng)
+            for operation in operations:
+                results.extend(getattr(benchmark, operation)(shape, parents))
+                print(f"{shape} {operation} done", file=sys.stderr)
+    finally:
+        benchmark.cleanup()
+        dbc.close_db()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'dialect': dbc.engine.dialect.name,
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'nodes': args.nodes,
+            'seed': args.seed,
+            'mptt_sparse_step': settings.MPTT_SPARSE_STEP,
+            'mptt_deferred': settings.MPTT_DEFERRED,
+            'mptt_tree_locks': settings.MPTT_TREE_LOCKS,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,32 @@
+import csv
+import datetime
+import importlib
+import io
+import os
+import threading
 import time
-from typing import Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Callable, Union
 
-from sqlalchemy import create_engine, func
+from sqlalchemy import create_engine, event, func, select, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.pool import NullPool
-from models import DeclarativeBase, Category, CategoryTree
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.dialects import postgresql, sqlite
+from db_pool import MeteredQueuePool
+from models import DeclarativeBase, Category, CategoryTree, CategoryTreeRoot, TreeIdCounter, tree_id_sequence
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy_mptt import tree_manager, mptt_sessionmaker
-from guid_type import GUID
+from tree_manager import guid_tree_manager, guid_mptt_sessionmaker, lock_node_trees, rebuild_subtree, ensure_root, \
+    verify_tree, damaged_subtrees
+from tree_id_allocator import TreeIdAllocator
+from tree_cache import TreeCache, TreeStructure
+from tree_snapshot import TreeSnapshot
+from instrumentation import SqlStats
+from guid_type import GUID, new_guid
+import tree_export
+import tree_mmap
 import logging
 
 logger = logging.getLogger(__name__)
@@ -18,23 +35,99 @@ logger = logging.getLogger(__name__)
 ON: bool = False
 OFF: bool = True
 
+# one engine (and so one pool) per database URL, pool options and locking mode for the whole process
+_engines: dict = {}
+_engines_lock = threading.Lock()
+
 
 class DatabaseController:
 
     def __init__(self, settings):
+        # module name to load the same settings in worker processes, see rebuild_all
+        self.settings_name = settings.__name__
         self.database = settings.DATABASE
         self.clear_db = settings.CLEAR_DB_BEFORE_START
         self.db_schema = settings.DB_SCHEMA
+        self.bulk_batch_size = settings.BULK_BATCH_SIZE
+        self.lookup_chunk_size = settings.LOOKUP_CHUNK_SIZE
+        self.upsert_copy_threshold = settings.UPSERT_COPY_THRESHOLD
+        self.pool_size = settings.POOL_SIZE
+        self.pool_max_overflow = settings.POOL_MAX_OVERFLOW
+        self.pool_timeout = settings.POOL_TIMEOUT
+        self.pool_recycle = settings.POOL_RECYCLE
+        self.pool_pre_ping = settings.POOL_PRE_PING
+        self.sparse_step = settings.MPTT_SPARSE_STEP
+        self.deferred = settings.MPTT_DEFERRED
+        self.lock_trees = settings.MPTT_TREE_LOCKS
+        self.tree_id_allocator = TreeIdAllocator(CategoryTree.__table__, tree_id_sequence, TreeIdCounter.__table__,
+                                                 block_size=settings.TREE_ID_BLOCK_SIZE)
+        self.tree_cache_max_nodes = settings.TREE_CACHE_MAX_NODES
+        self.tree_cache = None
+        self.sql_stats = settings.SQL_STATS
+        # instrumentation.SqlStats of the engine and the MPTT hooks, None when SQL_STATS is off
+        self.stats = None
+        self.engine = None
         self.sessions = {}
+        # sessions for units of work opened by `with dbc.session()`, one per thread
+        self.scoped_sessions = None
+        self._local = threading.local()
 
     def create_engine(self):
         # if it's a first time to launch, we should create a data folder
         self.create_data_folder()
-        # TODO: Add Connection Pool here (low priority task)
-        engine: Engine = create_engine(URL(**self.database), poolclass=NullPool)
+        url: URL = URL(**self.database)
+        # controllers with other pool options get their own engine
+        key: tuple = (url.render_as_string(hide_password=False), self.pool_size, self.pool_max_overflow,
+                      self.pool_timeout, self.pool_recycle, self.pool_pre_ping, self.lock_trees)
+        with _engines_lock:
+            engine: Engine = _engines.get(key)
+            if engine is None:
+                if self.pool_size > 0:
+                    engine = create_engine(url, poolclass=MeteredQueuePool, pool_size=self.pool_size,
+                                           max_overflow=self.pool_max_overflow, pool_timeout=self.pool_timeout,
+                                           pool_recycle=self.pool_recycle, pool_pre_ping=self.pool_pre_ping)
+                else:
+                    engine = create_engine(url, poolclass=NullPool)
+                if self.lock_trees and engine.dialect.name == 'sqlite':
+                    self._begin_immediate(engine)
+                _engines[key] = engine
+                logger.debug(f"Engine for {url!r} is created with {type(engine.pool).__name__}")
 
         return engine
 
+    @staticmethod
+    def _begin_immediate(engine: Engine):
+        """
+        Make pysqlite start every transaction with BEGIN IMMEDIATE, i.e. take the
+        write lock before the first read. It's the SQLite side of the per-tree locks.
+        Read-only transactions hold the lock too, so keep them short.
+        """
+        @event.listens_for(engine, 'connect')
+        def do_connect(dbapi_connection, connection_record):
+            # disable pysqlite's own BEGIN, it's emitted lazily before the first write
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def do_begin(connection):
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    @staticmethod
+    def dispose_engines(close: bool = True):
+        """
+        Close every pooled connection, e.g. at shutdown. In a forked child use close=False:
+        the connections still belong to the parent and are only dropped from the pool.
+        """
+        with _engines_lock:
+            for engine in _engines.values():
+                engine.dispose(close=close)
+            _engines.clear()
+
+    def pool_metrics(self) -> dict:
+        """Return checkout/wait/overflow counters of the engine's pool (empty without pooling)."""
+        if self.engine is None or not isinstance(self.engine.pool, MeteredQueuePool):
+            return {}
+        return self.engine.pool.metrics_status()
+
     def create_data_folder(self):
         pass
         # Path("../../../data").mkdir(parents=True, exist_ok=True)
@@ -42,42 +135,136 @@ class DatabaseController:
     @staticmethod
     def create_tables(engine):
         DeclarativeBase.metadata.create_all(engine, checkfirst=True)
+        # create_all skips the indexes of tables which already exist
+        for table in DeclarativeBase.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(engine, checkfirst=True)
+
+    @staticmethod
+    def create_session_factory(engine, mptt: dict = None):
+        # mptt overrides the settings of guid_tree_manager for the sessions of this factory
+        return guid_mptt_sessionmaker(sessionmaker(bind=engine, info={'mptt': mptt or {}}))
 
     @staticmethod
-    def create_session(engine):
-        session: Session = mptt_sessionmaker(sessionmaker(bind=engine))()
+    def create_session(engine, mptt: dict = None):
+        session: Session = DatabaseController.create_session_factory(engine, mptt)()
 
         return session
 
+    def mptt_config(self) -> dict:
+        """Settings of the MPTT events for the sessions of this controller, see GuidTreesManager.config."""
+        return {
+            'sparse_step': self.sparse_step,
+            'deferred': self.deferred,
+            'lock_trees': self.lock_trees,
+            'root_registry': CategoryTreeRoot.__table__,
+            'tree_id_allocator': self.tree_id_allocator,
+            'cache': self.tree_cache,
+            'instrumentation': self.stats,
+        }
+
+    @contextmanager
+    def session(self):
+        """
+        Unit of work bound to the current thread:
+
+            with dbc.session() as session:
+                dbc.add_category_node(...)
+
+        Every controller method called inside the block uses this thread's session and
+        only flushes it. It's committed when the block exits (rolled back on error) and
+        removed afterwards. Nested blocks in the same thread share the session, only the
+        outermost one commits or rolls back.
+        """
+        if self.scoped_sessions is None:
+            raise Exception("database is not opened")
+        session: Session = self.scoped_sessions()
+        depth: int = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        try:
+            if depth:
+                yield session
+                return
+            try:
+                yield session
+                session.commit()
+            except BaseException:
+                session.rollback()
+                raise
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self.scoped_sessions.remove()
+
+    def _commit(self, session: Session):
+        """Commit outside of `with dbc.session()`, inside the block flush only, the block commits."""
+        if getattr(self._local, 'depth', 0):
+            session.flush()
+        else:
+            session.commit()
+
+    def _get_session(self) -> Session:
+        if getattr(self._local, 'depth', 0):
+            return self.scoped_sessions()
+        session: Session = self.sessions.get(0)
+        if session is None:
+            raise Exception("session is not created")
+        return session
+
     def clear_tables(self, session):
         if self.clear_db:
+            session.query(CategoryTreeRoot).delete(synchronize_session=False)
             session.query(CategoryTree).delete(synchronize_session=False)
             session.query(Category).delete(synchronize_session=False)
 
     def open_db(self):
         engine: Engine = self.create_engine()
+        self.engine = engine
         self.create_tables(engine)
-        session: Session = self.create_session(engine)
+        with engine.begin() as connection:
+            self.tree_id_allocator.prepare(connection)
+        if self.tree_cache_max_nodes > 0:
+            self.tree_cache = TreeCache(self._load_tree_structure, self.tree_cache_max_nodes)
+        if self.sql_stats:
+            self.stats = SqlStats()
+            self.stats.attach(engine)
+        mptt: dict = self.mptt_config()
+        session: Session = self.create_session(engine, mptt)
         self.sessions[0]: Session = session
+        self.scoped_sessions = scoped_session(self.create_session_factory(engine, mptt))
         self.clear_tables(session)
         session.commit()
 
+    @classmethod
+    def open_worker(cls, settings_name: str) -> 'DatabaseController':
+        """
+        Open a controller in a worker process of a pool, with the settings module of the parent.
+        The tables are never cleared here, whatever CLEAR_DB_BEFORE_START says.
+        """
+        # a forked child inherits the parent's pooled connections, they mustn't be used here
+        cls.dispose_engines(close=False)
+        controller = cls(importlib.import_module(settings_name))
+        controller.clear_db = False
+        controller.open_db()
+        return controller
+
     def close_db(self):
         session: Session = self.sessions.pop(0)
         session.commit()
         session.close()
+        self.scoped_sessions.remove()
+        if self.stats is not None:
+            self.stats.detach(self.engine)
+        self.scoped_sessions = None
 
     def add_category(self, name: str, commit: bool = False) -> Category:
-        session: Session = self.sessions[0]
-        if session is None:
-            raise Exception("session to db is not created")
+        session: Session = self._get_session()
 
         category: Category = Category(name=name)
         session.add(category)
         if commit:
             try:
-                session.commit()
-                # session.flush()
+                self._commit(session)
                 logger.debug(
                     f'Item {name} is stored in category')
 
@@ -89,9 +276,7 @@ class DatabaseController:
         return category
 
     def add_categories(self, *args):
-        session: Session = self.sessions[0]
-        if session is None:
-            raise Exception("session to db is not created")
+        session: Session = self._get_session()
         if args is None:
             raise Exception("category name isn't passed")
         for arg in args:
@@ -102,9 +287,8 @@ class DatabaseController:
                     self.add_category(name)
             else:
                 raise Exception("Unknonw args in add_categories")
-        #   session.flush()
         try:
-            session.commit()
+            self._commit(session)
             logger.debug(
                 f'Items {args} are stored in category')
         except SQLAlchemyError as err:
@@ -113,53 +297,455 @@ class DatabaseController:
             raise
 
     def get_category(self, name) -> Category:
-        session: Session = self.sessions[0]
-        if session is None:
-            raise Exception("session is not created")
+        session: Session = self._get_session()
         category: Category = session.query(Category).filter(Category.name == name).first()
         return category
 
+    def get_categories(self, names) -> dict:
+        """
+        Return {name: Category} for the given names using chunked IN (...) queries.
+        Unknown names are absent from the result.
+        """
+        session: Session = self._get_session()
+        categories: dict = {}
+        for chunk in self._chunks(names):
+            categories.update((category.name, category) for category in
+                              session.query(Category).filter(Category.name.in_(chunk)))
+        return categories
+
+    def resolve_category_ids(self, names) -> dict:
+        """
+        Return {name: category id} for the given names without loading ORM instances.
+        Unknown names are absent from the result.
+        """
+        session: Session = self._get_session()
+        category_ids: dict = {}
+        for chunk in self._chunks(names):
+            category_ids.update(session.query(Category.name, Category.id).filter(Category.name.in_(chunk)).all())
+        return category_ids
+
+    def upsert_categories(self, names) -> dict:
+        """
+        Insert the names which don't exist yet and return {name: category id} for all of them.
+        Existing names don't fail the batch, they are skipped by INSERT ... ON CONFLICT (name) DO NOTHING.
+        PostgreSQL returns the ids of new rows with RETURNING (large batches are copied into
+        a staging table first), the ids of the other names are looked up in chunks.
+        """
+        session: Session = self._get_session()
+        names = list(dict.fromkeys(names))
+        if not names:
+            return {}
+        connection = session.connection()
+        try:
+            if connection.dialect.name == 'postgresql' and len(names) >= self.upsert_copy_threshold:
+                category_ids: dict = self._copy_categories(connection, names)
+            else:
+                category_ids: dict = self._insert_categories(connection, names)
+            self._commit(session)
+            logger.debug(f'{len(names)} names are stored in category')
+        except SQLAlchemyError as err:
+            logger.debug(f'Failed to upsert {len(names)} names. Error: {err=}, {type(err)=}')
+            session.rollback()
+            raise
+        return category_ids
+
+    def _insert_categories(self, connection, names: list) -> dict:
+        table = Category.__table__
+        is_postgresql: bool = connection.dialect.name == 'postgresql'
+        insert = postgresql.insert if is_postgresql else sqlite.insert
+        category_ids: dict = {}
+        for chunk in self._chunks(names):
+            statement = insert(table).on_conflict_do_nothing(index_elements=[table.c.name])
+            if is_postgresql:
+                # one multi-row INSERT per chunk, ids of the inserted rows come back at once
+                statement = statement.values([{'name': name} for name in chunk]).returning(table.c.name, table.c.id)
+                category_ids.update(connection.execute(statement).all())
+            else:
+                # SQLAlchemy 1.4 has no RETURNING for SQLite, executemany and look the ids up below
+                connection.execute(statement, [{'name': name} for name in chunk])
+
+        existing = [name for name in names if name not in category_ids]
+        for chunk in self._chunks(existing):
+            category_ids.update(connection.execute(
+                select(table.c.name, table.c.id).where(table.c.name.in_(chunk))
+            ).all())
+        return category_ids
+
+    @staticmethod
+    def _copy_categories(connection, names: list) -> dict:
+        """COPY names into a temporary table, then one INSERT ... SELECT and one join return all ids."""
+        table = Category.__table__
+        table_name: str = connection.dialect.identifier_preparer.format_table(table)
+        # GUID keys are generated here like the column default does for ORM inserts
+        is_guid: bool = isinstance(table.c.id.type, GUID)
+        columns: str = 'id, name' if is_guid else 'name'
+        connection.exec_driver_sql(
+            f"CREATE TEMPORARY TABLE category_staging ({'id uuid, ' if is_guid else ''}"
+            f"name varchar(256) PRIMARY KEY) ON COMMIT DROP"
+        )
+        buffer = io.StringIO()
+        # quoted, an empty unquoted field would be NULL
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        for name in names:
+            writer.writerow([new_guid(), name] if is_guid else [name])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY category_staging ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        finally:
+            cursor.close()
+
+        connection.execute(
+            text(
+                f"INSERT INTO {table_name} ({columns}, created_at) "
+                f"SELECT {columns}, :now FROM category_staging "
+                f"ON CONFLICT (name) DO NOTHING"
+            ),
+            {'now': datetime.datetime.utcnow()}
+        )
+        return dict(connection.execute(
+            text(f"SELECT c.name, c.id FROM {table_name} c JOIN category_staging s ON s.name = c.name")
+        ).all())
+
+    def _chunks(self, names):
+        unique_names = list(dict.fromkeys(names))
+        for start in range(0, len(unique_names), self.lookup_chunk_size):
+            yield unique_names[start:start + self.lookup_chunk_size]
+
+    def get_subtree(self, node: CategoryTree, max_depth: int = None) -> list:
+        """Return the node and its descendants (down to max_depth levels below it) ordered by lft."""
+        session: Session = self._get_session()
+        return session.execute(self._subtree_query(node, max_depth)).scalars().all()
+
+    def get_roots(self) -> list:
+        """Return the roots of all trees in the order of the root registry, unregistered trees go last."""
+        session: Session = self._get_session()
+        return session.execute(
+            select(CategoryTree).outerjoin(
+                CategoryTreeRoot, CategoryTreeRoot.tree_id == CategoryTree.tree_id
+            ).where(
+                CategoryTree.parent_id.is_(None)
+            ).order_by(
+                CategoryTreeRoot.position.is_(None), CategoryTreeRoot.position, CategoryTree.tree_id
+            )
+        ).scalars().all()
+
+    def get_ancestors(self, node: CategoryTree) -> list:
+        """Return the ancestors of the node from the root down, e.g. for breadcrumbs."""
+        session: Session = self._get_session()
+        return session.execute(self._ancestors_query(node)).scalars().all()
+
+    def get_children(self, node: CategoryTree) -> list:
+        session: Session = self._get_session()
+        return session.execute(self._children_query(node)).scalars().all()
+
+    def count_descendants(self, node: CategoryTree) -> int:
+        session: Session = self._get_session()
+        return session.execute(self._count_descendants_query(node)).scalar()
+
+    def iter_subtree(self, node: CategoryTree, batch_size: int = None):
+        """
+        Yield (id, parent_id, level, lft, rgt, category name) of the subtree in lft order.
+        Rows are fetched batch_size at a time through a server-side cursor (psycopg2),
+        no ORM instances are created, so the memory use doesn't depend on the tree size.
+        """
+        session: Session = self._get_session()
+        batch_size = batch_size or self.bulk_batch_size
+        connection = session.connection().execution_options(stream_results=True, max_row_buffer=batch_size)
+        result = connection.execute(self._subtree_rows_query(node))
+        try:
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield tuple(row)
+        finally:
+            result.close()
+
+    def export_subtree(self, node: CategoryTree, path: str, fmt: str = 'jsonl', batch_size: int = None) -> int:
+        """Stream the subtree to a JSON Lines or CSV file, return the number of exported nodes."""
+        writer = tree_export.WRITERS.get(fmt)
+        if writer is None:
+            raise Exception(f"unknown export format {fmt}, use one of {list(tree_export.WRITERS)}")
+        with open(path, 'w', newline='', encoding='utf-8') as fp:
+            count: int = writer(self.iter_subtree(node, batch_size), fp)
+        logger.debug(f"{count} nodes of subtree {node.id} are exported to {path}")
+        return count
+
+    def export_tree_mmap(self, node: CategoryTree, path: str, batch_size: int = None) -> int:
+        """
+        Write the subtree to a binary file which worker processes can open with
+        tree_mmap.MmapTree and share read-only. Returns the number of exported nodes.
+        """
+        count: int = tree_mmap.write_tree(self.iter_subtree(node, batch_size), path, node.tree_id)
+        logger.debug(f"{count} nodes of subtree {node.id} are exported to {path}")
+        return count
+
+    def import_tree_mmap(self, path: str, tree_id: Union[int, GUID] = None) -> Union[int, GUID]:
+        """Load a tree file written by export_tree_mmap as a new tree with bulk_load_tree."""
+        tree: dict = {}
+        names: dict = {}
+        with tree_mmap.MmapTree(path) as mapped:
+            for node in mapped:
+                names[node.id] = node.name
+                tree.setdefault(node.name, [])
+                if node.parent_id is not None:
+                    tree[names[node.parent_id]].append(node.name)
+        return self.bulk_load_tree(tree, tree_id=tree_id)
+
+    # The queries use only (tree_id, lft/rgt/parent_id) predicates, so they are served by
+    # the composite indexes of CategoryTree. They don't rely on rgt - lft to count nodes,
+    # which keeps them right for gap-based numbering too.
+
+    @staticmethod
+    def _subtree_query(node: CategoryTree, max_depth: int = None):
+        query = select(CategoryTree).where(
+            CategoryTree.tree_id == node.tree_id,
+            CategoryTree.left.between(node.left, node.right)
+        )
+        if max_depth is not None:
+            query = query.where(CategoryTree.level <= node.level + max_depth)
+        return query.order_by(CategoryTree.left)
+
+    @staticmethod
+    def _subtree_rows_query(node: CategoryTree):
+        return select(
+            CategoryTree.id,
+            CategoryTree.parent_id,
+            CategoryTree.level,
+            CategoryTree.left,
+            CategoryTree.right,
+            Category.name
+        ).join(
+            Category, Category.id == CategoryTree.category_id
+        ).where(
+            CategoryTree.tree_id == node.tree_id,
+            CategoryTree.left.between(node.left, node.right)
+        ).order_by(CategoryTree.left)
+
+    @staticmethod
+    def _ancestors_query(node: CategoryTree):
+        return select(CategoryTree).where(
+            CategoryTree.tree_id == node.tree_id,
+            CategoryTree.left < node.left,
+            CategoryTree.right > node.right
+        ).order_by(CategoryTree.left)
+
+    @staticmethod
+    def _children_query(node: CategoryTree):
+        return select(CategoryTree).where(
+            CategoryTree.tree_id == node.tree_id,
+            CategoryTree.parent_id == node.id
+        ).order_by(CategoryTree.left)
+
+    @staticmethod
+    def _count_descendants_query(node: CategoryTree):
+        return select(func.count()).select_from(CategoryTree).where(
+            CategoryTree.tree_id == node.tree_id,
+            CategoryTree.left > node.left,
+            CategoryTree.left < node.right
+        )
+
+    def get_tree_structure(self, tree_id: Union[int, GUID]) -> TreeStructure:
+        """
+        Return ids, lft, rgt, level and parents of a whole tree for in-memory
+        ancestors/descendants/children lookups, from the cache when it's enabled.
+        """
+        if self.tree_cache is None:
+            return self._load_tree_structure(tree_id)
+        return self.tree_cache.get(tree_id)
+
+    def _load_tree_structure(self, tree_id: Union[int, GUID]) -> TreeStructure:
+        # a connection of its own, the cache is shared by all sessions and must see committed rows only
+        table = CategoryTree.__table__
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(table.c.id, table.c.parent_id, table.c.lft, table.c.rgt, table.c.level)
+                .where(table.c.tree_id == tree_id)
+                .order_by(table.c.lft)
+            )
+            return TreeStructure(tree_id, rows)
+
+    def load_snapshot(self, tree_ids: list = None, batch_size: int = None) -> TreeSnapshot:
+        """Load nested sets of all trees (or only of tree_ids) into a compact TreeSnapshot for analytics."""
+        with self.engine.connect() as connection:
+            return TreeSnapshot.load(connection, CategoryTree.__table__, tree_ids,
+                                     batch_size=batch_size or self.bulk_batch_size)
+
+    def tree_cache_stats(self) -> dict:
+        """Return hit/miss/eviction counters of the tree cache (empty when it's off)."""
+        if self.tree_cache is None:
+            return {}
+        return self.tree_cache.stats()
+
     def get_max_tree_id(self):
         """
-        Return the maximum of the currently stored tree IDs.
-        This is not a thread-safe value, but we use it just for a label.
+        Return an id for a new tree.
+        Integer ids come from TreeIdAllocator (a sequence or a locked counter),
+        so concurrent writers don't get the same value.
         """
-        session: Session = self.sessions[0]
-        if session is None:
-            raise Exception("session is not created")
+        session: Session = self._get_session()
 
         if isinstance(CategoryTree.tree_id.type, GUID):
-            tree_id = GUID.build(time.monotonic())
-            return tree_id
+            return new_guid()
         else:
             try:
-                max_id: int = session.query(func.max(CategoryTree.tree_id)).one()
-                if max_id[0] is None:
-                    return 0
-                else:
-                    tree_id = max_id[0] + 1
-                    return tree_id
+                return self.tree_id_allocator.allocate(session.connection())
             except SQLAlchemyError as err:
                 logger.exception(err)
-            return 0
+                raise
 
     def switch_mptt(self, flag: bool, tree_id: Union[int, GUID]):
-        tree_manager.register_events(remove=flag)  # enabled MPTT events back
+        # MPTT events are registered globally, switching them affects sessions of all threads
+        guid_tree_manager.register_events(remove=flag)  # enabled MPTT events back
         if flag:
             logger.debug("MPTT is disabled")
         else:
-            session: Session = self.sessions[0]
-            if session is None:
-                raise Exception("session is not created")
-            CategoryTree.rebuild(session, tree_id)  # rebuild lft, rgt value automatically
+            self.rebuild_tree(tree_id)  # rebuild lft, rgt value automatically
             logger.debug("MPTT is enabled")
 
+    def rebuild_tree(self, tree_id: Union[int, GUID], use_cte: bool = None):
+        """Rebuild every root of the tree with rebuild_subtree."""
+        session: Session = self._get_session()
+        roots = session.query(CategoryTree.id).filter(CategoryTree.tree_id == tree_id,
+                                                      CategoryTree.parent_id.is_(None)).all()
+        for (root_id,) in roots:
+            self.rebuild_subtree(root_id, use_cte=use_cte)
+        if roots:
+            # roots inserted while the MPTT events were off aren't registered yet
+            ensure_root(CategoryTreeRoot.__table__, session.connection(), tree_id)
+
+    def rebuild_all(self, tree_ids: list = None, workers: int = None, processes: bool = False,
+                    use_cte: bool = None, progress: Callable = None) -> dict:
+        """
+        Rebuild many trees in parallel, every tree in its own transaction.
+        Threads share the engine (one pooled connection each), processes (processes=True)
+        open their own engine. SQLite has a single writer, so it's always one worker.
+        progress(done, total, tree_id, seconds) is called as trees finish, seconds is None if it failed.
+        Returns {'trees', 'seconds', 'timings': {tree_id: seconds}, 'failed': {tree_id: error}}.
+        """
+        if tree_ids is None:
+            tree_ids = self._get_session().execute(
+                select(CategoryTree.tree_id).distinct().order_by(CategoryTree.tree_id)
+            ).scalars().all()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if self.engine.dialect.name == 'sqlite':
+            workers = 1
+        # pending changes of this session must be visible to the workers
+        self._get_session().commit()
+
+        start = time.perf_counter()
+        timings: dict = {}
+        failed: dict = {}
+        if processes:
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_open_worker_controller,
+                                       initargs=(self.settings_name,))
+            rebuild = _rebuild_tree_in_worker
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rebuild')
+            rebuild = self._rebuild_tree_in_transaction
+        with pool:
+            futures = {pool.submit(rebuild, tree_id, use_cte): tree_id for tree_id in tree_ids}
+            for future in as_completed(futures):
+                tree_id = futures[future]
+                try:
+                    seconds = timings[tree_id] = future.result()
+                except Exception as err:
+                    failed[tree_id] = repr(err)
+                    logger.debug(f"Rebuild of tree {tree_id} failed: {err!r}")
+                    seconds = None
+                else:
+                    logger.debug(f"Tree {tree_id} is rebuilt in {seconds:.3f}s "
+                                 f"({len(timings) + len(failed)}/{len(futures)})")
+                if progress is not None:
+                    progress(len(timings) + len(failed), len(futures), tree_id, seconds)
+
+        if processes and self.tree_cache is not None:
+            for tree_id in tree_ids:
+                self.tree_cache.invalidate(tree_id)
+        self._get_session().expire_all()
+        return {'trees': len(timings), 'seconds': time.perf_counter() - start, 'timings': timings, 'failed': failed}
+
+    def _rebuild_tree_in_transaction(self, tree_id: Union[int, GUID], use_cte: bool = None) -> float:
+        start = time.perf_counter()
+        with self.session():
+            self.rebuild_tree(tree_id, use_cte=use_cte)
+        return time.perf_counter() - start
+
+    def rebuild_subtree(self, node: Union[CategoryTree, int, GUID], use_cte: bool = None):
+        """
+        Recompute lft, rgt and level of one subtree and shift the rest of its tree once.
+        use_cte=None picks the single-statement recursive CTE on PostgreSQL.
+        """
+        session: Session = self._get_session()
+        node_id = node.id if isinstance(node, CategoryTree) else node
+        session.flush()
+        connection = session.connection()
+        if use_cte is None:
+            use_cte = connection.dialect.name == 'postgresql'
+        table = CategoryTree.__table__
+        if self.lock_trees:
+            lock_node_trees(table, connection, table.c.id, [node_id])
+        tree_id = session.query(CategoryTree.tree_id).filter(CategoryTree.id == node_id).scalar()
+        guid_tree_manager.invalidate_trees(session, [tree_id])
+        rebuild_subtree(table, connection, table.c.id, node_id,
+                        default_level=CategoryTree.get_default_level(), use_cte=use_cte)
+        # positions of loaded nodes are stale now
+        session.expire_all()
+        logger.debug(f"Subtree {node_id} is rebuilt")
+
+    def verify_tree(self, tree_id: Union[int, GUID]) -> dict:
+        """
+        Check lft, rgt and level of the tree against parent_id in one query.
+        Returns {'problems': [(node_id, parent_id, problem)], 'damaged': [subtree root ids],
+        'orphans': [node ids], 'cycles': [node ids]}; rebuilding the damaged subtrees fixes everything
+        but orphans and parent_id cycles.
+        Gaps are reported only with the dense numbering (MPTT_SPARSE_STEP=0).
+        """
+        session: Session = self._get_session()
+        session.flush()
+        connection = session.connection()
+        table = CategoryTree.__table__
+        problems = verify_tree(table, connection, table.c.id, tree_id,
+                               default_level=CategoryTree.get_default_level(),
+                               dense=not self.sparse_step)
+        damaged, orphans, cycles = damaged_subtrees(table, connection, table.c.id, tree_id, problems)
+        if problems:
+            logger.debug(f"Tree {tree_id} has {len(problems)} inconsistent nodes in {len(damaged)} subtrees")
+        return {'problems': problems, 'damaged': damaged, 'orphans': orphans, 'cycles': cycles}
+
+    def repair_tree(self, tree_id: Union[int, GUID], use_cte: bool = None) -> list:
+        """
+        Rebuild only the damaged subtrees found by verify_tree, the whole tree if that isn't enough.
+        Returns the ids of the rebuilt subtrees. Nothing is committed.
+        """
+        report: dict = self.verify_tree(tree_id)
+        if report['orphans']:
+            raise Exception(f"nodes {report['orphans']} of tree {tree_id} have no parent in the tree, "
+                            f"fix their parent_id first")
+        if report['cycles']:
+            raise Exception(f"nodes {report['cycles']} of tree {tree_id} are their own ancestors, "
+                            f"fix their parent_id first")
+        rebuilt: list = []
+        for node_id in report['damaged']:
+            self.rebuild_subtree(node_id, use_cte=use_cte)
+            rebuilt.append(node_id)
+        if rebuilt and self.verify_tree(tree_id)['problems']:
+            # a subtree rebuild keeps the numbering around it, which was broken too
+            logger.debug(f"Tree {tree_id} is still inconsistent, rebuilding it completely")
+            self.rebuild_tree(tree_id, use_cte=use_cte)
+            rebuilt = [node_id for (node_id,) in self._get_session().query(CategoryTree.id).filter(
+                CategoryTree.tree_id == tree_id, CategoryTree.parent_id.is_(None))]
+        return rebuilt
+
     def _commit_node(self, node: CategoryTree, session: Session):
         if node is None:
             return
         session.add(node)
         try:
-            session.commit()
+            self._commit(session)
             logger.debug(
                 f'Item {node} has been stored in database successfully')
         except SQLAlchemyError as err:
@@ -168,20 +754,21 @@ class DatabaseController:
             raise
 
     def add_category_node(self, category: Category, tree_id: Union[int, GUID],
-                          parent: CategoryTree = None) -> CategoryTree:
-        if category is None:
-            raise Exception("can't add category, due to it's None ")
+                          parent: CategoryTree = None, category_id: Union[int, GUID] = None) -> CategoryTree:
+        """category may be None when category_id is given, e.g. an id returned by upsert_categories."""
+        if category_id is None:
+            if category is None:
+                raise Exception("can't add category, due to it's None ")
+            category_id = category.id
 
-        session: Session = self.sessions[0]
-        if session is None:
-            raise Exception("session is not created")
+        session: Session = self._get_session()
 
         if parent is None:
             parent_id = None
         else:
             parent_id = parent.id
 
-        node = CategoryTree(category_id=category.id, parent_id=parent_id, left=0, right=0, tree_id=tree_id)
+        node = CategoryTree(category_id=category_id, parent_id=parent_id, left=0, right=0, tree_id=tree_id)
 
         self._commit_node(node, session)
         return node
@@ -192,17 +779,175 @@ class DatabaseController:
         if category is None:
             raise Exception("can't add category, due to it's None")
 
-        session: Session = self.sessions[0]
-        if session is None:
-            raise Exception("session is not created")
+        session: Session = self._get_session()
 
         node.category = category
         node.parent = parent
 
-        if parent is None:
-            node.tree_id = self.get_max_tree_id()
-        else:
+        # a node which becomes a root gets its new tree_id from the MPTT hook
+        if parent is not None:
             node.tree_id = parent.tree_id
 
         self._commit_node(node, session)
         return node
+
+    def bulk_load_tree(self, tree: dict, tree_id: Union[int, GUID] = None, batch_size: int = None) -> Union[int, GUID]:
+        """
+        Load a whole tree at once, bypassing the MPTT events.
+
+        `tree` is either nested dicts ({"root": {"child": {...}, "leaf": None}})
+        or an adjacency mapping ({"root": ["child", "leaf"], "child": [...]}),
+        keyed by category names. Ids, lft, rgt and level are computed by a single
+        in-memory DFS and the rows are written with COPY (PostgreSQL) or batched
+        executemany INSERTs, so no rebuild is needed afterwards.
+        """
+        session: Session = self._get_session()
+        if not tree:
+            raise Exception("tree mustn't be empty")
+
+        names, parents, lefts, rights, levels = self._layout_tree(tree, CategoryTree.get_default_level())
+        category_ids = self.resolve_category_ids(names)
+        missing = [name for name in set(names) if name not in category_ids]
+        if missing:
+            raise Exception(f"unknown categories: {missing[:10]}")
+
+        if tree_id is None:
+            tree_id = self.get_max_tree_id()
+
+        ids = self._allocate_node_ids(session, len(names))
+        now = datetime.datetime.utcnow()
+        rows = [
+            {
+                'id': ids[i],
+                'category_id': category_ids[names[i]],
+                'parent_id': None if parents[i] < 0 else ids[parents[i]],
+                'tree_id': tree_id,
+                'lft': lefts[i],
+                'rgt': rights[i],
+                'level': levels[i],
+                'created_at': now,
+                'updated_at': now,
+            }
+            for i in range(len(names))
+        ]
+
+        try:
+            self._write_rows(session, CategoryTree.__table__, rows, batch_size or self.bulk_batch_size)
+            ensure_root(CategoryTreeRoot.__table__, session.connection(), tree_id)
+            guid_tree_manager.invalidate_trees(session, [tree_id])
+            self._commit(session)
+            logger.debug(f'Tree {tree_id} with {len(rows)} nodes has been loaded')
+        except SQLAlchemyError as err:
+            logger.debug(f'Failed to load tree {tree_id}. Error: {err=}, {type(err)=}')
+            session.rollback()
+            raise
+
+        return tree_id
+
+    @staticmethod
+    def _layout_tree(tree: dict, root_level: int):
+        """
+        Walk the tree description depth-first (iteratively, trees may be deep)
+        and return parallel lists of names, parent indexes, lft, rgt and level.
+        """
+        if all(value is None or isinstance(value, dict) for value in tree.values()):
+            if len(tree) != 1:
+                raise Exception("nested tree must have exactly one root")
+            root = next(iter(tree.items()))
+
+            def name_of(item):
+                return item[0]
+
+            def children_of(item):
+                return (item[1] or {}).items()
+        else:
+            children = {child for values in tree.values() for child in values}
+            roots = [name for name in tree if name not in children]
+            if len(roots) != 1:
+                raise Exception(f"adjacency tree must have exactly one root, got {roots[:10]}")
+            root = roots[0]
+            visited = set()
+
+            def name_of(item):
+                if item in visited:
+                    raise Exception(f"node {item} occurs more than once in adjacency tree")
+                visited.add(item)
+                return item
+
+            def children_of(item):
+                return tree.get(item) or ()
+
+        names, parents, lefts, rights, levels = [name_of(root)], [-1], [1], [0], [root_level]
+        position = 2
+        stack = [(0, iter(children_of(root)))]
+        while stack:
+            index, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                rights[index] = position
+                position += 1
+                stack.pop()
+                continue
+            names.append(name_of(child))
+            parents.append(index)
+            lefts.append(position)
+            rights.append(0)
+            levels.append(levels[index] + 1)
+            position += 1
+            stack.append((len(names) - 1, iter(children_of(child))))
+
+        return names, parents, lefts, rights, levels
+
+    @staticmethod
+    def _allocate_node_ids(session: Session, count: int) -> list:
+        """
+        Reserve `count` primary keys for CategoryTree rows inserted outside the ORM.
+        """
+        if isinstance(CategoryTree.id.type, GUID):
+            return [new_guid() for _ in range(count)]
+
+        table = CategoryTree.__table__
+        if session.get_bind().dialect.name == 'postgresql':
+            # take the values from the identity sequence, so later ORM inserts don't collide
+            return session.execute(
+                text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+                {'table': table.fullname, 'count': count}
+            ).scalars().all()
+
+        max_id = session.query(func.max(CategoryTree.id)).scalar() or 0
+        return list(range(max_id + 1, max_id + 1 + count))
+
+    @staticmethod
+    def _write_rows(session: Session, table, rows: list, batch_size: int):
+        connection = session.connection()
+        if connection.dialect.name == 'postgresql':
+            columns = list(rows[0].keys())
+            statement = f"COPY {connection.dialect.identifier_preparer.format_table(table)} " \
+                        f"({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+            cursor = connection.connection.cursor()
+            try:
+                for start in range(0, len(rows), batch_size):
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    for row in rows[start:start + batch_size]:
+                        writer.writerow(['' if row[c] is None else row[c] for c in columns])
+                    buffer.seek(0)
+                    cursor.copy_expert(statement, buffer)
+            finally:
+                cursor.close()
+        else:
+            for start in range(0, len(rows), batch_size):
+                connection.execute(table.insert(), rows[start:start + batch_size])
+
+
+# controller of a rebuild_all worker process
+_worker_controller = None
+
+
+def _open_worker_controller(settings_name: str):
+    global _worker_controller
+    _worker_controller = DatabaseController.open_worker(settings_name)
+
+
+def _rebuild_tree_in_worker(tree_id: Union[int, GUID], use_cte: bool = None) -> float:
+    return _worker_controller._rebuild_tree_in_transaction(tree_id, use_cte)
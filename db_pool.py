@@ -0,0 +1,88 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PoolMetrics:
+    """Counters collected by MeteredQueuePool. All times are in seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects: int = 0
+        self.checkouts: int = 0
+        self.checkins: int = 0
+        self.wait_time: float = 0.0
+        self.max_wait_time: float = 0.0
+        self.max_overflow: int = 0
+
+    def record_checkout(self, wait_time: float, overflow: int):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.max_overflow = max(self.max_overflow, overflow)
+
+    def record_checkin(self):
+        with self._lock:
+            self.checkins += 1
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'wait_time': self.wait_time,
+                'avg_wait_time': self.wait_time / self.checkouts if self.checkouts else 0.0,
+                'max_wait_time': self.max_wait_time,
+                'max_overflow': self.max_overflow,
+            }
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool which measures how long every checkout waits for a connection."""
+
+    def __init__(self, creator, **kw):
+        super().__init__(creator, **kw)
+        self.metrics = PoolMetrics()
+        if '_dispatch' not in kw:
+            # recreate() passes the listeners of the old pool, they record into the same metrics
+            event.listen(self, 'connect', self._on_connect)
+            event.listen(self, 'checkin', self._on_checkin)
+
+    def recreate(self):
+        # engine.dispose() recreates the pool, the counters must survive it
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        connection = super()._do_get()
+        self.metrics.record_checkout(time.perf_counter() - start, self.overflow())
+        return connection
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.metrics.record_connect()
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        self.metrics.record_checkin()
+
+    def metrics_status(self) -> dict:
+        status = self.metrics.as_dict()
+        status.update({
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+        })
+        return status
@@ -22,10 +22,44 @@ CLEAR_DB_BEFORE_START = bool(strtobool(os.getenv("CLEAR_DB_BEFORE_START", "False
 TABLE_ARGS = None
 dialect = None
 PK_TYPE = GUID
+# GUIDs as native uuid on PostgreSQL and 16-byte BLOB on SQLite instead of strings
+GUID_NATIVE: bool = bool(strtobool(os.getenv("GUID_NATIVE", "False")))
+GUID.native = GUID_NATIVE
+# 4 - random keys, 7 - time-ordered keys (better index locality)
+GUID_VERSION: int = int(os.getenv("GUID_VERSION", 4))
+if GUID_VERSION not in (4, 7):
+    raise Exception(f"GUID_VERSION must be 4 or 7, got {GUID_VERSION}")
+GUID.version = GUID_VERSION
 SEQ_CACHE_SIZE: int = 1
+# gap between sibling positions in nested sets, 0 keeps the dense numbering
+MPTT_SPARSE_STEP: int = int(os.getenv("MPTT_SPARSE_STEP", 0))
+# new children get their lft/rgt once per flush instead of once per insert
+MPTT_DEFERRED: bool = bool(strtobool(os.getenv("MPTT_DEFERRED", "False")))
+# lock a tree (pg_advisory_xact_lock, BEGIN IMMEDIATE on SQLite) before changing its nested sets
+MPTT_TREE_LOCKS: bool = bool(strtobool(os.getenv("MPTT_TREE_LOCKS", "False")))
+# nodes kept by the in-process tree structure cache, 0 switches it off
+TREE_CACHE_MAX_NODES: int = int(os.getenv("TREE_CACHE_MAX_NODES", 0))
+# count statements, renumbered rows and lock waits of every MPTT operation, see DatabaseController.stats
+SQL_STATS: bool = bool(strtobool(os.getenv("SQL_STATS", "False")))
+# integer tree ids reserved from the PostgreSQL sequence at once
+TREE_ID_BLOCK_SIZE: int = int(os.getenv("TREE_ID_BLOCK_SIZE", 20))
+# number of rows sent per round trip by bulk loaders
+BULK_BATCH_SIZE: int = int(os.getenv("BULK_BATCH_SIZE", 10000))
+# upsert_categories copies at least this many names into a staging table (PostgreSQL)
+UPSERT_COPY_THRESHOLD: int = int(os.getenv("UPSERT_COPY_THRESHOLD", 50000))
+# number of values in one IN (...) list, old SQLite builds allow 999 bound parameters only
+LOOKUP_CHUNK_SIZE: int = int(os.getenv("LOOKUP_CHUNK_SIZE", 900))
 
 TABLE_PREFIX = os.getenv("TABLE_PREFIX", None)
 
+# connection pool (PostgreSQL only), POSTGRES_POOL_SIZE=0 switches pooling off
+POOL_SIZE: int = int(os.getenv("POSTGRES_POOL_SIZE", 5))
+POOL_MAX_OVERFLOW: int = int(os.getenv("POSTGRES_POOL_MAX_OVERFLOW", 10))
+POOL_TIMEOUT: float = float(os.getenv("POSTGRES_POOL_TIMEOUT", 30))
+# seconds, -1 means connections are never recycled
+POOL_RECYCLE: int = int(os.getenv("POSTGRES_POOL_RECYCLE", 1800))
+POOL_PRE_PING: bool = bool(strtobool(os.getenv("POSTGRES_POOL_PRE_PING", "True")))
+
 db_file = os.getenv("SQLITE_FILE")
 if db_file:
     from sqlalchemy.dialects import sqlite
@@ -38,6 +72,8 @@ if db_file:
         'drivername': 'sqlite',
         'database': db_file
     }
+    # every SQLite connection is a file open, there is nothing to pool
+    POOL_SIZE = 0
     DB_SCHEMA = None
 else:
     from sqlalchemy.dialects import postgresql
@@ -1,10 +1,64 @@
 
 from typing import Optional, Any
-from sqlalchemy.types import TypeDecorator, CHAR
+from sqlalchemy.types import TypeDecorator, BLOB, CHAR
 from sqlalchemy.dialects.postgresql import UUID
+import os
+import threading
+import time
 import uuid
 import hashlib
 
+_uuid7_lock = threading.Lock()
+_uuid7_last_ms: int = 0
+_uuid7_counter: int = 0
+
+
+def uuid7() -> uuid.UUID:
+    """
+    Time-ordered UUID (RFC 9562 version 7): 48 bits of Unix time in ms, a 12-bit
+    counter which keeps ids of the same millisecond increasing, 62 random bits.
+    New keys land at the right edge of the B-tree index instead of random pages.
+    """
+    global _uuid7_last_ms, _uuid7_counter
+    with _uuid7_lock:
+        ms = time.time_ns() // 1_000_000
+        if ms <= _uuid7_last_ms:
+            ms = _uuid7_last_ms
+            _uuid7_counter += 1
+            if _uuid7_counter > 0xFFF:
+                # the counter is exhausted, borrow the next millisecond
+                ms += 1
+                _uuid7_counter = 0
+        else:
+            _uuid7_counter = 0
+        _uuid7_last_ms = ms
+        counter = _uuid7_counter
+    random_bits = int.from_bytes(os.urandom(8), 'big') & 0x3FFF_FFFF_FFFF_FFFF
+    return uuid.UUID(
+        int=(ms & 0xFFFF_FFFF_FFFF) << 80 | 0x7 << 76 | counter << 64 | 0b10 << 62 | random_bits
+    )
+
+
+def new_guid() -> uuid.UUID:
+    """Key for a new row: uuid4, or uuid7 when GUID.version is 7 (GUID_VERSION in db_settings.py)."""
+    if GUID.version == 7:
+        return uuid7()
+    return uuid.uuid4()
+
+
+def _to_bytes(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    if not isinstance(value, uuid.UUID):
+        value = uuid.UUID(value)
+    return value.bytes
+
+
+def _from_bytes(value):
+    if value is None:
+        return value
+    return uuid.UUID(bytes=value)
+
 
 class GUID(TypeDecorator):
     """Platform-independent GUID type.
@@ -12,17 +66,42 @@ class GUID(TypeDecorator):
     Uses PostgreSQL's UUID type, otherwise uses
     CHAR(32), storing as stringified hex values.
 
+    In native mode (GUID.native = True, see GUID_NATIVE in db_settings.py)
+    uuid.UUID values are passed to psycopg2/asyncpg as they are, without
+    any per-row conversion, and other dialects store the 16 bytes as BLOB.
+    The storage of existing SQLite databases changes, so it's a per-database choice.
+
     https://docs.sqlalchemy.org/en/14/core/custom_types.html#backend-agnostic-guid-type
     """
     impl = CHAR
     cache_ok = True
+    native: bool = False
+    # version of the generated keys, see new_guid
+    version: int = 4
 
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
-            return dialect.type_descriptor(UUID())
+            return dialect.type_descriptor(UUID(as_uuid=self.native))
+        elif self.native:
+            return dialect.type_descriptor(BLOB())
         else:
             return dialect.type_descriptor(CHAR(32))
 
+    def bind_processor(self, dialect):
+        if not self.native:
+            return super().bind_processor(dialect)
+        if dialect.name == 'postgresql':
+            # None, the drivers adapt uuid.UUID themselves
+            return self.load_dialect_impl(dialect).bind_processor(dialect)
+        return _to_bytes
+
+    def result_processor(self, dialect, coltype):
+        if not self.native:
+            return super().result_processor(dialect, coltype)
+        if dialect.name == 'postgresql':
+            return self.load_dialect_impl(dialect).result_processor(dialect, coltype)
+        return _from_bytes
+
     def process_bind_param(self, value, dialect):
         if value is None:
             return value
@@ -0,0 +1,257 @@
+"""
+Streaming import of many independent trees.
+
+    python ingest.py catalogue.csv --workers 8
+    python ingest.py catalogue.jsonl --processes --queue-size 16
+
+Every row is either a path (`path`: "root/child/leaf", a list in JSONL) or an
+edge (`parent`, `child`). Edges come in topological order: a tree starts with
+its root row (empty parent) and a node is added before the rows of its children.
+The input is read as a stream and rows are grouped into trees by their root;
+the rows of one tree must be contiguous (paths may come in any order with
+--unsorted, then all trees are kept in memory until the end). Complete trees are loaded by a pool of workers,
+each with its own connection, with upsert_categories and bulk_load_tree. At most
+workers + queue size trees wait in memory, the reader blocks when they are all taken.
+"""
+import argparse
+import csv
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+import settings
+from db_controller import DatabaseController
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def read_rows(path: str, fmt: str = None) -> Iterator[dict]:
+    """Yield the rows of a CSV file (with a header) or of a JSONL file one by one."""
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    with open(path, encoding='utf-8', newline='') as fp:
+        if fmt == 'csv':
+            yield from csv.DictReader(fp)
+        elif fmt in ('jsonl', 'json', 'ndjson'):
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise Exception(f"unknown input format {fmt}, use csv or jsonl")
+
+
+def iter_trees(rows: Iterable[dict], separator: str = '/', grouped: bool = True) -> Iterator[tuple]:
+    """
+    Group path or edge rows into trees for DatabaseController.bulk_load_tree.
+    Yields (root name, tree, category names, number of nodes).
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return
+    rows = _chain(first, rows)
+    if 'path' in first:
+        yield from _path_trees(rows, separator, grouped)
+    elif 'child' in first:
+        if not grouped:
+            raise Exception("parent/child rows must be grouped by tree")
+        yield from _edge_trees(rows)
+    else:
+        raise Exception(f"rows must have a path or parent and child fields, got {sorted(first)}")
+
+
+def _chain(first: dict, rows: Iterator[dict]) -> Iterator[dict]:
+    yield first
+    yield from rows
+
+
+def _path_trees(rows: Iterable[dict], separator: str, grouped: bool) -> Iterator[tuple]:
+    # root name -> [nested dicts, names, nodes]
+    trees: dict = {}
+    loaded = set()
+    for row in rows:
+        path = row['path']
+        parts = path if isinstance(path, list) else path.split(separator)
+        parts = [str(part).strip() for part in parts if str(part).strip()]
+        if not parts:
+            continue
+        root = parts[0]
+        if root not in trees:
+            if grouped:
+                if root in loaded:
+                    raise Exception(f"rows of tree {root} aren't contiguous, use --unsorted")
+                for done in list(trees):
+                    loaded.add(done)
+                    yield (done, *trees.pop(done))
+            trees[root] = [{root: {}}, {root}, 1]
+        tree = trees[root]
+        node = tree[0][root]
+        for name in parts[1:]:
+            child = node.get(name)
+            if child is None:
+                child = node[name] = {}
+                tree[1].add(name)
+                tree[2] += 1
+            node = child
+    for root, tree in trees.items():
+        yield (root, *tree)
+
+
+def _edge_trees(rows: Iterable[dict]) -> Iterator[tuple]:
+    # an unknown parent isn't taken as the root of a new tree: a child listed
+    # before its parent would silently become a tree of its own
+    root = None
+    # child -> parent of the current tree
+    members: dict = {}
+    children: dict = {}
+
+    def tree():
+        return root, children or {root: []}, list(members), len(members)
+
+    for row in rows:
+        parent = (row.get('parent') or '').strip() or None
+        child = (row.get('child') or '').strip()
+        if not child:
+            continue
+        if parent is None:
+            if root is not None:
+                yield tree()
+            root = child
+            members = {root: None}
+            children = {}
+            continue
+        if parent not in members:
+            raise Exception(f"parent {parent} of {child} isn't in tree {root} yet, a tree must start with "
+                            f"its root row (empty parent) and parents must come before their children")
+        if child in members:
+            if members[child] != parent:
+                raise Exception(f"{child} has two parents in tree {root}: {members[child]} and {parent}")
+            continue
+        members[child] = parent
+        children.setdefault(parent, []).append(child)
+    if root is not None:
+        yield tree()
+
+
+def _load_tree(dbc: DatabaseController, tree: dict, names: list) -> tuple:
+    start = time.perf_counter()
+    with dbc.session():
+        # the same order in every worker, so concurrent upserts of shared names can't deadlock
+        dbc.upsert_categories(sorted(names))
+        tree_id = dbc.bulk_load_tree(tree)
+    return tree_id, time.perf_counter() - start
+
+
+# controller of an ingest worker process
+_worker_controller = None
+
+
+def _open_worker_controller(settings_name: str):
+    global _worker_controller
+    _worker_controller = DatabaseController.open_worker(settings_name)
+
+
+def _load_tree_in_worker(tree: dict, names: list) -> tuple:
+    return _load_tree(_worker_controller, tree, names)
+
+
+def ingest(dbc: DatabaseController, trees: Iterable[tuple], workers: int = None, processes: bool = False,
+           queue_size: int = None, progress: Callable = None) -> dict:
+    """
+    Load the trees of iter_trees on a pool of threads (or processes) and return a summary:
+    {'trees', 'nodes', 'seconds', 'trees_per_second', 'nodes_per_second',
+    'tree_ids': {root: tree_id}, 'failed': {root: error}}.
+    progress(loaded, failed, root, seconds) is called as trees finish.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if dbc.engine.dialect.name == 'sqlite':
+        # one writer at a time anyway
+        workers = 1
+    if queue_size is None:
+        queue_size = 2 * workers
+
+    summary: dict = {'trees': 0, 'nodes': 0, 'tree_ids': {}, 'failed': {}}
+    summary_lock = threading.Lock()
+    # free places for trees which are submitted but not loaded yet
+    slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def done(root, nodes, future):
+        try:
+            tree_id, seconds = future.result()
+        except Exception as err:
+            logger.debug(f"Tree {root} failed: {err!r}")
+            with summary_lock:
+                summary['failed'][root] = repr(err)
+            seconds = None
+        else:
+            logger.debug(f"Tree {root} with {nodes} nodes is loaded as {tree_id} in {seconds:.3f}s")
+            with summary_lock:
+                summary['trees'] += 1
+                summary['nodes'] += nodes
+                summary['tree_ids'][root] = tree_id
+        finally:
+            slots.release()
+        if progress is not None:
+            progress(summary['trees'], len(summary['failed']), root, seconds)
+
+    if processes:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_open_worker_controller,
+                                   initargs=(dbc.settings_name,))
+        load = _load_tree_in_worker
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+        load = functools.partial(_load_tree, dbc)
+
+    start = time.perf_counter()
+    with pool:
+        for root, tree, names, nodes in trees:
+            slots.acquire()
+            pool.submit(load, tree, names).add_done_callback(functools.partial(done, root, nodes))
+    seconds = time.perf_counter() - start
+    summary['seconds'] = seconds
+    summary['trees_per_second'] = summary['trees'] / seconds if seconds else None
+    summary['nodes_per_second'] = summary['nodes'] / seconds if seconds else None
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import trees from a CSV or JSONL file")
+    parser.add_argument('input', help="file with path or parent,child rows")
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help="by default taken from the file extension")
+    parser.add_argument('--separator', default='/', help="separator of path rows")
+    parser.add_argument('--unsorted', action='store_true', help="path rows of a tree aren't contiguous")
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--processes', action='store_true', help="use worker processes instead of threads")
+    parser.add_argument('--queue-size', type=int, help="complete trees waiting for a worker")
+    parser.add_argument('--tree-ids', action='store_true', help="list the tree id of every root in the summary")
+    args = parser.parse_args()
+
+    def progress(loaded, failed, root, seconds):
+        if (loaded + failed) % 1000 == 0:
+            logger.info(f"{loaded} trees are loaded, {failed} failed")
+
+    dbc = DatabaseController(settings)
+    dbc.open_db()
+    try:
+        rows = read_rows(args.input, args.format)
+        summary = ingest(dbc, iter_trees(rows, args.separator, grouped=not args.unsorted),
+                         workers=args.workers, processes=args.processes, queue_size=args.queue_size,
+                         progress=progress)
+    finally:
+        dbc.close_db()
+    if not args.tree_ids:
+        del summary['tree_ids']
+    json.dump(summary, sys.stdout, indent=2, default=str)
+    print()
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import logging
+
+logger = logging.getLogger(__name__)
+
+# operation of the MPTT hook running in this thread / task
+_current = contextvars.ContextVar('mptt_operation', default=None)
+
+
+class Operation:
+    """Statements issued by one MPTT hook call. Times are in seconds."""
+    __slots__ = ('kind', 'tree_id', 'statements', 'rows', 'sql_time', 'lock_wait', 'time')
+
+    def __init__(self, kind: str, tree_id=None):
+        self.kind = kind
+        self.tree_id = tree_id
+        self.statements: int = 0
+        # rows changed by UPDATEs, i.e. the renumbered nodes
+        self.rows: int = 0
+        self.sql_time: float = 0.0
+        self.lock_wait: float = 0.0
+        self.time: float = 0.0
+
+
+def record_lock_wait(seconds: float):
+    """Called by lock_trees, the time goes to the running operation."""
+    operation = _current.get()
+    if operation is not None:
+        operation.lock_wait += seconds
+
+
+class SqlStats:
+    """
+    Statement counters of an engine and of the MPTT operations (insert, update, delete,
+    flush of deferred inserts) run by GuidTreesManager. The `max_trees` trees with the
+    most renumbered rows are kept to find trees with expensive shifts.
+    """
+
+    def __init__(self, max_trees: int = 100):
+        self.max_trees = max_trees
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.statements: int = 0
+            self.sql_time: float = 0.0
+            self.lock_wait: float = 0.0
+            self.operations: dict = {}
+            self.trees: dict = {}
+
+    def attach(self, engine: Engine):
+        if not event.contains(engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def detach(self, engine: Engine):
+        if event.contains(engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.remove(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.remove(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # on the execution context, a failed statement leaves nothing behind on the connection
+        if context is not None:
+            context._sql_stats_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, '_sql_stats_start', None)
+        elapsed = 0.0 if start is None else time.perf_counter() - start
+        # BEGIN IMMEDIATE waits for the SQLite write lock
+        waited = elapsed if statement.startswith('BEGIN IMMEDIATE') else 0.0
+        with self._lock:
+            self.statements += 1
+            self.sql_time += elapsed
+            self.lock_wait += waited
+        operation = _current.get()
+        if operation is not None:
+            operation.statements += 1
+            operation.sql_time += elapsed
+            if statement.lstrip()[:6].upper() == 'UPDATE' and cursor.rowcount > 0:
+                operation.rows += cursor.rowcount
+
+    @contextmanager
+    def operation(self, kind: str, tree_id=None):
+        """Account the statements executed inside the block to an operation of `kind`."""
+        operation = Operation(kind, tree_id)
+        token = _current.set(operation)
+        start = time.perf_counter()
+        try:
+            yield operation
+        finally:
+            operation.time = time.perf_counter() - start
+            _current.reset(token)
+            self.record(operation)
+
+    def record(self, operation: Operation):
+        with self._lock:
+            self.lock_wait += operation.lock_wait
+            totals = self.operations.get(operation.kind)
+            if totals is None:
+                totals = self.operations[operation.kind] = {
+                    'count': 0, 'statements': 0, 'rows': 0, 'time': 0.0, 'sql_time': 0.0,
+                    'lock_wait': 0.0, 'max_time': 0.0, 'max_rows': 0,
+                }
+            totals['count'] += 1
+            totals['statements'] += operation.statements
+            totals['rows'] += operation.rows
+            totals['time'] += operation.time
+            totals['sql_time'] += operation.sql_time
+            totals['lock_wait'] += operation.lock_wait
+            totals['max_time'] = max(totals['max_time'], operation.time)
+            totals['max_rows'] = max(totals['max_rows'], operation.rows)
+            if operation.tree_id is not None:
+                self._record_tree(operation)
+        logger.debug(f"{operation.kind} of tree {operation.tree_id}: {operation.statements} statements, "
+                     f"{operation.rows} rows, {operation.time:.6f}s")
+
+    def _record_tree(self, operation: Operation):
+        tree = self.trees.get(operation.tree_id)
+        if tree is None:
+            if len(self.trees) >= self.max_trees:
+                # forget the cheapest tree to stay bounded
+                cheapest = min(self.trees, key=lambda tree_id: self.trees[tree_id]['rows'])
+                if self.trees[cheapest]['rows'] > operation.rows:
+                    return
+                del self.trees[cheapest]
+            tree = self.trees[operation.tree_id] = {'operations': 0, 'statements': 0, 'rows': 0, 'time': 0.0}
+        tree['operations'] += 1
+        tree['statements'] += operation.statements
+        tree['rows'] += operation.rows
+        tree['time'] += operation.time
+
+    def top_trees(self, count: int = 10) -> list:
+        """[(tree_id, totals)] of the trees with the most renumbered rows."""
+        with self._lock:
+            trees = sorted(self.trees.items(), key=lambda item: item[1]['rows'], reverse=True)
+            return [(tree_id, dict(totals)) for tree_id, totals in trees[:count]]
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'statements': self.statements,
+                'sql_time': self.sql_time,
+                'lock_wait': self.lock_wait,
+                'operations': {kind: dict(totals) for kind, totals in self.operations.items()},
+            }
+
+    def prometheus(self, prefix: str = 'mptt') -> str:
+        """The counters in the Prometheus text exposition format."""
+        stats = self.as_dict()
+        lines = [
+            f"# TYPE {prefix}_sql_statements_total counter",
+            f"{prefix}_sql_statements_total {stats['statements']}",
+            f"# TYPE {prefix}_sql_seconds_total counter",
+            f"{prefix}_sql_seconds_total {stats['sql_time']}",
+            f"# TYPE {prefix}_lock_wait_seconds_total counter",
+            f"{prefix}_lock_wait_seconds_total {stats['lock_wait']}",
+        ]
+        metrics = (
+            ('operations_total', 'count', 'counter'),
+            ('operation_statements_total', 'statements', 'counter'),
+            ('operation_rows_total', 'rows', 'counter'),
+            ('operation_seconds_total', 'time', 'counter'),
+            ('operation_lock_wait_seconds_total', 'lock_wait', 'counter'),
+            ('operation_max_seconds', 'max_time', 'gauge'),
+            ('operation_max_rows', 'max_rows', 'gauge'),
+        )
+        for name, key, metric_type in metrics:
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for kind, totals in sorted(stats['operations'].items()):
+                lines.append(f'{prefix}_{name}{{operation="{kind}"}} {totals[key]}')
+        lines.append(f"# TYPE {prefix}_tree_rows_total counter")
+        for tree_id, totals in self.top_trees(self.max_trees):
+            lines.append(f'{prefix}_tree_rows_total{{tree_id="{tree_id}"}} {totals["rows"]}')
+        return '\n'.join(lines) + '\n'
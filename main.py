@@ -6,6 +6,7 @@ from python_settings import settings #don't delete it!
 import settings as app_settings
 from db_controller import DatabaseController, ON, OFF
 import uuid
+from distutils.util import strtobool
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +20,7 @@ if __name__ == '__main__':
         names: list = []
 
         count: int = int(os.getenv("CATEGORY_COUNT", 5))
+        bulk_load: bool = bool(strtobool(os.getenv("BULK_LOAD", "False")))
 
         for i in range(1, count):
             salt: str = uuid.uuid4().hex
@@ -26,38 +28,36 @@ if __name__ == '__main__':
 
         logger.debug(f"names: {names[0]}..{names[len(names)-1]}")
 
-        dbc.add_categories(names)
+        # duplicates are skipped, {name: id} of all names is returned
+        category_ids: dict = dbc.upsert_categories(names)
 
         salt: str = uuid.uuid4().hex
         cat = dbc.add_category(name=f"root_{salt}", commit=True)
 
-        # If you use tree_id as an integer you should pay your attention that this code is not thread-safe.
-        # It's not a problem, because it's not a real-life application.
-        # But if you want to use this code in a real-life application,
-        # you should use a database with a lock.
-
-        # dbc.lock_db() or realise a something like that
-        # try:
+        # Integer tree ids come from a sequence (PostgreSQL) or a locked counter table (SQLite),
+        # so several writers can create trees at the same time.
         tree_id = dbc.get_max_tree_id()
 
-        # MPTT will refresh every node for any CRUD operation
-        # In order to speed up CRUD operations we can switch refreshing process off and switch it on later
-        # dbc.switch_mptt(flag=OFF, tree_id=tree_id)
-        dbc.switch_mptt(flag=OFF, tree_id=tree_id)
+        if bulk_load:
+            # the whole tree is laid out in memory and written at once, MPTT events aren't fired
+            tree_id = dbc.bulk_load_tree({cat.name: names}, tree_id=tree_id)
+        else:
+            # MPTT will refresh every node for any CRUD operation
+            # In order to speed up CRUD operations we can switch refreshing process off and switch it on later
+            # dbc.switch_mptt(flag=OFF, tree_id=tree_id)
+            dbc.switch_mptt(flag=OFF, tree_id=tree_id)
 
-        root = dbc.add_category_node(category=cat, tree_id=tree_id)
-        tree_id = root.tree_id
-        # finally:
-        #   dbc.unlock() - free
-        node = None
-        try:
-            # apply a bunch of CRUD
-            for i in range(1, count):
-                cat = dbc.get_category(name=names[i - 1])
-                node = dbc.add_category_node(tree_id=tree_id, category=cat, parent=root)
-        finally:
-            # switch MPTT refresh on
-            dbc.switch_mptt(flag=ON, tree_id=tree_id)
+            root = dbc.add_category_node(category=cat, tree_id=tree_id)
+            tree_id = root.tree_id
+            node = None
+            try:
+                # apply a bunch of CRUD, the ids of the upserted categories are enough
+                for i in range(1, count):
+                    node = dbc.add_category_node(category=None, category_id=category_ids[names[i - 1]],
+                                                 tree_id=tree_id, parent=root)
+            finally:
+                # switch MPTT refresh on
+                dbc.switch_mptt(flag=ON, tree_id=tree_id)
 
         logger.info(f"all data has been written successfully")
 
@@ -2,13 +2,12 @@ import logging
 import datetime
 from typing import Union
 from sqlalchemy.orm.decl_api import DeclarativeMeta
-from sqlalchemy import Column, ForeignKey, BigInteger, Identity
+from sqlalchemy import Column, ForeignKey, BigInteger, Identity, Index, Sequence
 import sqlalchemy as sql
-import uuid
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import declared_attr, relationship
 from sqlalchemy_mptt.mixins import BaseNestedSets
-from guid_type import GUID
+from guid_type import GUID, new_guid
 from settings import TABLE_ARGS, DB_SCHEMA, TABLE_PREFIX
 from settings import PK_TYPE, SEQ_CACHE_SIZE
 
@@ -34,7 +33,7 @@ def get_table_key(name: str, prefix: str = TABLE_PREFIX, schema: str = DB_SCHEMA
 
 def pk_column_maker(column_type: Union[GUID, BigInteger] = PK_TYPE) -> Column:
     if column_type is GUID:
-        return Column(column_type, primary_key=True, default=uuid.uuid4)
+        return Column(column_type, primary_key=True, default=new_guid)
     else:
         return Column(column_type, Identity(start=1, cycle=False, cache=SEQ_CACHE_SIZE), primary_key=True)
 
@@ -68,7 +67,20 @@ class Category(DeclarativeBase):
 
 class CategoryTree(DeclarativeBase, BaseNestedSets):
     __tablename__ = "category_tree"
-    __table_args__ = TABLE_ARGS
+
+    @declared_attr
+    def __table_args__(cls):
+        # Subtree, ancestor and children reads are range scans over these indexes,
+        # INCLUDE makes them index-only on PostgreSQL
+        return (
+            Index(f"ix_{cls.__tablename__}_tree_id_lft", 'tree_id', 'lft',
+                  postgresql_include=['rgt', 'level', 'parent_id', 'category_id']),
+            Index(f"ix_{cls.__tablename__}_tree_id_rgt", 'tree_id', 'rgt',
+                  postgresql_include=['lft', 'level']),
+            Index(f"ix_{cls.__tablename__}_tree_id_parent_id", 'tree_id', 'parent_id',
+                  postgresql_include=['lft']),
+            TABLE_ARGS or {},
+        )
 
     id = pk_column_maker()
     category_id = Column(PK_TYPE, ForeignKey(get_table_key("category.id")))
@@ -88,3 +100,33 @@ class CategoryTree(DeclarativeBase, BaseNestedSets):
 
     def __repr__(self):
         return "<Node (%s)>" % self.id
+
+
+class CategoryTreeRoot(DeclarativeBase):
+    """Order of the trees, one row per tree, see tree_manager.register_root"""
+    __tablename__ = "category_tree_root"
+    __table_args__ = TABLE_ARGS
+
+    tree_id = Column(CategoryTree.__table__.c.tree_id.type, primary_key=True, autoincrement=False)
+    # gapped, a tree is put between two others by writing its own row only
+    position = Column(BigInteger, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<CategoryTreeRoot({}@{})>".format(self.tree_id, self.position)
+
+
+class TreeIdCounter(DeclarativeBase):
+    """Tree id counters for databases without sequences (SQLite), see tree_id_allocator.py"""
+    __tablename__ = "tree_id_counter"
+    __table_args__ = TABLE_ARGS
+
+    name = Column(sql.String(length=256), primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<TreeIdCounter({}={})>".format(self.name, self.value)
+
+
+# source of integer tree ids on PostgreSQL, see tree_id_allocator.py
+tree_id_sequence = Sequence(f"{CategoryTree.__tablename__}_tree_id_seq", metadata=DeclarativeBase.metadata,
+                            schema=(TABLE_ARGS or {}).get('schema'))
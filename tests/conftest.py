@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# the settings are read from the environment when they are imported: a scratch SQLite
+# database, cleared by every controller, and the dense numbering unless a test asks
+os.environ['SQLITE_FILE'] = os.path.join(tempfile.mkdtemp(prefix='mptt-tests-'), 'tests.db')
+os.environ['CLEAR_DB_BEFORE_START'] = 'True'
+for name in ('MPTT_SPARSE_STEP', 'MPTT_DEFERRED', 'MPTT_TREE_LOCKS', 'SQL_STATS', 'TREE_CACHE_MAX_NODES'):
+    os.environ.pop(name, None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+from db_controller import DatabaseController
+
+
+@pytest.fixture
+def open_controller():
+    """Open a controller, settings attributes may be changed with monkeypatch first."""
+    controllers: list = []
+
+    def open_():
+        controller = DatabaseController(settings)
+        controller.open_db()
+        controllers.append(controller)
+        return controller
+
+    yield open_
+    for controller in controllers:
+        controller.close_db()
+
+
+@pytest.fixture
+def dbc(open_controller):
+    return open_controller()
+
+
+def _build_tree(dbc: DatabaseController, parents: list) -> list:
+    """Insert a tree node by node, parents[i] is the index of the parent of node i (-1 for the root)."""
+    names = [f"node_{i}" for i in range(len(parents))]
+    dbc.upsert_categories(names)
+    categories: dict = dbc.get_categories(names)
+    tree_id = dbc.get_max_tree_id()
+    nodes: list = []
+    for i, parent in enumerate(parents):
+        nodes.append(dbc.add_category_node(categories[names[i]], tree_id,
+                                           parent=None if parent < 0 else nodes[parent]))
+    return nodes
+
+
+@pytest.fixture
+def build_tree():
+    return _build_tree
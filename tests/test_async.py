@@ -0,0 +1,68 @@
+import asyncio
+
+import settings
+from async_db_controller import AsyncDatabaseController
+
+
+def _run(test):
+    """Run test(controller) with an opened AsyncDatabaseController."""
+    async def run():
+        controller = AsyncDatabaseController(settings)
+        await controller.open_db()
+        try:
+            return await test(controller)
+        finally:
+            await controller.close_db()
+            await AsyncDatabaseController.dispose_engines()
+
+    return asyncio.run(run())
+
+
+def test_async_tree_operations(dbc):
+    async def test(controller):
+        names = [f"node_{i}" for i in range(5)]
+        await controller.add_categories(names)
+        categories: dict = await controller.get_categories(names)
+        root = await controller.add_category_node(categories['node_0'], await controller.get_max_tree_id())
+        a = await controller.add_category_node(categories['node_1'], root.tree_id, parent=root)
+        a1 = await controller.add_category_node(categories['node_2'], root.tree_id, parent=a)
+        b = await controller.add_category_node(categories['node_3'], root.tree_id, parent=root)
+        assert (root.left, root.right, a1.left, b.right) == (1, 8, 3, 7)
+
+        assert [node.id for node in await controller.get_subtree(root)] == [root.id, a.id, a1.id, b.id]
+        assert [node.id for node in await controller.get_ancestors(a1)] == [root.id, a.id]
+        assert [node.id for node in await controller.get_children(root)] == [a.id, b.id]
+        assert await controller.count_descendants(a) == 1
+
+        await controller.update_node(a, categories['node_4'], parent=b)
+        rows = [row async for row in controller.iter_subtree(root, batch_size=2)]
+        assert [(row[0], row[3], row[4], row[5]) for row in rows] == [
+            (root.id, 1, 8, 'node_0'), (b.id, 2, 7, 'node_3'), (a.id, 3, 6, 'node_4'), (a1.id, 4, 5, 'node_2')
+        ]
+        await controller.update_node(a, categories['node_1'])
+        assert (a.parent_id, a.left, a.right) == (None, 1, 4) and a.tree_id != root.tree_id
+        return root.tree_id, a.tree_id
+
+    for tree_id in _run(test):
+        assert dbc.verify_tree(tree_id)['problems'] == []
+
+
+def test_async_tasks_with_their_own_sessions(dbc):
+    async def build(controller, k: int):
+        async with controller.session():
+            categories: dict = await controller.get_categories([f"task_{k}_{i}" for i in range(4)])
+            nodes = [await controller.add_category_node(categories[f"task_{k}_0"], await controller.get_max_tree_id())]
+            for i in range(1, 4):
+                nodes.append(await controller.add_category_node(categories[f"task_{k}_{i}"], nodes[0].tree_id,
+                                                                parent=nodes[i // 2]))
+            return nodes[0].tree_id
+
+    async def test(controller):
+        await controller.add_categories([f"task_{k}_{i}" for k in range(4) for i in range(4)])
+        return await asyncio.gather(*(build(controller, k) for k in range(4)))
+
+    tree_ids = _run(test)
+    assert len(set(tree_ids)) == 4
+    for tree_id in tree_ids:
+        assert dbc.verify_tree(tree_id)['problems'] == []
+        assert dbc.load_snapshot([tree_id]).depth_histogram() == {1: 1, 2: 1, 3: 2}
@@ -0,0 +1,48 @@
+import pytest
+
+from models import Category, CategoryTree
+
+NAMES = ['root', 'a', 'a1', 'a2', 'b', 'b1']
+NESTED = {'root': {'a': {'a1': None, 'a2': None}, 'b': {'b1': None}}}
+ADJACENCY = {'root': ['a', 'b'], 'a': ['a1', 'a2'], 'b': ['b1']}
+
+
+def _layout(dbc, tree_id) -> list:
+    session = dbc.sessions[0]
+    root = session.query(CategoryTree).filter_by(tree_id=tree_id, parent_id=None).one()
+    return [(name, level, lft, rgt) for _, _, level, lft, rgt, name in dbc.iter_subtree(root)]
+
+
+@pytest.mark.parametrize('tree', [NESTED, ADJACENCY])
+def test_bulk_load_computes_positions(dbc, tree):
+    dbc.upsert_categories(NAMES)
+    tree_id = dbc.bulk_load_tree(tree, batch_size=2)
+    level = CategoryTree.get_default_level()
+    assert _layout(dbc, tree_id) == [
+        ('root', level, 1, 12),
+        ('a', level + 1, 2, 7), ('a1', level + 2, 3, 4), ('a2', level + 2, 5, 6),
+        ('b', level + 1, 8, 11), ('b1', level + 2, 9, 10),
+    ]
+    assert dbc.verify_tree(tree_id)['problems'] == []
+
+
+def test_bulk_loaded_tree_takes_mptt_inserts(dbc):
+    dbc.upsert_categories(NAMES + ['c'])
+    tree_id = dbc.bulk_load_tree(ADJACENCY)
+    other_id = dbc.bulk_load_tree({'a': ['b']})
+    assert other_id != tree_id
+    session = dbc.sessions[0]
+    b = session.query(CategoryTree).join(Category, Category.id == CategoryTree.category_id).filter(
+        CategoryTree.tree_id == tree_id, Category.name == 'b').one()
+    dbc.add_category_node(dbc.get_category('c'), tree_id, parent=b)
+    assert dbc.verify_tree(tree_id)['problems'] == []
+    assert [name for name, *_ in _layout(dbc, tree_id)] == ['root', 'a', 'a1', 'a2', 'b', 'b1', 'c']
+    assert [root.tree_id for root in dbc.get_roots()] == [tree_id, other_id]
+
+
+def test_bulk_load_rejects_unknown_categories(dbc):
+    dbc.upsert_categories(['root'])
+    with pytest.raises(Exception, match='unknown categories'):
+        dbc.bulk_load_tree({'root': ['missing']})
+    with pytest.raises(Exception, match='empty'):
+        dbc.bulk_load_tree({})
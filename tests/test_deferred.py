@@ -0,0 +1,50 @@
+import settings
+from models import CategoryTree
+
+
+def _layout(dbc, root) -> list:
+    return [(name, level, lft, rgt) for _, _, level, lft, rgt, name in dbc.iter_subtree(root)]
+
+
+def test_deferred_inserts_of_one_flush(monkeypatch, open_controller):
+    monkeypatch.setattr(settings, 'MPTT_DEFERRED', True)
+    monkeypatch.setattr(settings, 'SQL_STATS', True)
+    dbc = open_controller()
+    category_ids = dbc.upsert_categories(['root', 'old', 'a', 'a1', 'a2', 'b', 'other'])
+    root = dbc.add_category_node(None, dbc.get_max_tree_id(), category_id=category_ids['root'])
+    old = dbc.add_category_node(None, root.tree_id, parent=root, category_id=category_ids['old'])
+    other = dbc.add_category_node(None, dbc.get_max_tree_id(), category_id=category_ids['other'])
+    dbc.stats.reset()
+
+    with dbc.session() as session:
+        # loaded first, a query would autoflush the new nodes
+        old_node, root_node, other_node = (session.get(CategoryTree, n.id) for n in (old, root, other))
+
+        def node(name, parent):
+            child = CategoryTree(category_id=category_ids[name], parent=parent, tree_id=parent.tree_id)
+            session.add(child)
+            return child
+
+        # new subtrees under a new node, an old one, and a second tree, written by one flush
+        a = node('a', old_node)
+        node('a1', a)
+        node('a2', a)
+        node('b', root_node)
+        node('b', other_node)
+
+    # root and other are nodes of the controller's own session
+    dbc.sessions[0].expire_all()
+    level = CategoryTree.get_default_level()
+    assert _layout(dbc, root) == [
+        ('root', level, 1, 12),
+        ('old', level + 1, 2, 9),
+        ('a', level + 2, 3, 8), ('a1', level + 3, 4, 5), ('a2', level + 3, 6, 7),
+        ('b', level + 1, 10, 11),
+    ]
+    assert _layout(dbc, other) == [('other', level, 1, 4), ('b', level + 1, 2, 3)]
+    for tree_id in (root.tree_id, other.tree_id):
+        assert dbc.verify_tree(tree_id)['problems'] == []
+    operations: dict = dbc.stats.as_dict()['operations']
+    # positions are assigned once for the whole flush, not in every insert
+    assert operations['flush']['count'] == 1
+    assert operations['insert']['statements'] == 0
@@ -0,0 +1,46 @@
+import uuid
+
+import pytest
+from sqlalchemy.dialects import postgresql, sqlite
+
+from guid_type import GUID, new_guid, uuid7
+
+VALUE = uuid.UUID('0190f1b2-3c4d-7e5f-8a6b-7c8d9e0f1a2b')
+
+
+def test_uuid7_is_time_ordered():
+    keys = [uuid7() for _ in range(5000)]
+    assert all(key.version == 7 and key.variant == uuid.RFC_4122 for key in keys)
+    # the counter keeps the keys of one millisecond increasing
+    assert keys == sorted(keys) and len(set(keys)) == len(keys)
+
+
+@pytest.mark.parametrize('version', [4, 7])
+def test_new_guid_version(monkeypatch, version):
+    monkeypatch.setattr(GUID, 'version', version)
+    assert new_guid().version == version
+
+
+def _processors(dialect):
+    impl = GUID().dialect_impl(dialect)
+    return impl.bind_processor(dialect), impl.result_processor(dialect, None)
+
+
+@pytest.mark.parametrize('native, dialect, stored', [
+    (False, sqlite.dialect(), VALUE.hex),
+    (False, postgresql.psycopg2.dialect(), None),
+    (True, sqlite.dialect(), VALUE.bytes),
+    # the driver adapts uuid.UUID, nothing is converted per row
+    (True, postgresql.psycopg2.dialect(), VALUE),
+])
+def test_guid_storage(monkeypatch, native, dialect, stored):
+    monkeypatch.setattr(GUID, 'native', native)
+    bind, result = _processors(dialect)
+    if stored is VALUE:
+        assert bind is None and result is None
+        return
+    value = bind(VALUE)
+    if stored is not None:
+        assert value == stored
+    assert result(value) == VALUE
+    assert bind(None) is None and result(None) is None
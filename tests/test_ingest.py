@@ -0,0 +1,34 @@
+import pytest
+
+from ingest import iter_trees
+
+
+def _edges(*pairs) -> list:
+    return [{'parent': parent, 'child': child} for parent, child in pairs]
+
+
+def test_edge_rows_are_grouped_into_trees():
+    trees = list(iter_trees(_edges(('', 'r'), ('r', 'a'), ('a', 'b'), ('', 's'), ('s', 'x'))))
+    assert [(root, tree, nodes) for root, tree, _, nodes in trees] == [
+        ('r', {'r': ['a'], 'a': ['b']}, 3),
+        ('s', {'s': ['x']}, 2),
+    ]
+
+
+@pytest.mark.parametrize('rows', [
+    # a child before its parent
+    _edges(('', 'r'), ('b', 'c'), ('r', 'b')),
+    # no root row
+    _edges(('r', 'a'),),
+])
+def test_edge_rows_out_of_order_raise(rows):
+    with pytest.raises(Exception, match="isn't in tree"):
+        list(iter_trees(rows))
+
+
+def test_path_rows_of_a_tree_must_be_contiguous():
+    rows = [{'path': 'r/a'}, {'path': 's/x'}, {'path': 'r/b'}]
+    with pytest.raises(Exception, match="aren't contiguous"):
+        list(iter_trees(rows))
+    trees = {root: tree for root, tree, _, _ in iter_trees(rows, grouped=False)}
+    assert trees['r'] == {'r': {'a': {}, 'b': {}}}
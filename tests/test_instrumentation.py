@@ -0,0 +1,41 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+import settings
+from instrumentation import SqlStats
+
+
+def test_failed_statement_leaves_nothing_behind():
+    engine = create_engine('sqlite://')
+    stats = SqlStats()
+    stats.attach(engine)
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+        with pytest.raises(OperationalError):
+            connection.execute(text('SELECT * FROM missing'))
+        connection.execute(text('SELECT 2'))
+        assert 'sql_stats_start' not in connection.info
+    # the failed statement never reached after_cursor_execute
+    assert stats.as_dict()['statements'] == 2
+    stats.detach(engine)
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 3'))
+    assert stats.as_dict()['statements'] == 2
+
+
+def test_mptt_operations_are_accounted(monkeypatch, open_controller, build_tree):
+    monkeypatch.setattr(settings, 'SQL_STATS', True)
+    dbc = open_controller()
+    nodes = build_tree(dbc, [-1, 0, 0, 1])
+    tree_id = nodes[0].tree_id
+
+    inserts = dbc.stats.as_dict()['operations']['insert']
+    assert inserts['count'] == 4
+    assert inserts['statements'] >= 4 and inserts['rows'] > 0
+    assert inserts['max_rows'] <= inserts['rows']
+    (top_tree, totals), = dbc.stats.top_trees()
+    assert top_tree == tree_id and totals['operations'] == 4 and totals['rows'] == inserts['rows']
+    metrics = dbc.stats.prometheus()
+    assert 'mptt_operations_total{operation="insert"} 4\n' in metrics
+    assert f'mptt_tree_rows_total{{tree_id="{tree_id}"}} {inserts["rows"]}\n' in metrics
@@ -0,0 +1,71 @@
+import re
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from models import CategoryTree
+from tree_manager import _tree_lock_key, lock_trees
+
+TABLE = CategoryTree.__table__
+
+
+class LockRecorder:
+    """Stands for a PostgreSQL connection, records the advisory lock calls."""
+
+    dialect = postgresql.dialect()
+
+    def __init__(self, taken=()):
+        self.info: dict = {}
+        self.transaction = object()
+        self.calls: list = []
+        # tree keys of other transactions, pg_try_advisory_xact_lock fails on them
+        self.taken = {_tree_lock_key(tree_id) for tree_id in taken}
+
+    def get_transaction(self):
+        return self.transaction
+
+    def execute(self, statement):
+        sql = str(statement.compile(dialect=self.dialect, compile_kwargs={'literal_binds': True}))
+        function, _, tree_key = re.search(r'(pg_\w+)\((-?\d+), (-?\d+)\)', sql).groups()
+        self.calls.append((function, int(tree_key)))
+        return self
+
+    def scalar(self):
+        function, tree_key = self.calls[-1]
+        return tree_key not in self.taken
+
+
+def _trees_by_key(count: int) -> list:
+    return sorted(range(1, count + 1), key=_tree_lock_key)
+
+
+def test_trees_are_locked_in_key_order():
+    connection = LockRecorder()
+    tree_ids = _trees_by_key(4)
+    lock_trees(TABLE, connection, reversed(tree_ids))
+    assert connection.calls == [('pg_advisory_xact_lock', _tree_lock_key(tree_id)) for tree_id in tree_ids]
+    # held keys aren't taken again
+    lock_trees(TABLE, connection, tree_ids[1:3])
+    assert len(connection.calls) == 4
+
+
+def test_lower_keys_are_only_tried_later():
+    low, middle, high = _trees_by_key(3)
+    connection = LockRecorder(taken=[low])
+    lock_trees(TABLE, connection, [middle])
+    # waiting for a lower key while holding a higher one could deadlock
+    with pytest.raises(Exception, match='out of order'):
+        lock_trees(TABLE, connection, [low, high])
+    assert connection.calls[1:] == [('pg_try_advisory_xact_lock', _tree_lock_key(low))]
+
+    connection = LockRecorder()
+    lock_trees(TABLE, connection, [middle])
+    lock_trees(TABLE, connection, [low, high])
+    assert [function for function, _ in connection.calls] == [
+        'pg_advisory_xact_lock', 'pg_try_advisory_xact_lock', 'pg_advisory_xact_lock'
+    ]
+    # a new transaction starts with nothing held
+    connection.transaction = object()
+    connection.calls.clear()
+    lock_trees(TABLE, connection, [low])
+    assert connection.calls == [('pg_advisory_xact_lock', _tree_lock_key(low))]
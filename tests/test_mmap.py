@@ -0,0 +1,47 @@
+import uuid
+
+import pytest
+
+import tree_mmap
+from tree_mmap import MmapTree, Node
+
+# (id, parent_id, level, lft, rgt, name) in lft order, negative ids sort before positive ones
+ROWS = [(10, None, 1, 1, 10, 'root'), (-3, 10, 2, 2, 7, 'a'), (7, -3, 3, 3, 4, 'a1'),
+        (2, -3, 3, 5, 6, 'ä2'), (5, 10, 2, 8, 9, 'b')]
+
+
+@pytest.mark.parametrize('key', [int, lambda node_id: uuid.UUID(int=node_id % 2 ** 128)])
+def test_write_and_map_a_tree(tmp_path, key):
+    path = str(tmp_path / 'tree.mptt')
+    rows = [(key(node_id), None if parent_id is None else key(parent_id), *rest) for node_id, parent_id, *rest in ROWS]
+    assert tree_mmap.write_tree(iter(rows), path, key(42)) == 5
+    with MmapTree(path) as tree:
+        assert len(tree) == 5 and tree.tree_id == key(42)
+        assert list(tree) == [Node(*row) for row in rows]
+        assert tree.get(key(2)).name == 'ä2'
+        assert [node.name for node in tree.descendants(key(10))] == ['a', 'a1', 'ä2', 'b']
+        assert [node.name for node in tree.children(key(10))] == ['a', 'b']
+        assert [node.name for node in tree.children(key(7))] == []
+        assert [node.name for node in tree.ancestors(key(2))] == ['root', 'a']
+        with pytest.raises(Exception, match="isn't in"):
+            tree.position(key(4))
+
+
+def test_bad_files(tmp_path):
+    with pytest.raises(Exception, match='empty tree'):
+        tree_mmap.write_tree([], str(tmp_path / 'empty.mptt'), 1)
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'\0' * 128)
+    with pytest.raises(Exception, match="isn't a tree file"):
+        MmapTree(str(path))
+
+
+def test_export_and_import_through_a_file(dbc, build_tree, tmp_path):
+    nodes = build_tree(dbc, [-1, 0, 1, 0])
+    path = str(tmp_path / 'tree.mptt')
+    assert dbc.export_tree_mmap(nodes[1], path) == 2
+    tree_id = dbc.import_tree_mmap(path)
+    assert tree_id != nodes[0].tree_id
+    assert dbc.verify_tree(tree_id)['problems'] == []
+    root = next(root for root in dbc.get_roots() if root.tree_id == tree_id)
+    assert [row[5] for row in dbc.iter_subtree(root)] == ['node_1', 'node_2']
@@ -0,0 +1,87 @@
+from models import CategoryTree, CategoryTreeRoot
+
+
+def _layout(dbc, root) -> list:
+    """(name, depth below the root, lft, rgt) in lft order"""
+    dbc.sessions[0].refresh(root)
+    return [(name[5:], level - root.level, lft, rgt) for _, _, level, lft, rgt, name in dbc.iter_subtree(root)]
+
+
+def test_move_inside_the_tree(dbc, build_tree):
+    root, a, a1, a2, b = build_tree(dbc, [-1, 0, 1, 1, 0])
+    dbc.update_node(a, dbc.get_category('node_1'), parent=b)
+    assert _layout(dbc, root) == [('0', 0, 1, 10), ('4', 1, 2, 9), ('1', 2, 3, 8), ('2', 3, 4, 5), ('3', 3, 6, 7)]
+    assert dbc.verify_tree(root.tree_id)['problems'] == []
+
+
+def test_move_before_and_after_siblings(dbc, build_tree):
+    root, a, a1, b, c = build_tree(dbc, [-1, 0, 1, 0, 0])
+    session = dbc.sessions[0]
+    c.move_before(a.id)
+    session.commit()
+    assert [name for name, *_ in _layout(dbc, root)] == ['0', '4', '1', '2', '3']
+    a = session.get(CategoryTree, a.id)
+    a.move_after(b.id)
+    session.commit()
+    assert [name for name, *_ in _layout(dbc, root)] == ['0', '4', '3', '1', '2']
+    assert dbc.verify_tree(root.tree_id)['problems'] == []
+
+
+def test_move_before_the_first_child_of_another_parent(dbc, build_tree):
+    root, a, a1, a2, b, b1 = build_tree(dbc, [-1, 0, 1, 1, 0, 4])
+    session = dbc.sessions[0]
+    # the nearest node of that level on the left is a2, a cousin
+    a1.move_before(b1.id)
+    session.commit()
+    assert a1.parent_id == b.id
+    assert _layout(dbc, root) == [('0', 0, 1, 12), ('1', 1, 2, 5), ('3', 2, 3, 4),
+                                  ('4', 1, 6, 11), ('2', 2, 7, 8), ('5', 2, 9, 10)]
+    assert dbc.verify_tree(root.tree_id)['problems'] == []
+
+
+def test_move_to_another_tree(dbc, build_tree):
+    root, a, a1, b = build_tree(dbc, [-1, 0, 1, 0])
+    other, x = build_tree(dbc, [-1, 0])
+    dbc.update_node(a, dbc.get_category('node_1'), parent=x)
+    assert a.tree_id == other.tree_id
+    assert _layout(dbc, root) == [('0', 0, 1, 4), ('3', 1, 2, 3)]
+    assert _layout(dbc, other) == [('0', 0, 1, 8), ('1', 1, 2, 7), ('1', 2, 3, 6), ('2', 3, 4, 5)]
+    for tree_id in (root.tree_id, other.tree_id):
+        assert dbc.verify_tree(tree_id)['problems'] == []
+
+
+def _root_order(dbc) -> list:
+    return [root.tree_id for root in dbc.get_roots()]
+
+
+def test_subtree_becomes_a_tree_without_shifting_tree_ids(dbc, build_tree):
+    root, a, a1, b = build_tree(dbc, [-1, 0, 1, 0])
+    other = build_tree(dbc, [-1])[0]
+    tree_ids = [root.tree_id, other.tree_id]
+
+    dbc.update_node(a, dbc.get_category('node_1'), parent=None)
+    assert a.tree_id not in tree_ids
+    assert (a.parent_id, a.left, a.right) == (None, 1, 4)
+    assert _root_order(dbc) == tree_ids + [a.tree_id]
+    assert [(r.tree_id, r.id) for r in dbc.get_roots()[:2]] == [(root.tree_id, root.id), (other.tree_id, other.id)]
+    for tree_id in tree_ids + [a.tree_id]:
+        assert dbc.verify_tree(tree_id)['problems'] == []
+
+
+def test_reorder_roots_writes_the_registry_only(dbc, build_tree):
+    first, second, third = (build_tree(dbc, [-1, 0])[0] for _ in range(3))
+    session = dbc.sessions[0]
+    third.move_before(first.id)
+    session.commit()
+    assert _root_order(dbc) == [third.tree_id, first.tree_id, second.tree_id]
+    first = session.get(CategoryTree, first.id)
+    first.move_after(second.id)
+    session.commit()
+    assert _root_order(dbc) == [third.tree_id, second.tree_id, first.tree_id]
+    assert (first.left, first.right) == (1, 4)
+
+    # a root moved into another tree leaves the registry
+    dbc.update_node(second, dbc.get_category('node_0'), parent=first)
+    assert second.tree_id == first.tree_id
+    assert _root_order(dbc) == [third.tree_id, first.tree_id]
+    assert session.query(CategoryTreeRoot).count() == 2
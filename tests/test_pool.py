@@ -0,0 +1,25 @@
+import os
+
+from sqlalchemy import create_engine, text
+
+from db_pool import MeteredQueuePool
+
+
+def _use_connection(engine):
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT 1")).scalar() == 1
+
+
+def test_pool_metrics_survive_dispose(tmp_path):
+    engine = create_engine(f"sqlite:///{os.path.join(tmp_path, 'pool.db')}", poolclass=MeteredQueuePool,
+                           pool_size=2, max_overflow=0)
+    metrics = engine.pool.metrics
+    _use_connection(engine)
+    for expected in (2, 3):
+        engine.dispose()
+        _use_connection(engine)
+        assert isinstance(engine.pool, MeteredQueuePool)
+        assert engine.pool.metrics is metrics
+        status: dict = engine.pool.metrics_status()
+        assert (status['connects'], status['checkouts'], status['checkins']) == (expected, expected, expected)
+    engine.dispose()
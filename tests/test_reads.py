@@ -0,0 +1,59 @@
+import csv
+import json
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.dialects import sqlite
+
+# root 0 with children 1 (with 2, 3 and 4 under 3) and 5
+PARENTS = [-1, 0, 1, 1, 3, 0]
+
+
+def _ids(nodes) -> list:
+    return [node.id for node in nodes]
+
+
+def test_range_reads(dbc, build_tree):
+    nodes = build_tree(dbc, PARENTS)
+    build_tree(dbc, [-1, 0])
+    root, a, a1, a2, a21, b = nodes
+    assert _ids(dbc.get_subtree(root)) == _ids(nodes)
+    assert _ids(dbc.get_subtree(a)) == [a.id, a1.id, a2.id, a21.id]
+    assert _ids(dbc.get_subtree(root, max_depth=1)) == [root.id, a.id, b.id]
+    assert _ids(dbc.get_ancestors(a21)) == [root.id, a.id, a2.id]
+    assert dbc.get_ancestors(root) == []
+    assert _ids(dbc.get_children(a)) == [a1.id, a2.id]
+    assert dbc.count_descendants(root) == 5 and dbc.count_descendants(b) == 0
+
+
+def test_subtree_read_is_an_index_range_scan(dbc, build_tree):
+    root = build_tree(dbc, PARENTS)[0]
+    statement = dbc._subtree_query(root).compile(dialect=sqlite.dialect(), compile_kwargs={'literal_binds': True})
+    plan = ' '.join(row[-1] for row in dbc.sessions[0].execute(text(f"EXPLAIN QUERY PLAN {statement}")))
+    assert 'ix_category_tree_tree_id_lft' in plan
+
+
+def test_iter_subtree_in_batches(dbc, build_tree):
+    nodes = build_tree(dbc, PARENTS)
+    a = nodes[1]
+    rows = list(dbc.iter_subtree(a, batch_size=2))
+    assert rows == [(node.id, node.parent_id, node.level, node.left, node.right, f"node_{i + 1}")
+                    for i, node in enumerate(nodes[1:5])]
+
+
+def test_export_subtree(dbc, build_tree, tmp_path):
+    nodes = build_tree(dbc, PARENTS)
+    root = nodes[0]
+    assert dbc.export_subtree(root, tmp_path / 'tree.jsonl', batch_size=4) == 6
+    with open(tmp_path / 'tree.jsonl', encoding='utf-8') as fp:
+        exported = [json.loads(line) for line in fp]
+    assert exported[4] == {'id': nodes[4].id, 'parent_id': nodes[3].id, 'level': nodes[4].level,
+                           'lft': nodes[4].left, 'rgt': nodes[4].right, 'name': 'node_4'}
+
+    assert dbc.export_subtree(root, tmp_path / 'tree.csv', fmt='csv') == 6
+    with open(tmp_path / 'tree.csv', newline='', encoding='utf-8') as fp:
+        lines = list(csv.reader(fp))
+    assert lines[0] == ['id', 'parent_id', 'level', 'lft', 'rgt', 'name']
+    assert [line[5] for line in lines[1:]] == [f"node_{i}" for i in range(6)]
+    with pytest.raises(Exception, match='unknown export format'):
+        dbc.export_subtree(root, tmp_path / 'tree.xml', fmt='xml')
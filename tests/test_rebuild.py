@@ -0,0 +1,62 @@
+from models import CategoryTree
+
+
+def _damage(dbc, node):
+    session = dbc.sessions[0]
+    session.execute(CategoryTree.__table__.update().where(CategoryTree.id == node.id).values(lft=100, rgt=101))
+    session.commit()
+
+
+def test_rebuild_all_reports_every_tree(dbc, build_tree):
+    first = build_tree(dbc, [-1, 0, 1, 0])
+    second = build_tree(dbc, [-1, 0, 0])
+    broken = build_tree(dbc, [-1, 0])
+    tree_ids = [first[0].tree_id, second[0].tree_id]
+    broken_id = broken[0].tree_id
+    _damage(dbc, first[2])
+    _damage(dbc, second[1])
+    rebuild = dbc._rebuild_tree_in_transaction
+
+    def failing(tree_id, use_cte=None):
+        if tree_id == broken_id:
+            raise Exception("no connection")
+        return rebuild(tree_id, use_cte)
+
+    dbc._rebuild_tree_in_transaction = failing
+    calls: list = []
+    result: dict = dbc.rebuild_all(progress=lambda *args: calls.append(args))
+
+    assert result['trees'] == 2 and sorted(result['timings']) == tree_ids
+    assert result['failed'] == {broken_id: "Exception('no connection')"}
+    for tree_id in tree_ids:
+        assert dbc.verify_tree(tree_id)['problems'] == []
+    # failed trees are reported too, without a time
+    assert [call[:2] for call in calls] == [(1, 3), (2, 3), (3, 3)]
+    assert {call[2]: call[3] is None for call in calls} == {tree_ids[0]: False, tree_ids[1]: False, broken_id: True}
+
+
+def test_rebuild_all_in_processes(dbc, build_tree):
+    nodes = build_tree(dbc, [-1, 0, 1, 0])
+    tree_id = nodes[0].tree_id
+    _damage(dbc, nodes[2])
+    result: dict = dbc.rebuild_all(processes=True, workers=1)
+    assert list(result['timings']) == [tree_id] and result['failed'] == {}
+    assert dbc.verify_tree(tree_id)['problems'] == []
+
+
+def test_rebuild_subtree_shifts_the_rest_of_the_tree(dbc, build_tree):
+    root, a, a1, b = build_tree(dbc, [-1, 0, 1, 0])
+    session = dbc.sessions[0]
+    category_id = dbc.upsert_categories(['new'])['new']
+    # a node written around the MPTT events, without a position
+    session.execute(CategoryTree.__table__.insert().values(
+        category_id=category_id, parent_id=a.id, tree_id=root.tree_id, lft=0, rgt=0, level=0))
+    session.commit()
+    assert dbc.verify_tree(root.tree_id)['damaged'] == [a.id]
+
+    # the recursive CTE is PostgreSQL only, SQLite takes the per-level path
+    dbc.rebuild_subtree(a)
+    session.commit()
+    assert dbc.verify_tree(root.tree_id)['problems'] == []
+    # children keep their lft order, the new node (lft=0) comes first
+    assert [(node.left, node.right) for node in (root, a, a1, b)] == [(1, 10), (2, 7), (5, 6), (8, 9)]
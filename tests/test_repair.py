@@ -0,0 +1,33 @@
+import pytest
+
+from models import CategoryTree
+
+
+def test_repair_rebuilds_a_damaged_subtree(dbc, build_tree):
+    root, a, b, c, d = build_tree(dbc, [-1, 0, 1, 1, 0])
+    session = dbc.sessions[0]
+    session.execute(CategoryTree.__table__.update().where(CategoryTree.id == c.id).values(lft=100, rgt=101))
+    session.commit()
+
+    report: dict = dbc.verify_tree(root.tree_id)
+    assert report['problems']
+    assert report['damaged'] == [a.id]
+    dbc.repair_tree(root.tree_id)
+    assert dbc.verify_tree(root.tree_id)['problems'] == []
+
+
+def test_repair_of_a_parent_id_cycle_raises(dbc, build_tree):
+    root, a, b, c = build_tree(dbc, [-1, 0, 1, 2])
+    session = dbc.sessions[0]
+    # a under its own child
+    session.execute(CategoryTree.__table__.update().where(CategoryTree.id == a.id).values(parent_id=b.id))
+    session.commit()
+
+    report: dict = dbc.verify_tree(root.tree_id)
+    assert sorted(report['cycles']) == sorted([a.id, b.id])
+    assert report['orphans'] == []
+    with pytest.raises(Exception, match='their own ancestors'):
+        dbc.repair_tree(root.tree_id)
+    session.rollback()
+    with pytest.raises(Exception, match='cycle'):
+        dbc.rebuild_subtree(b.id)
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+import settings
+from async_db_controller import AsyncDatabaseController
+from models import Category, CategoryTree
+
+
+def _count(dbc, *names) -> int:
+    return dbc.sessions[0].query(Category).filter(Category.name.in_(names)).count()
+
+
+def test_nested_session_is_rolled_back_by_the_outer_block(dbc):
+    with pytest.raises(ValueError):
+        with dbc.session() as session:
+            session.add(Category(name='outer'))
+            with dbc.session() as inner:
+                assert inner is session
+                inner.add(Category(name='inner'))
+            raise ValueError
+    assert _count(dbc, 'outer', 'inner') == 0
+
+
+def test_nested_session_is_committed_by_the_outer_block(dbc):
+    with dbc.session():
+        with dbc.session() as inner:
+            inner.add(Category(name='inner'))
+        # the inner block exited without a commit
+        assert _count(dbc, 'inner') == 0
+    assert _count(dbc, 'inner') == 1
+
+
+def test_controller_methods_only_flush_inside_a_session_block(dbc):
+    with pytest.raises(ValueError):
+        with dbc.session():
+            category_ids: dict = dbc.upsert_categories(['u1', 'u2'])
+            dbc.add_category('u3', commit=True)
+            dbc.add_categories(['u4'])
+            root = dbc.add_category_node(dbc.get_category('u1'), dbc.get_max_tree_id())
+            assert root.id is not None and set(category_ids) == {'u1', 'u2'}
+            dbc.bulk_load_tree({'u1': ['u2']})
+            raise ValueError
+    assert _count(dbc, 'u1', 'u2', 'u3', 'u4') == 0
+    assert dbc.sessions[0].query(CategoryTree).count() == 0
+
+
+def test_controller_methods_are_committed_by_the_session_block(dbc):
+    with dbc.session():
+        dbc.upsert_categories(['u1', 'u2'])
+        tree_id = dbc.bulk_load_tree({'u1': ['u2']})
+    assert _count(dbc, 'u1', 'u2') == 2
+    assert dbc.verify_tree(tree_id)['problems'] == []
+    assert dbc.sessions[0].query(CategoryTree).filter(CategoryTree.tree_id == tree_id).count() == 2
+
+
+def test_async_controller_methods_only_flush_inside_a_session_block(dbc):
+    async def run():
+        controller = AsyncDatabaseController(settings)
+        await controller.open_db()
+        try:
+            with pytest.raises(ValueError):
+                async with controller.session():
+                    await controller.add_categories(['a1'])
+                    category = await controller.get_category('a1')
+                    await controller.add_category_node(category, await controller.get_max_tree_id())
+                    raise ValueError
+        finally:
+            await controller.close_db()
+            await AsyncDatabaseController.dispose_engines()
+
+    asyncio.run(run())
+    assert _count(dbc, 'a1') == 0
+    assert dbc.sessions[0].query(CategoryTree).count() == 0
@@ -0,0 +1,48 @@
+import uuid
+
+import pytest
+
+import tree_snapshot
+from tree_snapshot import TreeSnapshot
+
+# (id, tree_id, lft, rgt, level, parent_id) ordered by tree_id, lft; tree 1 has gaps
+ROWS = [
+    (1, 1, 1, 100, 1, None), (2, 1, 10, 50, 2, 1), (3, 1, 20, 30, 3, 2), (4, 1, 60, 70, 2, 1),
+    (5, 2, 1, 4, 1, None), (6, 2, 2, 3, 2, 5),
+]
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def snapshot_class(request, monkeypatch):
+    if request.param == 'array':
+        monkeypatch.setattr(tree_snapshot, 'numpy', None)
+    elif tree_snapshot.numpy is None:
+        pytest.skip("NumPy isn't installed")
+    return TreeSnapshot
+
+
+@pytest.mark.parametrize('key', [int, lambda node_id: uuid.UUID(int=node_id)])
+def test_snapshot_queries(snapshot_class, key):
+    snapshot = snapshot_class(
+        (key(node_id), tree_id, left, right, level, None if parent_id is None else key(parent_id))
+        for node_id, tree_id, left, right, level, parent_id in ROWS
+    )
+    assert len(snapshot) == 6 and snapshot.nbytes > 0
+    assert list(snapshot.descendant_counts()) == [3, 1, 0, 0, 1, 0]
+    assert snapshot.depth_histogram() == {1: 2, 2: 3, 3: 1}
+    assert snapshot.depth_histogram(2) == {1: 1, 2: 1}
+    assert list(snapshot.subtree_mask(key(2))) == [0, 1, 1, 0, 0, 0]
+    assert snapshot.lowest_common_ancestor(key(3), key(4)) == key(1)
+    assert snapshot.lowest_common_ancestor(key(3), key(2)) == key(2)
+    assert snapshot.lowest_common_ancestor(key(3), key(6)) is None
+    with pytest.raises(Exception, match="isn't in the snapshot"):
+        snapshot.position(key(7))
+
+
+def test_load_snapshot(dbc, build_tree):
+    nodes = build_tree(dbc, [-1, 0, 1, 0])
+    other = build_tree(dbc, [-1, 0])
+    snapshot = dbc.load_snapshot(batch_size=2)
+    assert snapshot.tree_keys == [nodes[0].tree_id, other[0].tree_id]
+    assert list(snapshot.descendant_counts()) == [3, 1, 0, 0, 1, 0]
+    assert len(dbc.load_snapshot([other[0].tree_id])) == 2
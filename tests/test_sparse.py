@@ -0,0 +1,51 @@
+import pytest
+
+import settings
+import tree_manager
+
+
+@pytest.fixture
+def respaces(monkeypatch):
+    calls: list = []
+    respace_subtree = tree_manager._respace_subtree
+
+    def counting(table, connection, table_pk, node, step):
+        calls.append(node[0])
+        return respace_subtree(table, connection, table_pk, node, step)
+
+    monkeypatch.setattr(tree_manager, '_respace_subtree', counting)
+    return calls
+
+
+@pytest.mark.parametrize('shape, count, step, max_respaces', [
+    # every insert goes one level deeper, each one halves the room left
+    ('deep', 150, 16, 50),
+    ('deep', 150, 1024, 20),
+    ('wide', 400, 16, 8),
+    ('wide', 400, 1024, 2),
+])
+def test_sparse_respace_frequency(monkeypatch, open_controller, build_tree, respaces,
+                                  shape, count, step, max_respaces):
+    monkeypatch.setattr(settings, 'MPTT_SPARSE_STEP', step)
+    dbc = open_controller()
+    parents = [i - 1 if shape == 'deep' else 0 for i in range(count)]
+    parents[0] = -1
+    nodes = build_tree(dbc, parents)
+
+    assert len(respaces) <= max_respaces
+    assert dbc.verify_tree(nodes[0].tree_id)['problems'] == []
+
+
+def test_controllers_keep_their_own_numbering(monkeypatch, open_controller, build_tree):
+    dense = open_controller()
+    monkeypatch.setattr(settings, 'MPTT_SPARSE_STEP', 1024)
+    sparse = open_controller()
+
+    # the controller opened last doesn't change the sessions of the first one
+    root, child = build_tree(dense, [-1, 0])
+    assert (root.left, child.left, child.right, root.right) == (1, 2, 3, 4)
+    root, child = build_tree(sparse, [-1, 0])
+    assert child.right - child.left > 1 and root.right - child.right > 1
+    assert dense.verify_tree(root.tree_id)['problems'] != []
+    assert sparse.verify_tree(root.tree_id)['problems'] == []
+    assert tree_manager.guid_tree_manager.sparse_step == 0
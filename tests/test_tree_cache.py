@@ -0,0 +1,72 @@
+import settings
+from tree_cache import TreeCache, TreeStructure
+
+# root 1 with children 2 (leaf) and 3, 4 under 3
+ROWS = [(1, None, 1, 8, 1), (2, 1, 2, 3, 2), (3, 1, 4, 7, 2), (4, 3, 5, 6, 3)]
+
+
+def test_tree_structure_queries():
+    tree = TreeStructure(7, ROWS)
+    assert len(tree) == 4 and 3 in tree and 5 not in tree
+    assert tree.descendants(1) == [2, 3, 4]
+    assert tree.count_descendants(3) == 1
+    assert tree.children(1) == [2, 3]
+    assert tree.ancestors(4) == [1, 3]
+    assert tree.ancestors(1) == []
+
+
+def test_cache_hits_misses_and_evictions():
+    loads: list = []
+
+    def loader(tree_id):
+        loads.append(tree_id)
+        return TreeStructure(tree_id, ROWS)
+
+    cache = TreeCache(loader, max_nodes=8)
+    cache.get(1)
+    cache.get(1)
+    cache.get(2)
+    # the third tree pushes the least recently used one out
+    cache.get(3)
+    assert loads == [1, 2, 3]
+    assert cache.stats() == {'trees': 2, 'nodes': 8, 'max_nodes': 8, 'hits': 1, 'misses': 3, 'evictions': 1}
+    cache.invalidate(2)
+    cache.get(2)
+    assert loads == [1, 2, 3, 2]
+
+
+def test_tree_invalidated_during_its_load_isnt_cached():
+    cache = None
+    loads: list = []
+
+    def loader(tree_id):
+        loads.append(tree_id)
+        # e.g. after_commit of another session while the old rows are being read
+        if len(loads) == 1:
+            cache.invalidate(tree_id)
+        return TreeStructure(tree_id, ROWS)
+
+    cache = TreeCache(loader, max_nodes=100)
+    cache.get(1)
+    assert cache.stats()['trees'] == 0
+    cache.get(1)
+    cache.get(1)
+    assert loads == [1, 1]
+    assert cache.stats()['trees'] == 1
+    assert cache._loading == {}
+
+
+def test_controller_cache_is_invalidated_by_writes(monkeypatch, open_controller, build_tree):
+    monkeypatch.setattr(settings, 'TREE_CACHE_MAX_NODES', 1000)
+    dbc = open_controller()
+    root, child = build_tree(dbc, [-1, 0])
+    tree_id = root.tree_id
+    assert dbc.get_tree_structure(tree_id).descendants(root.id) == [child.id]
+    assert dbc.get_tree_structure(tree_id) is dbc.get_tree_structure(tree_id)
+
+    dbc.upsert_categories(['grandchild'])
+    grandchild = dbc.add_category_node(dbc.get_category('grandchild'), tree_id, parent=child)
+    tree = dbc.get_tree_structure(tree_id)
+    assert tree.descendants(root.id) == [child.id, grandchild.id]
+    assert tree.ancestors(grandchild.id) == [root.id, child.id]
+    assert dbc.tree_cache_stats()['misses'] == 2
@@ -0,0 +1,77 @@
+import itertools
+import threading
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from models import CategoryTree, TreeIdCounter, tree_id_sequence
+from tree_id_allocator import TreeIdAllocator
+
+
+def test_counter_ids_follow_the_stored_trees(dbc):
+    dbc.upsert_categories(['root'])
+    first = dbc.bulk_load_tree({'root': []})
+    # a tree written with its own id, prepare moves the counter past it
+    dbc.bulk_load_tree({'root': []}, tree_id=first + 10)
+    allocator = dbc.tree_id_allocator
+    with dbc.engine.begin() as connection:
+        allocator.prepare(connection)
+        assert [allocator.allocate(connection) for _ in range(2)] == [first + 11, first + 12]
+    # ids of a rolled back transaction are given out again
+    with dbc.engine.connect() as connection:
+        transaction = connection.begin()
+        assert allocator.allocate(connection) == first + 13
+        transaction.rollback()
+    with dbc.engine.begin() as connection:
+        assert allocator.allocate(connection) == first + 13
+
+
+def test_unprepared_counter_raises(dbc):
+    with dbc.engine.connect() as connection:
+        transaction = connection.begin()
+        connection.execute(TreeIdCounter.__table__.delete())
+        with pytest.raises(Exception, match="isn't prepared"):
+            dbc.tree_id_allocator.allocate(connection)
+        transaction.rollback()
+
+
+class SequenceConnection:
+    """Stands for a PostgreSQL connection, nextval of a block comes from a counter."""
+
+    dialect = postgresql.dialect()
+
+    def __init__(self):
+        self.values = itertools.count(1)
+        self.round_trips: int = 0
+        self.block_size: int = 0
+
+    def execute(self, statement):
+        self.round_trips += 1
+        self.ids = [next(self.values) for _ in range(self.block_size)]
+        return self
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self.ids
+
+
+def test_sequence_ids_are_fetched_in_blocks():
+    allocator = TreeIdAllocator(CategoryTree.__table__, tree_id_sequence, TreeIdCounter.__table__, block_size=5)
+    connection = SequenceConnection()
+    connection.block_size = allocator.block_size
+    assert [allocator.allocate(connection) for _ in range(7)] == list(range(1, 8))
+    assert connection.round_trips == 2
+
+    ids: list = []
+
+    def allocate():
+        ids.extend(allocator.allocate(connection) for _ in range(500))
+
+    threads = [threading.Thread(target=allocate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 2000 and min(ids) == 8
@@ -0,0 +1,23 @@
+import settings
+
+
+def test_upsert_skips_existing_names(monkeypatch, open_controller):
+    monkeypatch.setattr(settings, 'LOOKUP_CHUNK_SIZE', 3)
+    dbc = open_controller()
+    first = dbc.upsert_categories(['a', 'b', 'c', 'b'])
+    assert sorted(first) == ['a', 'b', 'c']
+    # existing names don't fail the batch and keep their ids
+    second = dbc.upsert_categories(['c', 'd', 'a', 'e', 'f'])
+    assert second['a'] == first['a'] and second['c'] == first['c']
+    assert len(set(second.values())) == 5
+    assert dbc.get_category('d').id == second['d']
+    assert dbc.upsert_categories([]) == {}
+
+
+def test_add_category_node_by_category_id(dbc):
+    category_ids = dbc.upsert_categories(['root', 'child'])
+    tree_id = dbc.get_max_tree_id()
+    root = dbc.add_category_node(dbc.get_category('root'), tree_id)
+    child = dbc.add_category_node(None, tree_id, parent=root, category_id=category_ids['child'])
+    assert child.category_id == category_ids['child']
+    assert (child.parent_id, child.tree_id) == (root.id, root.tree_id)
@@ -0,0 +1,170 @@
+import collections
+import threading
+from array import array
+from bisect import bisect_right
+from typing import Callable, Iterable
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TreeStructure:
+    """
+    Read-only snapshot of one tree as parallel arrays sorted by lft.
+
+    The descendants of the node at position i are the positions i + 1 .. j - 1,
+    where j is the first position with lft > rgt[i]; it's found by binary search.
+    """
+    __slots__ = ('tree_id', 'ids', 'lefts', 'rights', 'levels', 'parents', '_positions')
+
+    def __init__(self, tree_id, rows: Iterable[tuple]):
+        """rows are (id, parent_id, lft, rgt, level) ordered by lft"""
+        self.tree_id = tree_id
+        ids: list = []
+        parent_ids: list = []
+        self.lefts = array('q')
+        self.rights = array('q')
+        self.levels = array('l')
+        for node_id, parent_id, left, right, level in rows:
+            ids.append(node_id)
+            parent_ids.append(parent_id)
+            self.lefts.append(left)
+            self.rights.append(right)
+            self.levels.append(level)
+
+        self._positions: dict = {node_id: i for i, node_id in enumerate(ids)}
+        self.parents = array('l', (self._positions.get(parent_id, -1) for parent_id in parent_ids))
+        # integer keys take 8 bytes in an array instead of a Python int per node
+        self.ids = array('q', ids) if all(isinstance(node_id, int) for node_id in ids) else ids
+
+    def __len__(self) -> int:
+        return len(self.lefts)
+
+    def __contains__(self, node_id) -> bool:
+        return node_id in self._positions
+
+    def _position(self, node_id) -> int:
+        try:
+            return self._positions[node_id]
+        except KeyError:
+            raise Exception(f"node {node_id} isn't in tree {self.tree_id}")
+
+    def _end(self, position: int) -> int:
+        return bisect_right(self.lefts, self.rights[position], lo=position + 1)
+
+    def descendants(self, node_id) -> list:
+        """Ids of all descendants in lft order."""
+        position = self._position(node_id)
+        return list(self.ids[position + 1:self._end(position)])
+
+    def count_descendants(self, node_id) -> int:
+        position = self._position(node_id)
+        return self._end(position) - position - 1
+
+    def children(self, node_id) -> list:
+        """Ids of direct children in lft order, jumping over the subtree of each child."""
+        position = self._position(node_id)
+        end = self._end(position)
+        children: list = []
+        child = position + 1
+        while child < end:
+            children.append(self.ids[child])
+            child = self._end(child)
+        return children
+
+    def ancestors(self, node_id) -> list:
+        """Ids of the ancestors from the root down."""
+        ancestors: list = []
+        parent = self.parents[self._position(node_id)]
+        while parent >= 0:
+            ancestors.append(self.ids[parent])
+            parent = self.parents[parent]
+        ancestors.reverse()
+        return ancestors
+
+
+class TreeCache:
+    """
+    LRU cache of TreeStructure by tree_id, limited by the total number of cached nodes.
+    GuidTreesManager invalidates trees which are changed through the ORM.
+    """
+
+    def __init__(self, loader: Callable, max_nodes: int):
+        """loader(tree_id) returns a TreeStructure"""
+        self.loader = loader
+        self.max_nodes = max_nodes
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._trees = collections.OrderedDict()
+        self._nodes: int = 0
+        # tree_id -> [running loads, generation] of trees being loaded, invalidate() bumps
+        # the generation so a load which has read the old rows isn't cached
+        self._loading: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, tree_id) -> TreeStructure:
+        with self._lock:
+            tree = self._trees.get(tree_id)
+            if tree is not None:
+                self._trees.move_to_end(tree_id)
+                self.hits += 1
+                return tree
+            self.misses += 1
+            loading = self._loading.setdefault(tree_id, [0, 0])
+            loading[0] += 1
+            generation: int = loading[1]
+
+        try:
+            tree = self.loader(tree_id)
+        except BaseException:
+            with self._lock:
+                self._loaded(tree_id)
+            raise
+        with self._lock:
+            if self._loaded(tree_id) != generation:
+                logger.debug(f"Tree {tree_id} was changed while it was loaded, it isn't cached")
+            elif len(tree) <= self.max_nodes and tree_id not in self._trees:
+                self._trees[tree_id] = tree
+                self._nodes += len(tree)
+                while self._nodes > self.max_nodes:
+                    _, evicted = self._trees.popitem(last=False)
+                    self._nodes -= len(evicted)
+                    self.evictions += 1
+        return tree
+
+    def _loaded(self, tree_id) -> int:
+        """Finish a load of the tree, returns the current generation."""
+        loading = self._loading[tree_id]
+        loading[0] -= 1
+        if not loading[0]:
+            del self._loading[tree_id]
+        return loading[1]
+
+    def invalidate(self, tree_id):
+        with self._lock:
+            loading = self._loading.get(tree_id)
+            if loading is not None:
+                loading[1] += 1
+            tree = self._trees.pop(tree_id, None)
+            if tree is not None:
+                self._nodes -= len(tree)
+                logger.debug(f"Tree {tree_id} is removed from cache")
+
+    def clear(self):
+        with self._lock:
+            for loading in self._loading.values():
+                loading[1] += 1
+            self._trees.clear()
+            self._nodes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'trees': len(self._trees),
+                'nodes': self._nodes,
+                'max_nodes': self.max_nodes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
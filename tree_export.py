@@ -0,0 +1,36 @@
+import csv
+import json
+from typing import Iterable, TextIO
+import logging
+
+logger = logging.getLogger(__name__)
+
+# columns of the rows produced by DatabaseController.iter_subtree
+FIELDS = ('id', 'parent_id', 'level', 'lft', 'rgt', 'name')
+
+
+def write_jsonl(rows: Iterable[tuple], fp: TextIO) -> int:
+    """Write one JSON object per row, GUIDs are written as strings. Returns the number of rows."""
+    count: int = 0
+    for row in rows:
+        fp.write(json.dumps(dict(zip(FIELDS, row)), default=str))
+        fp.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(rows: Iterable[tuple], fp: TextIO) -> int:
+    """Write a header and one line per row. Returns the number of rows."""
+    writer = csv.writer(fp)
+    writer.writerow(FIELDS)
+    count: int = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+WRITERS = {
+    'jsonl': write_jsonl,
+    'csv': write_csv,
+}
@@ -0,0 +1,92 @@
+import collections
+import threading
+
+from sqlalchemy import Sequence, Table, and_, func, select, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.engine import Connection
+from guid_type import GUID, new_guid
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TreeIdAllocator:
+    """
+    Hands out ids for new trees without SELECT max(tree_id) + 1.
+
+    On PostgreSQL the ids come from a sequence; nextval is never rolled back,
+    so they are fetched in blocks and cached in-process. Elsewhere (SQLite) a
+    row of the counter table is incremented in the caller's transaction: the
+    UPDATE takes the database write lock, so concurrent writers are serialized,
+    and a rolled back transaction gives its id back together with its tree.
+    """
+
+    def __init__(self, tree_table: Table, sequence: Sequence, counter_table: Table, block_size: int = 20):
+        self.tree_table = tree_table
+        self.sequence = sequence
+        self.counter_table = counter_table
+        self.block_size = block_size
+        self._ids = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def is_guid(self) -> bool:
+        return isinstance(self.tree_table.c.tree_id.type, GUID)
+
+    def prepare(self, connection: Connection):
+        """Move the sequence (counter) past tree ids which are already stored."""
+        if self.is_guid:
+            return
+        max_tree_id = connection.scalar(select([func.max(self.tree_table.c.tree_id)])) or 0
+        if connection.dialect.name == 'postgresql':
+            name = connection.dialect.identifier_preparer.format_sequence(self.sequence)
+            last_value, is_called = connection.execute(text(f"SELECT last_value, is_called FROM {name}")).fetchone()
+            if max_tree_id > (last_value if is_called else last_value - 1):
+                connection.execute(text("SELECT setval(:name, :value)"), {'name': name, 'value': max_tree_id})
+        else:
+            counter = self.counter_table
+            connection.execute(
+                sqlite.insert(counter).prefix_with('OR IGNORE'),
+                {'name': self.tree_table.name, 'value': max_tree_id}
+            )
+            connection.execute(
+                counter.update(
+                    and_(counter.c.name == self.tree_table.name,
+                     counter.c.value < max_tree_id)
+                ).values(
+                    value=max_tree_id
+                )
+            )
+
+    def allocate(self, connection: Connection):
+        """Return a new tree id, the connection is used for the database round trip (if any)."""
+        if self.is_guid:
+            return new_guid()
+        if connection.dialect.name != 'postgresql':
+            return self._increment_counter(connection)
+        with self._lock:
+            if self._ids:
+                return self._ids.popleft()
+        # the round trip is made without the lock: a hook awaited through a greenlet (asyncio)
+        # must not hold a thread lock which another task of the same thread waits for
+        ids: list = connection.execute(
+            select(
+                [self.sequence.next_value()]
+            ).select_from(
+                func.generate_series(1, self.block_size)
+            )
+        ).scalars().all()
+        logger.debug(f"Tree ids {ids[0]}..{ids[-1]} are reserved")
+        with self._lock:
+            # concurrent refills only leave a gap in the sequence
+            self._ids.extend(ids)
+            return self._ids.popleft()
+
+    def _increment_counter(self, connection: Connection) -> int:
+        counter = self.counter_table
+        condition = counter.c.name == self.tree_table.name
+        connection.execute(counter.update(condition).values(value=counter.c.value + 1))
+        tree_id = connection.scalar(select([counter.c.value]).where(condition))
+        if tree_id is None:
+            raise Exception(f"tree id counter of {self.tree_table.name} isn't prepared")
+        return tree_id
@@ -1,70 +1,39 @@
+import collections
+import time
+import weakref
+import zlib
+from contextlib import nullcontext
+
 from sqlalchemy.orm import object_session
 from sqlalchemy_mptt import TreesManager, BaseNestedSets, tree_manager, mptt_sessionmaker
-from sqlalchemy import and_, case, select, event
+from sqlalchemy import and_, bindparam, case, inspect, or_, select, event, text
 from sqlalchemy import func
 from sqlalchemy_mptt.events import mptt_before_delete
+from instrumentation import record_lock_wait
 
+# lft and rgt are 32-bit integer columns
+MAX_POSITION = 2 ** 31 - 1
 
-def _insert_subtree(
-        table,
-        connection,
-        node_size,
-        node_pos_left,
-        node_pos_right,
-        parent_pos_left,
-        parent_pos_right,
-        subtree,
-        parent_tree_id,
-        parent_level,
-        node_level,
-        left_sibling,
-        table_pk
-):
-    # step 1: rebuild inserted subtree
-    delta_lft = left_sibling['lft'] + 1
-    if not left_sibling['is_parent']:
-        delta_lft = left_sibling['rgt'] + 1
-    delta_rgt = delta_lft + node_size - 1
-
-    connection.execute(
-        table.update(
-            table_pk.in_(subtree)
-        ).values(
-            lft=table.c.lft - node_pos_left + delta_lft,
-            rgt=table.c.rgt - node_pos_right + delta_rgt,
-            level=table.c.level - node_level + parent_level + 1,
-            tree_id=parent_tree_id
-        )
-    )
-
-    # step 2: update key of right side
-    connection.execute(
-        table.update(
-            and_(
-                table.c.rgt > delta_lft - 1,
-                table_pk.notin_(subtree),
-                table.c.tree_id == parent_tree_id
-            )
-        ).values(
-            rgt=table.c.rgt + node_size,
-            lft=case(
-                [
-                    (
-                        table.c.lft > left_sibling['lft'],
-                        table.c.lft + node_size
-                    )
-                ],
-                else_=table.c.lft
-            )
-        )
-    )
 
 def _get_tree_table(mapper):
     for table in mapper.tables:
         if all(key in table.c for key in ['level', 'lft', 'rgt', 'parent_id']):
             return table
 
-def my_mptt_before_insert(mapper, connection, instance):
+def _new_tree_id(table, connection, tree_id_allocator=None):
+    if tree_id_allocator is not None:
+        return tree_id_allocator.allocate(connection)
+    # not safe for concurrent writers, see tree_id_allocator.TreeIdAllocator
+    return connection.scalar(
+        select(
+            [
+                func.max(table.c.tree_id) + 1
+            ]
+        )
+    ) or 1
+
+
+def my_mptt_before_insert(mapper, connection, instance, tree_id_allocator=None):
     """ Based on example
     https://bitbucket.org/zzzeek/sqlalchemy/src/73095b353124/examples/nested_sets/nested_sets.py?at=master
     """
@@ -78,14 +47,7 @@ def my_mptt_before_insert(mapper, connection, instance):
         instance.level = instance.get_default_level()
         # if we passed a tree_id, we don't need to set it (we can use it with guid)
         if instance.tree_id is None:
-            tree_id = connection.scalar(
-                select(
-                    [
-                        func.max(table.c.tree_id) + 1
-                    ]
-                )
-            ) or 1
-            instance.tree_id = tree_id
+            instance.tree_id = _new_tree_id(table, connection, tree_id_allocator)
     else:
         (parent_pos_left,
          parent_pos_right,
@@ -135,11 +97,625 @@ def my_mptt_before_insert(mapper, connection, instance):
         instance.left = parent_pos_right
         instance.right = parent_pos_right + 1
 
-# TODO: add support for tree_id (and other fields) as guid type
-# right now this method doesn't support tree_id as guid type
-def mptt_before_update(mapper, connection, instance):
+def my_mptt_sparse_before_insert(mapper, connection, instance, step, tree_id_allocator=None):
+    """ Gap-based variant of my_mptt_before_insert.
+
+        Siblings are numbered with free space between them, so a new child is put
+        into the gap after its last sibling and only the new row is written.
+        When the gap is exhausted an enclosing subtree is renumbered with room
+        for more appends first (see _respace_subtree).
+    """
+    table = _get_tree_table(mapper)
+    db_pk = instance.get_pk_column()
+    table_pk = getattr(table.c, db_pk.name)
+
+    if instance.parent_id is None:
+        instance.left = 1
+        instance.right = min(1 + step * step, MAX_POSITION)
+        instance.level = instance.get_default_level()
+        if instance.tree_id is None:
+            instance.tree_id = _new_tree_id(table, connection, tree_id_allocator)
+        return
+
+    parent, last_right = _get_sparse_slot(table, connection, table_pk, instance.parent_id)
+    if parent.rgt - last_right - 1 < 2:
+        _respace_subtree(table, connection, table_pk, parent, step)
+        parent, last_right = _get_sparse_slot(table, connection, table_pk, instance.parent_id)
+
+    width = min(step, (parent.rgt - last_right - 1) // 2)
+    instance.level = parent.level + 1
+    instance.tree_id = parent.tree_id
+    instance.left = last_right + 1
+    instance.right = last_right + 1 + width
+
+
+def _get_sparse_slot(table, connection, table_pk, parent_id):
+    """ Return the parent row and the position after which its next child goes
+        (rgt of the last child or lft of the parent).
+    """
+    parent = connection.execute(
+        select(
+            [
+                table_pk,
+                table.c.lft,
+                table.c.rgt,
+                table.c.tree_id,
+                table.c.level,
+                table.c.parent_id
+            ]
+        ).where(
+            table_pk == parent_id
+        )
+    ).fetchone()
+    last_right = connection.scalar(
+        select(
+            [
+                func.max(table.c.rgt)
+            ]
+        ).where(
+            and_(table.c.parent_id == parent_id,
+                 table.c.tree_id == parent.tree_id)
+        )
+    )
+    return parent, parent.lft if last_right is None else last_right
+
+
+def _respace_slots(size):
+    """ Slots taken by a respaced subtree of `size` nodes: 2 * size - 1 between its
+        endpoints and (children + 1) of room for appends before the rgt of every node.
+    """
+    return 4 * size - 2
+
+
+def _respace_subtree(table, connection, table_pk, node, step):
+    """ Make room for one more child of `node`, packed memory array style.
+
+        The ancestors of `node` and their sizes come from one query. Going up from
+        `node`, the first subtree whose spacing would stay at or above the threshold
+        of its height (3 at `node`, doubling per level up to `step`) is renumbered,
+        so the levels below are left far under their thresholds and a respace buys
+        many inserts. The root is grown to twice `step` (up to MAX_POSITION).
+        Every node gets free slots before its rgt for as many appends as it has
+        children, appends are where inserts go.
+    """
+    nodes = table.alias('nodes')
+    size = select(
+        [
+            func.count()
+        ]
+    ).where(
+        and_(nodes.c.tree_id == table.c.tree_id,
+             nodes.c.lft >= table.c.lft,
+             nodes.c.rgt <= table.c.rgt)
+    ).correlate(table).scalar_subquery()
+    ancestors = connection.execute(
+        select(
+            [
+                table_pk,
+                table.c.lft,
+                table.c.rgt,
+                table.c.parent_id,
+                size.label('size')
+            ]
+        ).where(
+            and_(table.c.lft <= node.lft,
+                 table.c.rgt >= node.rgt,
+                 table.c.tree_id == node.tree_id)
+        ).order_by(
+            table.c.lft.desc()
+        )
+    ).fetchall()
+
+    for height, ancestor in enumerate(ancestors):
+        left, right = ancestor.lft, ancestor.rgt
+        # the new node is counted in
+        slots = _respace_slots(ancestor.size + 1)
+        if ancestor.parent_id is None:
+            right = max(right, min(left + slots * max(2 * step, 3), MAX_POSITION))
+            if (right - left) // slots < 3:
+                raise Exception(f"tree {node.tree_id} doesn't fit into {MAX_POSITION} positions")
+            break
+        if (right - left) // slots >= max(3, min(step, 3 << height)):
+            break
+    else:
+        raise Exception(f"ancestors of node {node[0]} are inconsistent")
+    spacing = (right - left) // slots
+
+    rows = connection.execute(
+        select(
+            [
+                table_pk,
+                table.c.lft,
+                table.c.rgt,
+                table.c.parent_id
+            ]
+        ).where(
+            and_(table.c.lft >= left,
+                 table.c.rgt <= ancestor.rgt,
+                 table.c.tree_id == node.tree_id)
+        ).order_by(
+            table.c.lft
+        )
+    ).fetchall()
+    children = collections.Counter(row[3] for row in rows)
+    # lft order is the DFS order of a valid nested set, a node is closed
+    # when the next lft is past its rgt
+    slots_of = {}
+    stack = []
+    slot = 0
+    for pk, lft, rgt, _ in rows + [(None, MAX_POSITION + 1, None, None)]:
+        while stack and stack[-1][1] < lft:
+            closed = stack.pop()[0]
+            slots_of[closed][1] = slot + children[closed] + 1
+            slot = slots_of[closed][1] + 1
+        if pk is not None:
+            slots_of[pk] = [slot, None]
+            stack.append((pk, rgt))
+            slot += 1
+
+    positions = [{'_pk': pk, '_lft': left + lft * spacing, '_rgt': left + rgt * spacing}
+                 for pk, (lft, rgt) in slots_of.items()]
+    positions[0]['_rgt'] = right
+    connection.execute(
+        table.update(
+            table_pk == bindparam('_pk')
+        ).values(
+            lft=bindparam('_lft'),
+            rgt=bindparam('_rgt')
+        ),
+        positions
+    )
+
+
+def _apply_pending_inserts(table, connection, table_pk, nodes):
+    """ Give positions to nodes inserted in deferred mode.
+
+        `nodes` is a list of (pk, parent_id) in insertion order, the rows were
+        written with lft = rgt = 0. New nodes become the last children of their
+        parents. Per tree the right side is shifted by one UPDATE whose CASE
+        adds the accumulated size of all insertions to the left of each row,
+        then the new rows get their positions with one executemany UPDATE.
+        Returns the ids of the changed trees.
+    """
+    pending_ids = {pk for pk, _ in nodes}
+    children = {}
+    for pk, parent_id in nodes:
+        children.setdefault(parent_id, []).append(pk)
+
+    # number of new nodes in every new subtree (including itself)
+    sizes = {}
+    for pk, _ in reversed(nodes):
+        sizes[pk] = 1 + sum(sizes[child] for child in children.get(pk, ()))
+
+    anchors = connection.execute(
+        select(
+            [
+                table_pk,
+                table.c.lft,
+                table.c.rgt,
+                table.c.tree_id,
+                table.c.level
+            ]
+        ).where(
+            table_pk.in_([parent_id for parent_id in children if parent_id not in pending_ids])
+        )
+    ).fetchall()
+
+    trees = {}
+    for anchor in anchors:
+        trees.setdefault(anchor.tree_id, []).append(anchor)
+
+    positions = []
+    for tree_id, tree_anchors in trees.items():
+        tree_anchors.sort(key=lambda anchor: anchor.rgt)
+        # (old rgt of a parent, shift of every position from it up to the next parent)
+        shifts = []
+        shift = 0
+        for anchor in tree_anchors:
+            # the new subtrees go right before the (shifted) rgt of their parent
+            stack = []
+            left = anchor.rgt + shift
+            for child in children[anchor[0]]:
+                stack.append((child, left, anchor.level + 1))
+                left += 2 * sizes[child]
+            shift = left - anchor.rgt
+            shifts.append((anchor.rgt, shift))
+
+            while stack:
+                pk, left, level = stack.pop()
+                positions.append({
+                    '_pk': pk,
+                    '_lft': left,
+                    '_rgt': left + 2 * sizes[pk] - 1,
+                    '_level': level,
+                    '_tree_id': tree_id
+                })
+                left += 1
+                for child in children.get(pk, ()):
+                    stack.append((child, left, level + 1))
+                    left += 2 * sizes[child]
+
+        def shifted(column):
+            return case(
+                [
+                    (column >= right, column + delta)
+                    for right, delta in reversed(shifts)
+                ],
+                else_=column
+            )
+
+        connection.execute(
+            table.update(
+                and_(table.c.rgt >= shifts[0][0],
+                     table.c.tree_id == tree_id)
+            ).values(
+                lft=shifted(table.c.lft),
+                rgt=shifted(table.c.rgt)
+            )
+        )
+
+    if positions:
+        connection.execute(
+            table.update(
+                table_pk == bindparam('_pk')
+            ).values(
+                lft=bindparam('_lft'),
+                rgt=bindparam('_rgt'),
+                level=bindparam('_level'),
+                tree_id=bindparam('_tree_id')
+            ),
+            positions
+        )
+
+    return set(trees)
+
+
+def _subtree_cte(table, table_pk, node_id):
+    """ Recursive CTE with ids of the node and all its descendants.
+
+        It follows parent_id, so it's correct even if lft/rgt are broken.
+        UNION (not UNION ALL) drops the rows found before, so a parent_id
+        cycle ends the recursion instead of looping forever.
+    """
+    nodes = table.alias('nodes')
+    subtree = select(
+        [
+            table_pk.label('id')
+        ]
+    ).where(
+        table_pk == node_id
+    ).cte('subtree', recursive=True)
+    return subtree.union(
+        select(
+            [
+                nodes.c[table_pk.name]
+            ]
+        ).where(
+            nodes.c.parent_id == subtree.c.id
+        )
+    )
+
+
+def rebuild_subtree(table, connection, table_pk, node_id, default_level=1, use_cte=False):
+    """ Recompute lft, rgt and level of one subtree from parent_id.
+
+        The node keeps its lft (a root starts from 1), the rest of the tree is
+        shifted once by the change of the subtree size. Siblings keep their
+        order by lft. With use_cte (PostgreSQL only) the positions are computed
+        by a single UPDATE ... FROM over a recursive CTE, otherwise they are
+        computed in Python and written with executemany.
+    """
+    node = connection.execute(
+        select(
+            [
+                table.c.lft,
+                table.c.rgt,
+                table.c.tree_id,
+                table.c.level,
+                table.c.parent_id
+            ]
+        ).where(
+            table_pk == node_id
+        )
+    ).fetchone()
+    if node is None:
+        raise Exception(f"node {node_id} doesn't exist")
+
+    subtree = _subtree_cte(table, table_pk, node_id)
+    if node.parent_id is not None and connection.scalar(
+            select([func.count()]).select_from(subtree).where(subtree.c.id == node.parent_id)):
+        raise Exception(f"node {node_id} is its own ancestor, parent_id makes a cycle")
+    size = connection.scalar(select([func.count()]).select_from(subtree))
+    if node.parent_id is None:
+        left, level = 1, default_level
+    else:
+        left, level = node.lft, node.level
+    delta = left + 2 * size - 1 - node.rgt
+
+    if delta and node.parent_id is not None:
+        # ancestors and everything on the right side
+        connection.execute(
+            table.update(
+                and_(table.c.rgt > node.rgt,
+                     table.c.tree_id == node.tree_id,
+                     table_pk.notin_(select([subtree.c.id])))
+            ).values(
+                lft=case(
+                    [
+                        (
+                            table.c.lft > node.rgt,
+                            table.c.lft + delta
+                        )
+                    ],
+                    else_=table.c.lft
+                ),
+                rgt=table.c.rgt + delta
+            )
+        )
+
+    if use_cte:
+        _rebuild_subtree_cte(table, connection, table_pk, node_id, node.tree_id, left, level)
+        return
+
+    rows = connection.execute(
+        select(
+            [
+                table_pk,
+                table.c.parent_id
+            ]
+        ).where(
+            table_pk.in_(select([subtree.c.id]))
+        ).order_by(
+            table.c.lft,
+            table_pk
+        )
+    ).fetchall()
+    children = {}
+    for pk, parent_id in rows:
+        children.setdefault(parent_id, []).append(pk)
+
+    position = left
+    positions = [{'_pk': node_id, '_lft': position, '_rgt': None, '_level': level, '_tree_id': node.tree_id}]
+    stack = [(0, iter(children.get(node_id, ())))]
+    while stack:
+        index, nodes = stack[-1]
+        pk = next(nodes, None)
+        position += 1
+        if pk is None:
+            positions[index]['_rgt'] = position
+            stack.pop()
+            continue
+        positions.append({
+            '_pk': pk,
+            '_lft': position,
+            '_rgt': None,
+            '_level': positions[index]['_level'] + 1,
+            '_tree_id': node.tree_id
+        })
+        stack.append((len(positions) - 1, iter(children.get(pk, ()))))
+
+    connection.execute(
+        table.update(
+            table_pk == bindparam('_pk')
+        ).values(
+            lft=bindparam('_lft'),
+            rgt=bindparam('_rgt'),
+            level=bindparam('_level'),
+            tree_id=bindparam('_tree_id')
+        ),
+        positions
+    )
+
+
+def _rebuild_subtree_cte(table, connection, table_pk, node_id, tree_id, left, level):
+    """ PostgreSQL: number the subtree with one statement.
+
+        Every node gets its preorder index `pre`, its depth below the subtree
+        root and the size of its own subtree; then
+        lft = left + 2 * pre - depth and rgt = lft + 2 * size - 1.
+    """
+    preparer = connection.dialect.identifier_preparer
+    table_name = preparer.format_table(table)
+    pk = preparer.quote(table_pk.name)
+    connection.execute(
+        text(f"""
+            WITH RECURSIVE ranked AS (
+                SELECT {pk} AS id, parent_id,
+                       row_number() OVER (PARTITION BY parent_id ORDER BY lft, {pk}) AS rank
+                FROM {table_name}
+                WHERE tree_id = :tree_id
+            ), subtree(id, path, ids, depth) AS (
+                SELECT id, ARRAY[rank], ARRAY[id], 0 FROM ranked WHERE id = :node_id
+                UNION ALL
+                SELECT r.id, s.path || r.rank, s.ids || r.id, s.depth + 1
+                FROM ranked r JOIN subtree s ON r.parent_id = s.id
+                WHERE r.id <> ALL(s.ids)
+            ), ordered AS (
+                SELECT id, depth, row_number() OVER (ORDER BY path) - 1 AS pre FROM subtree
+            ), sizes AS (
+                SELECT ancestor AS id, count(*) AS size
+                FROM subtree, unnest(subtree.ids) AS ancestor
+                GROUP BY ancestor
+            )
+            UPDATE {table_name} AS t
+            SET lft = :left + 2 * o.pre - o.depth,
+                rgt = :left + 2 * o.pre - o.depth + 2 * z.size - 1,
+                level = :level + o.depth
+            FROM ordered o JOIN sizes z ON z.id = o.id
+            WHERE t.{pk} = o.id
+        """),
+        {'tree_id': tree_id, 'node_id': node_id, 'left': left, 'level': level}
+    )
+
+
+def verify_tree(table, connection, table_pk, tree_id, default_level=1, dense=True):
+    """ Check the nested sets of a tree against parent_id with one query.
+
+        Every node is compared with its parent (joined by parent_id), with its
+        siblings and with the next node in lft order (window functions),
+        so overlapping intervals, gaps (dense numbering only), wrong levels and
+        intervals outside of the parent are found in a single scan of the tree.
+        Returns [(node_id, parent_id, problem)] of the inconsistent nodes.
+    """
+    node = table.alias('node')
+    parent = table.alias('parent')
+    node_pk = node.c[table_pk.name]
+    parent_pk = parent.c[table_pk.name]
+    order = (node.c.lft, node_pk)
+    scan = select(
+        [
+            node_pk.label('id'),
+            node.c.parent_id,
+            node.c.lft,
+            node.c.rgt,
+            node.c.level,
+            parent_pk.label('parent_found'),
+            parent.c.lft.label('parent_lft'),
+            parent.c.rgt.label('parent_rgt'),
+            parent.c.level.label('parent_level'),
+            func.lead(node.c.parent_id).over(order_by=order).label('next_parent_id'),
+            func.lag(node.c.rgt).over(partition_by=node.c.parent_id, order_by=order).label('sibling_rgt'),
+            func.lead(node_pk).over(partition_by=node.c.parent_id, order_by=order).label('next_sibling_id')
+        ]
+    ).select_from(
+        node.outerjoin(parent, and_(parent_pk == node.c.parent_id, parent.c.tree_id == node.c.tree_id))
+    ).where(
+        node.c.tree_id == tree_id
+    ).subquery('scan')
+
+    c = scan.c
+    is_root = c.parent_id.is_(None)
+    checks = [
+        (and_(c.parent_id.isnot(None), c.parent_found.is_(None)), 'orphan'),
+        (c.lft >= c.rgt, 'interval'),
+        (and_(is_root, c.level != default_level), 'root_level'),
+        (and_(is_root, c.lft != 1), 'root_left'),
+        (c.level != c.parent_level + 1, 'level'),
+        (or_(c.lft <= c.parent_lft, c.rgt >= c.parent_rgt), 'outside_parent'),
+        (c.lft <= c.sibling_rgt, 'overlap'),
+    ]
+    if dense:
+        # every position follows the previous one: first child after its parent's lft,
+        # the next sibling after rgt of the previous one, the parent's rgt after the
+        # last child, and a leaf takes two positions only
+        checks += [
+            (and_(c.sibling_rgt.is_(None), ~is_root, c.lft != c.parent_lft + 1), 'gap'),
+            (c.lft != c.sibling_rgt + 1, 'gap'),
+            (and_(c.next_sibling_id.is_(None), c.rgt != c.parent_rgt - 1), 'gap'),
+            (and_(or_(c.next_parent_id.is_(None), c.next_parent_id != c.id), c.rgt != c.lft + 1), 'gap'),
+        ]
+    problem = case(checks, else_=None).label('problem')
+    checked = select([c.id, c.parent_id, problem]).subquery('checked')
+    return connection.execute(
+        select(
+            [
+                checked.c.id,
+                checked.c.parent_id,
+                checked.c.problem
+            ]
+        ).where(
+            checked.c.problem.isnot(None)
+        )
+    ).fetchall()
+
+
+def damaged_subtrees(table, connection, table_pk, tree_id, problems):
+    """ The smallest set of subtree roots whose rebuild fixes `problems` of verify_tree.
+
+        A node in a wrong place is renumbered by the rebuild of its parent, a root
+        by its own rebuild. Subtrees inside other damaged subtrees are dropped.
+        Orphans and members of parent_id cycles can't be fixed by a rebuild and
+        are returned separately. Returns (subtree root ids, orphan ids, cycle ids).
+    """
+    if not problems:
+        return [], [], []
+    parents = dict(connection.execute(
+        select(
+            [
+                table_pk,
+                table.c.parent_id
+            ]
+        ).where(
+            table.c.tree_id == tree_id
+        )
+    ).fetchall())
+
+    # a cycle never reaches a root: follow parent_id from every node, visiting each
+    # node once, a walk which runs into itself has found a cycle
+    cycles = []
+    walks = {}
+    for start in parents:
+        path = []
+        node_id = start
+        while node_id in parents and node_id not in walks:
+            walks[node_id] = start
+            path.append(node_id)
+            node_id = parents[node_id]
+        if walks.get(node_id) == start:
+            cycles.extend(path[path.index(node_id):])
+    in_cycle = set(cycles)
+
+    targets = set()
+    orphans = []
+    for node_id, parent_id, problem in problems:
+        if problem == 'orphan':
+            orphans.append(node_id)
+        elif node_id not in in_cycle:
+            target = node_id if parent_id is None else parent_id
+            if target not in in_cycle:
+                targets.add(target)
+
+    damaged = []
+    for target in targets:
+        ancestor = parents.get(target)
+        seen = {target}
+        # parent_id may be broken as well, don't loop on a cycle
+        while ancestor is not None and ancestor not in targets and ancestor not in seen:
+            seen.add(ancestor)
+            ancestor = parents.get(ancestor)
+        if ancestor is None or ancestor in seen:
+            damaged.append(target)
+    return damaged, orphans, cycles
+
+
+def _move_subtree(
+        table,
+        connection,
+        node_pos_left,
+        node_tree_id,
+        target_pos_left,
+        target_tree_id,
+        level_delta
+):
+    """ Put the subtree marked by negative positions (see mptt_before_update)
+        to target_pos_left of the target tree.
+    """
+    connection.execute(
+        table.update(
+            and_(
+                table.c.lft < 0,
+                table.c.tree_id == node_tree_id
+            )
+        ).values(
+            lft=-table.c.lft - node_pos_left + target_pos_left,
+            rgt=-table.c.rgt - node_pos_left + target_pos_left,
+            level=table.c.level + level_delta,
+            tree_id=target_tree_id
+        )
+    )
+
+
+def mptt_before_update(mapper, connection, instance, tree_id_allocator=None, root_registry=None):
     """ Based on this example:
         http://stackoverflow.com/questions/889527/move-node-in-nested-set
+
+        The moved subtree is addressed by its lft range only: it's marked by
+        negating lft/rgt, the gap it leaves is closed, a gap is opened at the
+        new place and the marked rows are moved there. No id lists are loaded.
+
+        A subtree which becomes a root gets a new tree_id, its place among the
+        other trees is kept in root_registry (see register_root), so tree ids
+        are never shifted and may be GUIDs. Reordering roots writes the registry only.
     """
     node_id = getattr(instance, instance.get_pk_name())
     table = _get_tree_table(mapper)
@@ -149,6 +725,9 @@ def mptt_before_update(mapper, connection, instance):
     mptt_move_inside = None
     left_sibling = None
     left_sibling_tree_id = None
+    # the node becomes a root placed right after/before the tree of another root
+    root_after_tree_id = None
+    root_before_tree_id = None
 
     if hasattr(instance, 'mptt_move_inside'):
         mptt_move_inside = instance.mptt_move_inside
@@ -173,7 +752,8 @@ def mptt_before_update(mapper, connection, instance):
                 table_pk == instance.mptt_move_before
             )
         ).fetchone()
-        current_lvl_nodes = connection.execute(
+        # the nearest sibling on the left, other than the moved node
+        current_lvl_node = connection.execute(
             select(
                 [
                     table.c.lft,
@@ -183,28 +763,51 @@ def mptt_before_update(mapper, connection, instance):
                 ]
             ).where(
                 and_(
-                    table.c.level == right_sibling_level,
+                    table.c.parent_id == right_sibling_parent,
                     table.c.tree_id == right_sibling_tree_id,
-                    table.c.lft < right_sibling_left
+                    table.c.lft < right_sibling_left,
+                    table_pk != node_id
                 )
-            )
-        ).fetchall()
-        if current_lvl_nodes:
+            ).order_by(
+                table.c.lft.desc()
+            ).limit(1)
+        ).fetchone()
+        if current_lvl_node:
             (
                 left_sibling_left,
                 left_sibling_right,
                 left_sibling_parent,
                 left_sibling_tree_id
-            ) = current_lvl_nodes[-1]
+            ) = current_lvl_node
             instance.parent_id = left_sibling_parent
             left_sibling = {
                 'lft': left_sibling_left,
                 'rgt': left_sibling_right,
+                'tree_id': left_sibling_tree_id,
                 'is_parent': False
             }
         # if move_before to top level
         elif not right_sibling_parent:
-            left_sibling_tree_id = right_sibling_tree_id - 1
+            root_before_tree_id = right_sibling_tree_id
+        else:
+            # before the first child, i.e. right after the lft of the parent
+            instance.parent_id = right_sibling_parent
+            parent_left, parent_tree_id = connection.execute(
+                select(
+                    [
+                        table.c.lft,
+                        table.c.tree_id
+                    ]
+                ).where(
+                    table_pk == right_sibling_parent
+                )
+            ).fetchone()
+            left_sibling = {
+                'lft': parent_left,
+                'rgt': None,
+                'tree_id': parent_tree_id,
+                'is_parent': True
+            }
 
     # if placed after a particular node
     if hasattr(instance, 'mptt_move_after'):
@@ -229,28 +832,11 @@ def mptt_before_update(mapper, connection, instance):
         left_sibling = {
             'lft': left_sibling_left,
             'rgt': left_sibling_right,
+            'tree_id': left_sibling_tree_id,
             'is_parent': False
         }
-
-    """ Get subtree from node
-
-        SELECT id, name, level FROM my_tree
-        WHERE left_key >= $left_key AND right_key <= $right_key
-        ORDER BY left_key
-    """
-    subtree = connection.execute(
-        select([table_pk])
-        .where(
-            and_(
-                table.c.lft >= instance.left,
-                table.c.rgt <= instance.right,
-                table.c.tree_id == instance.tree_id
-            )
-        ).order_by(
-            table.c.lft
-        )
-    ).fetchall()
-    subtree = [x[0] for x in subtree]
+        if left_sibling_parent is None:
+            root_after_tree_id = left_sibling_tree_id
 
     """ step 0: Initialize parameters.
 
@@ -281,9 +867,15 @@ def mptt_before_update(mapper, connection, instance):
     if not left_sibling \
             and str(node_parent_id) == str(instance.parent_id) \
             and not mptt_move_inside:
-        if left_sibling_tree_id is None:
+        if root_before_tree_id is None:
             return
 
+    if node_parent_id is None and instance.parent_id is None:
+        # a root stays a root, only the order of the trees changes
+        if root_registry is not None:
+            register_root(root_registry, connection, node_tree_id, root_after_tree_id, root_before_tree_id)
+        return
+
     # fix tree shorting
     if instance.parent_id is not None:
         (
@@ -309,100 +901,466 @@ def mptt_before_update(mapper, connection, instance):
             instance.parent_id = None
             return
 
-    # delete from old tree
-    mptt_before_delete(mapper, connection, instance, False)
+    # 'size' of moving node (including all it's sub nodes)
+    node_size = node_pos_right - node_pos_left + 1
 
-    if instance.parent_id is not None:
-        """ Put there right position of new parent node (there moving node
-            should be moved)
-        """
-        (
-            parent_id,
-            parent_pos_right,
-            parent_pos_left,
-            parent_tree_id,
-            parent_level
-        ) = connection.execute(
-            select(
-                [
-                    table_pk,
-                    table.c.rgt,
-                    table.c.lft,
-                    table.c.tree_id,
-                    table.c.level
-                ]
-            ).where(
-                table_pk == instance.parent_id
+    # step 1: mark the moving subtree
+    connection.execute(
+        table.update(
+            and_(
+                table.c.lft >= node_pos_left,
+                table.c.rgt <= node_pos_right,
+                table.c.tree_id == node_tree_id
             )
-        ).fetchone()
-        # 'size' of moving node (including all it's sub nodes)
-        node_size = node_pos_right - node_pos_left + 1
+        ).values(
+            lft=-table.c.lft,
+            rgt=-table.c.rgt
+        )
+    )
+
+    # step 2: close the gap in the old tree (like mptt_before_delete)
+    connection.execute(
+        table.update(
+            and_(
+                table.c.rgt > node_pos_right,
+                table.c.tree_id == node_tree_id
+            )
+        ).values(
+            lft=case(
+                [
+                    (
+                        table.c.lft > node_pos_right,
+                        table.c.lft - node_size
+                    )
+                ],
+                else_=table.c.lft
+            ),
+            rgt=table.c.rgt - node_size
+        )
+    )
+
+    def closed(position, tree_id):
+        """ Position of a row read before step 2 """
+        if tree_id == node_tree_id and position > node_pos_right:
+            return position - node_size
+        return position
 
+    if instance.parent_id is not None:
         # left sibling node
         if not left_sibling:
             left_sibling = {
                 'lft': parent_pos_left,
                 'rgt': parent_pos_right,
+                'tree_id': parent_tree_id,
                 'is_parent': True
             }
+        if left_sibling['is_parent']:
+            target_pos_left = closed(left_sibling['lft'], left_sibling['tree_id']) + 1
+        else:
+            target_pos_left = closed(left_sibling['rgt'], left_sibling['tree_id']) + 1
 
-        # insert subtree in exist tree
+        # step 3: open a gap in the new tree
+        connection.execute(
+            table.update(
+                and_(
+                    table.c.rgt >= target_pos_left,
+                    table.c.tree_id == parent_tree_id
+                )
+            ).values(
+                lft=case(
+                    [
+                        (
+                            table.c.lft >= target_pos_left,
+                            table.c.lft + node_size
+                        )
+                    ],
+                    else_=table.c.lft
+                ),
+                rgt=table.c.rgt + node_size
+            )
+        )
+
+        # step 4: insert subtree in exist tree
         instance.tree_id = parent_tree_id
-        _insert_subtree(
+        _move_subtree(
             table,
             connection,
-            node_size,
             node_pos_left,
-            node_pos_right,
-            parent_pos_left,
-            parent_pos_right,
-            subtree,
+            node_tree_id,
+            target_pos_left,
             parent_tree_id,
-            parent_level,
-            node_level,
-            left_sibling,
-            table_pk
+            parent_level + 1 - node_level
         )
+        if node_parent_id is None and root_registry is not None:
+            # the tree of the moved root is gone
+            unregister_root(root_registry, connection, node_tree_id)
     else:
-        # if insert after
-        if left_sibling_tree_id or left_sibling_tree_id == 0:
-            tree_id = left_sibling_tree_id + 1
-            connection.execute(
-                table.update(
-                    table.c.tree_id > left_sibling_tree_id
-                ).values(
-                    tree_id=table.c.tree_id + 1
-                )
-            )
-        # if just insert
-        else:
-            tree_id = connection.scalar(
-                select(
-                    [
-                        func.max(table.c.tree_id) + 1
-                    ]
-                )
-            )
+        # the subtree becomes a new tree, the other trees aren't touched;
+        # a tree_id the caller has already allocated for it is kept
+        tree_id = instance.tree_id
+        if tree_id is None or str(tree_id) == str(node_tree_id):
+            tree_id = _new_tree_id(table, connection, tree_id_allocator)
+        instance.tree_id = tree_id
+        _move_subtree(
+            table,
+            connection,
+            node_pos_left,
+            node_tree_id,
+            1,
+            tree_id,
+            default_level - node_level
+        )
+        if root_registry is not None:
+            register_root(root_registry, connection, tree_id, root_after_tree_id, root_before_tree_id)
+
+
+# gap between positions of neighbouring trees in the root registry
+ROOT_POSITION_STEP = 2 ** 16
+
+
+def _root_position(registry, connection, tree_id):
+    return connection.execute(
+        select(
+            [
+                registry.c.position
+            ]
+        ).where(
+            registry.c.tree_id == tree_id
+        )
+    ).scalar()
 
+
+def _respace_roots(registry, connection):
+    """ Renumber the whole registry with ROOT_POSITION_STEP gaps, it holds one row per tree """
+    tree_ids = connection.execute(
+        select(
+            [
+                registry.c.tree_id
+            ]
+        ).order_by(
+            registry.c.position,
+            registry.c.tree_id
+        )
+    ).scalars().all()
+    if tree_ids:
         connection.execute(
-            table.update(
-                table_pk.in_(
-                    subtree
-                )
+            registry.update(
+                registry.c.tree_id == bindparam('_tree_id')
             ).values(
-                lft=table.c.lft - node_pos_left + 1,
-                rgt=table.c.rgt - node_pos_left + 1,
-                level=table.c.level - node_level + default_level,
-                tree_id=tree_id
-            )
+                position=bindparam('_position')
+            ),
+            [{'_tree_id': tree_id, '_position': (i + 1) * ROOT_POSITION_STEP} for i, tree_id in enumerate(tree_ids)]
         )
 
 
+def _root_gap(registry, connection, after_tree_id=None, before_tree_id=None):
+    """ (low, high) positions the new entry goes between """
+    if after_tree_id is not None:
+        low = ensure_root(registry, connection, after_tree_id)
+        high = connection.execute(
+            select([func.min(registry.c.position)]).where(registry.c.position > low)
+        ).scalar()
+        return low, low + 2 * ROOT_POSITION_STEP if high is None else high
+    if before_tree_id is not None:
+        high = ensure_root(registry, connection, before_tree_id)
+        low = connection.execute(
+            select([func.max(registry.c.position)]).where(registry.c.position < high)
+        ).scalar()
+        return high - 2 * ROOT_POSITION_STEP if low is None else low, high
+    low = connection.execute(select([func.max(registry.c.position)])).scalar() or 0
+    return low, low + 2 * ROOT_POSITION_STEP
+
+
+def register_root(registry, connection, tree_id, after_tree_id=None, before_tree_id=None):
+    """ Put the tree into the ordered registry of trees: at the end, or right
+        after/before another tree. Only the registry row of the tree is written
+        (all rows of the small registry when the gap is used up), the trees
+        themselves keep their tree_id. Returns the position.
+    """
+    unregister_root(registry, connection, tree_id)
+    low, high = _root_gap(registry, connection, after_tree_id, before_tree_id)
+    if high - low < 2:
+        _respace_roots(registry, connection)
+        low, high = _root_gap(registry, connection, after_tree_id, before_tree_id)
+    position = (low + high) // 2
+    connection.execute(
+        registry.insert().values(tree_id=tree_id, position=position)
+    )
+    return position
+
+
+def ensure_root(registry, connection, tree_id):
+    """ Position of the tree in the registry, a tree which isn't there yet is appended """
+    position = _root_position(registry, connection, tree_id)
+    if position is None:
+        position = register_root(registry, connection, tree_id)
+    return position
+
+
+def unregister_root(registry, connection, tree_id):
+    connection.execute(
+        registry.delete(registry.c.tree_id == tree_id)
+    )
+
+
+def _tree_lock_key(tree_id) -> int:
+    """ Signed 32-bit key of a tree for pg_advisory_xact_lock(int, int) """
+    key = zlib.crc32(str(tree_id).encode('utf-8'))
+    return key - 2 ** 32 if key >= 2 ** 31 else key
+
+
+def _held_tree_locks(connection) -> set:
+    """ (table key, tree key) pairs locked by the current transaction of the connection """
+    transaction = connection.get_transaction()
+    held = connection.info.get('mptt_tree_locks')
+    if held is None or held[0] is not transaction:
+        held = connection.info['mptt_tree_locks'] = (transaction, set())
+    return held[1]
+
+
+def lock_trees(table, connection, tree_ids):
+    """ Serialize nested-set changes of the given trees until the end of the transaction.
+
+        PostgreSQL: transaction-level advisory locks keyed by (table, tree_id). A transaction
+        waits only for keys above every key it already holds, so waits can't make a cycle.
+        A lower key needed later (another flush, a node moved meanwhile) is only tried;
+        when it's taken the transaction can't go on in order and an exception is raised,
+        roll back and retry it. SQLite has the database write lock only, which is taken
+        at BEGIN when the engine issues BEGIN IMMEDIATE.
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    table_key = _tree_lock_key(table.fullname)
+    held = _held_tree_locks(connection)
+    keys = {(table_key, _tree_lock_key(tree_id)): tree_id for tree_id in tree_ids if tree_id is not None}
+    top = max(held, default=None)
+    start = time.perf_counter()
+    for key in sorted(keys.keys() - held):
+        if top is not None and key < top:
+            if not connection.execute(select([func.pg_try_advisory_xact_lock(*key)])).scalar():
+                raise Exception(f"tree {keys[key]} is locked out of order, retry the transaction")
+        else:
+            connection.execute(select([func.pg_advisory_xact_lock(*key)]))
+        held.add(key)
+    record_lock_wait(time.perf_counter() - start)
+
+
+def lock_node_trees(table, connection, table_pk, node_ids):
+    """ Lock the trees the nodes belong to, see lock_trees. Returns the locked tree ids.
+
+        A concurrent move can change tree_id between reading and locking it,
+        so it's read again under the lock until no node has left the locked trees.
+    """
+    locked = set()
+    while True:
+        tree_ids = set(connection.execute(
+            select(
+                [
+                    table.c.tree_id
+                ]
+            ).where(
+                table_pk.in_(node_ids)
+            ).distinct()
+        ).scalars().all())
+        if tree_ids <= locked:
+            return locked
+        lock_trees(table, connection, tree_ids - locked)
+        if connection.dialect.name != 'postgresql':
+            # nothing to wait for, the database write lock is held since BEGIN IMMEDIATE
+            return tree_ids
+        locked |= tree_ids
+
+
 class GuidTreesManager(TreesManager):
+    """
+    The attributes below are the defaults for every session. A session factory overrides
+    them for its own sessions with sessionmaker(info={'mptt': {name: value}}), so controllers
+    with different settings don't change each other's sessions.
+    """
+
+    def __init__(self, base_class, sparse_step: int = 0, deferred: bool = False):
+        super().__init__(base_class)
+        # 0 keeps the dense numbering, otherwise new children are put into gaps of this width
+        self.sparse_step = sparse_step
+        # positions of new children are assigned once per flush, see _apply_pending_inserts
+        self.deferred = deferred
+        # tree_id_allocator.TreeIdAllocator for new roots, max(tree_id) + 1 is used without it
+        self.tree_id_allocator = None
+        # take a per-tree lock before changing lft/rgt, see lock_trees
+        self.lock_trees = False
+        # tree_cache.TreeCache to invalidate when a tree changes
+        self.cache = None
+        # table ordering the trees, see register_root
+        self.root_registry = None
+        self.pending = weakref.WeakKeyDictionary()
+        # ids of trees changed by a session, None means all of them
+        self.touched = weakref.WeakKeyDictionary()
+        # instrumentation.SqlStats accounting the statements of every hook call
+        self.instrumentation = None
+
+    def config(self, session, name: str):
+        """Return the setting of the session's factory, the manager's attribute if it has none."""
+        if session is not None:
+            config: dict = session.info.get('mptt')
+            if config is not None and name in config:
+                return config[name]
+        return getattr(self, name)
+
+    def register_factory(self, sessionmaker):
+        event.listen(sessionmaker, 'before_flush', self.before_flush)
+        event.listen(sessionmaker, 'after_flush', self.after_flush)
+        event.listen(sessionmaker, 'after_commit', self.after_commit)
+        event.listen(sessionmaker, 'after_rollback', self.after_rollback)
+        return super().register_factory(sessionmaker)
+
+    def invalidate_trees(self, session, tree_ids=None):
+        """
+        Drop changed trees from the cache. Other connections could load the old
+        rows again until the transaction ends, so they are dropped once more after commit.
+        """
+        cache = self.config(session, 'cache')
+        if cache is None:
+            return
+        if tree_ids is None:
+            self.touched[session] = None
+        else:
+            touched = self.touched.setdefault(session, set())
+            if touched is not None:
+                touched.update(tree_ids)
+        self._drop_trees(cache, tree_ids)
+
+    @staticmethod
+    def _drop_trees(cache, tree_ids):
+        if tree_ids is None:
+            cache.clear()
+        else:
+            for tree_id in tree_ids:
+                cache.invalidate(tree_id)
+
+    def _operation(self, session, kind: str, tree_id=None):
+        instrumentation = self.config(session, 'instrumentation')
+        if instrumentation is None:
+            return nullcontext()
+        return instrumentation.operation(kind, tree_id)
+
     def before_insert(self, mapper, connection, instance):
+        with self._operation(object_session(instance), 'insert', instance.tree_id):
+            self._before_insert(mapper, connection, instance)
+
+    def _before_insert(self, mapper, connection, instance):
+        session = object_session(instance)
+        self.instances[session].add(instance)
+        if self.config(session, 'lock_trees') and instance.parent_id is not None:
+            self._lock_trees_of(mapper, connection, [instance.parent_id])
+        if self.config(session, 'deferred') and instance.parent_id is not None:
+            # placeholders, the real values are written in after_flush
+            instance.left = 0
+            instance.right = 0
+            instance.level = 0
+            self.pending.setdefault(session, {})[instance] = mapper
+            return
+        sparse_step: int = self.config(session, 'sparse_step')
+        tree_id_allocator = self.config(session, 'tree_id_allocator')
+        if sparse_step:
+            my_mptt_sparse_before_insert(mapper, connection, instance, sparse_step, tree_id_allocator)
+        else:
+            my_mptt_before_insert(mapper, connection, instance, tree_id_allocator)
+        self.invalidate_trees(session, [instance.tree_id])
+        root_registry = self.config(session, 'root_registry')
+        if instance.parent_id is None and root_registry is not None:
+            ensure_root(root_registry, connection, instance.tree_id)
+
+    def before_flush(self, session, context, instances):
+        """ Lock the trees of every node of the flush at once, in the order of lock_trees """
+        if not self.config(session, 'lock_trees'):
+            return
+        nodes = {}
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(instance, self.base_class):
+                mapper = inspect(instance).mapper
+                table = _get_tree_table(mapper)
+                table_pk = getattr(table.c, mapper.class_.get_pk_column().name)
+                nodes.setdefault((table, table_pk), set()).update(self._node_ids_to_lock(instance))
+        if not nodes:
+            return
+        connection = session.connection()
+        if connection.dialect.name != 'postgresql':
+            return
+        for table, table_pk in sorted(nodes, key=lambda key: _tree_lock_key(key[0].fullname)):
+            lock_node_trees(table, connection, table_pk, nodes[table, table_pk])
+
+    @staticmethod
+    def _node_ids_to_lock(instance) -> list:
+        """ The node, its parent and the node it's moved next to: the trees it's in and goes to """
+        parent = instance.__dict__.get('parent')
+        node_ids = [instance.get_pk_value(), instance.parent_id, None if parent is None else parent.get_pk_value()] + [
+            getattr(instance, name) for name in ('mptt_move_before', 'mptt_move_after', 'mptt_move_inside')
+            if hasattr(instance, name)
+        ]
+        return [node_id for node_id in node_ids if node_id is not None]
+
+    def after_flush(self, session, context):
+        pending = self.pending.pop(session, None)
+        if not pending:
+            return
+        connection = session.connection()
+        tables = {}
+        for instance, mapper in pending.items():
+            table = _get_tree_table(mapper)
+            table_pk = getattr(table.c, instance.get_pk_column().name)
+            tables.setdefault((table, table_pk), []).append((instance.get_pk_value(), instance.parent_id))
+        for (table, table_pk), nodes in tables.items():
+            with self._operation(session, 'flush') as operation:
+                tree_ids = _apply_pending_inserts(table, connection, table_pk, nodes)
+                if operation is not None and len(tree_ids) == 1:
+                    operation.tree_id = next(iter(tree_ids))
+                self.invalidate_trees(session, tree_ids)
+
+    def after_commit(self, session):
+        cache = self.config(session, 'cache')
+        if cache is not None and session in self.touched:
+            self._drop_trees(cache, self.touched.pop(session))
+
+    def after_rollback(self, session):
+        self.pending.pop(session, None)
+        cache = self.config(session, 'cache')
+        if cache is not None and session in self.touched:
+            self._drop_trees(cache, self.touched.pop(session))
+
+    def before_update(self, mapper, connection, instance):
+        with self._operation(object_session(instance), 'update', instance.tree_id):
+            self._before_update(mapper, connection, instance)
+
+    def _before_update(self, mapper, connection, instance):
         session = object_session(instance)
         self.instances[session].add(instance)
-        my_mptt_before_insert(mapper, connection, instance)
+        if self.config(session, 'lock_trees'):
+            # usually locked by before_flush already, unless the node changed its tree meanwhile
+            self._lock_trees_of(mapper, connection, self._node_ids_to_lock(instance))
+        old_tree_id = inspect(instance).committed_state.get('tree_id', instance.tree_id)
+        mptt_before_update(mapper, connection, instance, self.config(session, 'tree_id_allocator'),
+                           self.config(session, 'root_registry'))
+        self.invalidate_trees(session, {old_tree_id, instance.tree_id})
+
+    def before_delete(self, mapper, connection, instance):
+        with self._operation(object_session(instance), 'delete', instance.tree_id):
+            self._before_delete(mapper, connection, instance)
+
+    def _before_delete(self, mapper, connection, instance):
+        session = object_session(instance)
+        if self.config(session, 'lock_trees'):
+            self._lock_trees_of(mapper, connection, [instance.get_pk_value()])
+        self.instances[session].discard(instance)
+        self.invalidate_trees(session, [instance.tree_id])
+        root_registry = self.config(session, 'root_registry')
+        if instance.parent_id is None and root_registry is not None:
+            unregister_root(root_registry, connection, instance.tree_id)
+        mptt_before_delete(mapper, connection, instance)
+
+    def _lock_trees_of(self, mapper, connection, node_ids):
+        table = _get_tree_table(mapper)
+        table_pk = getattr(table.c, mapper.class_.get_pk_column().name)
+        lock_node_trees(table, connection, table_pk, node_ids)
 
     def register_events(self, remove=False):
         for e, h in (
@@ -422,8 +1380,8 @@ __mixins__ = [BaseNestedSets]
 __all__ = ['BaseNestedSets', 'guid_mptt_sessionmaker']
 
 guid_tree_manager = GuidTreesManager(BaseNestedSets)
-tree_manager.register_events(remove=True)
 # remove all events from the standard mptt, because they do not work with tree_id as guid
-mptt_sessionmaker.register_events()
-# register our new events to support tree_id as tree_id
+tree_manager.register_events(remove=True)
+# register our new events to support tree_id as guid
+guid_tree_manager.register_events()
 guid_mptt_sessionmaker = guid_tree_manager.register_factory
\ No newline at end of file
@@ -0,0 +1,217 @@
+import mmap
+import os
+import struct
+import uuid
+from collections import namedtuple
+from typing import Iterable, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+# File layout (little-endian):
+#   header   - _HEADER
+#   records  - one _record_struct per node, sorted by lft
+#   index    - (id key, record number) sorted by key, keys compare bytewise like the ids
+#   names    - utf-8 category names referenced by (offset, length) of the records
+MAGIC = b'MPTTMMAP'
+VERSION = 1
+_HEADER = struct.Struct('<8sHHBBxxQQQQ16s')
+_INT_KIND = 0
+_UUID_KIND = 1
+
+Node = namedtuple('Node', ('id', 'parent_id', 'level', 'lft', 'rgt', 'name'))
+
+
+def _record_struct(id_size: int) -> struct.Struct:
+    # lft, rgt, level, parent record number (-1 for the root), name offset, name length, id
+    return struct.Struct(f'<qqiiQI4x{id_size}s')
+
+
+def _index_struct(id_size: int) -> struct.Struct:
+    return struct.Struct(f'>{id_size}sI')
+
+
+def _kind_of(value) -> int:
+    return _UUID_KIND if isinstance(value, uuid.UUID) else _INT_KIND
+
+
+def _encode(value, kind: int) -> bytes:
+    if kind == _UUID_KIND:
+        return value.bytes
+    return value.to_bytes(8, 'little', signed=True)
+
+
+def _decode(raw: bytes, kind: int):
+    if kind == _UUID_KIND:
+        return uuid.UUID(bytes=bytes(raw))
+    return int.from_bytes(raw, 'little', signed=True)
+
+
+def _index_key(value, kind: int) -> bytes:
+    if kind == _UUID_KIND:
+        return value.bytes
+    # big-endian with the sign bit flipped sorts like the signed integers
+    return (value + 2 ** 63).to_bytes(8, 'big')
+
+
+def write_tree(rows: Iterable[tuple], path: str, tree_id: Union[int, uuid.UUID]) -> int:
+    """
+    Write rows (id, parent_id, level, lft, rgt, name) ordered by lft, e.g. from
+    DatabaseController.iter_subtree, to `path`. The file is written next to it and
+    renamed at the end, so readers never map a half-written file. Returns the number of nodes.
+    """
+    tmp_path = f"{path}.tmp"
+    names = bytearray()
+    index = []
+    positions: dict = {}
+    record = None
+    kind = None
+    count: int = 0
+    with open(tmp_path, 'wb') as fp:
+        fp.write(b'\0' * _HEADER.size)
+        for node_id, parent_id, level, left, right, name in rows:
+            if record is None:
+                kind = _kind_of(node_id)
+                record = _record_struct(16 if kind == _UUID_KIND else 8)
+            encoded = (name or '').encode('utf-8')
+            fp.write(record.pack(left, right, level, positions.get(parent_id, -1),
+                                 len(names), len(encoded), _encode(node_id, kind)))
+            names += encoded
+            positions[node_id] = count
+            index.append((_index_key(node_id, kind), count))
+            count += 1
+
+        if kind is None:
+            raise Exception("can't write an empty tree")
+        id_size = 16 if kind == _UUID_KIND else 8
+        records_offset = _HEADER.size
+        index_offset = records_offset + count * record.size
+        index.sort()
+        entry = _index_struct(id_size)
+        for key, position in index:
+            fp.write(entry.pack(key, position))
+        names_offset = index_offset + count * entry.size
+        fp.write(names)
+
+        tree_kind = _kind_of(tree_id)
+        fp.seek(0)
+        fp.write(_HEADER.pack(MAGIC, VERSION, id_size, kind, tree_kind, count,
+                              records_offset, index_offset, names_offset,
+                              _encode(tree_id, tree_kind).ljust(16, b'\0')))
+    os.replace(tmp_path, path)
+    logger.debug(f"{count} nodes of tree {tree_id} are written to {path}")
+    return count
+
+
+class MmapTree:
+    """
+    Read-only view of a file written by write_tree. The file is mapped, not read:
+    processes which open the same file share its pages, and a node is decoded
+    only when it's accessed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        (
+            magic, version, id_size, self._kind, tree_kind, self._count,
+            self._records_offset, self._index_offset, self._names_offset, tree_id
+        ) = _HEADER.unpack_from(self._view, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise Exception(f"{path} isn't a tree file of version {VERSION}")
+        self.tree_id = _decode(tree_id[:16 if tree_kind == _UUID_KIND else 8], tree_kind)
+        self._record = _record_struct(id_size)
+        self._entry = _index_struct(id_size)
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _unpack(self, position: int) -> tuple:
+        return self._record.unpack_from(self._view, self._records_offset + position * self._record.size)
+
+    def _left(self, position: int) -> int:
+        return struct.unpack_from('<q', self._view, self._records_offset + position * self._record.size)[0]
+
+    def _parent(self, position: int) -> int:
+        return struct.unpack_from('<i', self._view, self._records_offset + position * self._record.size + 20)[0]
+
+    def node(self, position: int) -> Node:
+        """Decode the node at `position` in lft order."""
+        left, right, level, parent, name_offset, name_length, raw_id = self._unpack(position)
+        start = self._names_offset + name_offset
+        name = str(self._view[start:start + name_length], 'utf-8')
+        parent_id = None if parent < 0 else _decode(self._unpack(parent)[6], self._kind)
+        return Node(_decode(raw_id, self._kind), parent_id, level, left, right, name)
+
+    def position(self, node_id) -> int:
+        """Binary search of the id index, returns the position of the node in lft order."""
+        key = _index_key(node_id, self._kind)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry.unpack_from(self._view, self._index_offset + middle * self._entry.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count:
+            found, position = self._entry.unpack_from(self._view, self._index_offset + low * self._entry.size)
+            if found == key:
+                return position
+        raise Exception(f"node {node_id} isn't in {self.path}")
+
+    def get(self, node_id) -> Node:
+        return self.node(self.position(node_id))
+
+    def _subtree_end(self, position: int) -> int:
+        right = self._unpack(position)[1]
+        low, high = position + 1, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._left(middle) <= right:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def descendants(self, node_id) -> list:
+        """All descendants in lft order."""
+        position = self.position(node_id)
+        return [self.node(i) for i in range(position + 1, self._subtree_end(position))]
+
+    def children(self, node_id) -> list:
+        """Direct children in lft order."""
+        position = self.position(node_id)
+        end = self._subtree_end(position)
+        children: list = []
+        child = position + 1
+        while child < end:
+            children.append(self.node(child))
+            child = self._subtree_end(child)
+        return children
+
+    def ancestors(self, node_id) -> list:
+        """Ancestors from the root down."""
+        ancestors: list = []
+        parent = self._parent(self.position(node_id))
+        while parent >= 0:
+            ancestors.append(self.node(parent))
+            parent = self._parent(parent)
+        ancestors.reverse()
+        return ancestors
+
+    def __iter__(self):
+        for position in range(self._count):
+            yield self.node(position)